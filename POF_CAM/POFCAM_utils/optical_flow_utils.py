@@ -13,6 +13,56 @@ import cv2
 from torch._C import _ImperativeEngine as ImperativeEngine
 
 
+class Flow_Warper:
+    """Backward warping of CAMs/features with optical flows, as done by warp.
+
+    The pixel grid is built once per (H, W, device, dtype) and cached, and the validity mask is
+    computed from the sampling coordinates: the fraction of the bilinear footprint that falls inside
+    the frame is min(i + 1, size - i, 1) along each axis, which is what a grid_sample over a tensor
+    of ones gives. Pixels whose footprint is at least 0.9999 inside are valid (mask 1), the others
+    are zeroed.
+
+    x: [B, C, H, W] and flo: [B, 2, H, W], or [B, T, C, H, W] and [B, T, 2, H, W] to warp the T
+    frames of every sample in a single call. Returns the warped x and its mask ([B, 1, H, W] or
+    [B, T, 1, H, W], broadcastable to x).
+    """
+    def __init__(self):
+        self.grids = {}
+
+    def get_grid(self, h, w, device, dtype):
+        key = (h, w, device, dtype)
+        if key not in self.grids:
+            yy, xx = torch.meshgrid(torch.arange(h, device=device, dtype=dtype), torch.arange(w, device=device, dtype=dtype), indexing='ij')
+            self.grids[key] = torch.stack((xx, yy)).unsqueeze(0)
+        return self.grids[key]
+
+    def __call__(self, x, flo):
+        if x.dim() == 5:
+            b, t = x.shape[:2]
+            output, mask = self(x.flatten(0, 1), flo.flatten(0, 1))
+            return output.unflatten(0, (b, t)), mask.unflatten(0, (b, t))
+
+        # sampling and validity mask in float32 with mixed precision
+        x, flo = x.float(), flo.float()
+        H, W = x.shape[-2:]
+
+        # same arithmetic as the former warp: grid + flow, scaled to [-1, 1]
+        vgrid = self.get_grid(H, W, flo.device, flo.dtype) + flo
+        vgrid = torch.stack((2.0*vgrid[:, 0]/max(W-1, 1)-1.0, 2.0*vgrid[:, 1]/max(H-1, 1)-1.0), dim=-1)
+
+        output = F.grid_sample(x, vgrid, align_corners=False)
+
+        # pixel coordinates sampled by grid_sample (align_corners=False) and inside fraction of their footprint
+        ix = ((vgrid[..., 0] + 1) * W - 1) / 2
+        iy = ((vgrid[..., 1] + 1) * H - 1) / 2
+        inside_x = torch.minimum(ix + 1, W - ix).clamp(0, 1)
+        inside_y = torch.minimum(iy + 1, H - iy).clamp(0, 1)
+        mask = (inside_x * inside_y >= 0.9999).to(x.dtype).unsqueeze(1)
+
+        return output*mask, mask
+
+_flow_warper = Flow_Warper()
+
 def warp(x, flo):
         """
         warp an image/tensor (im2) back to im1, according to the optical flow
@@ -20,36 +70,18 @@ def warp(x, flo):
         x: [B, C, H, W] (im2)
         flo: [B, 2, H, W] flow
 
+        returns the warped tensor and its validity mask (expanded to [B, C, H, W]), see Flow_Warper
         """
-        B, C, H, W = x.size()
-        # mesh grid 
-        xx = torch.arange(0, W).view(1,-1).repeat(H,1)
-        yy = torch.arange(0, H).view(-1,1).repeat(1,W)
-        xx = xx.view(1,1,H,W).repeat(B,1,1,1)
-        yy = yy.view(1,1,H,W).repeat(B,1,1,1)
-        grid = torch.cat((xx,yy),1).float()
-
-        if x.is_cuda:
-            grid = grid.cuda()
-        vgrid = Variable(grid) + flo
-
-        # scale grid to [-1,1] 
-        vgrid[:,0,:,:] = 2.0*vgrid[:,0,:,:]/max(W-1,1)-1.0
-        vgrid[:,1,:,:] = 2.0*vgrid[:,1,:,:]/max(H-1,1)-1.0
-
-        vgrid = vgrid.permute(0,2,3,1)        
-        output = nn.functional.grid_sample(x, vgrid)
-        mask = torch.autograd.Variable(torch.ones(x.size())).cuda()
-        mask = nn.functional.grid_sample(mask, vgrid)
-
-        mask[mask<0.9999] = 0
-        mask[mask>0] = 1
-        
-        return output*mask, mask
+        output, mask = _flow_warper(x, flo)
+        return output, mask.expand_as(output)
 
 
 def resize_flows_batch(flows_batch, new_shape):
 
+    if tuple(flows_batch.shape[-2:]) == tuple(new_shape):
+        # already at the feature resolution (flow pyramid)
+        return flows_batch.cuda()
+
     factor = torch.tensor(flows_batch.shape[-2:])/torch.tensor(new_shape)
 
     flows_batch = F.interpolate(flows_batch, size = new_shape, mode='bilinear', align_corners=False).cuda()
@@ -1,3 +1,4 @@
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import timm
@@ -16,6 +17,83 @@ class FixedBatchNorm(nn.BatchNorm2d):
     def forward(self, x):
         return F.batch_norm(x, self.running_mean, self.running_var, self.weight, self.bias, training=False, eps=self.eps)
 
+class GroupedBatchNorm2d(nn.BatchNorm2d):
+    """BatchNorm2d with separate batch statistics for each of num_groups interleaved groups of samples.
+
+    With num_groups = G the batch holds the G frames of every sample next to each other (sample i,
+    frame g at index i * G + g). In training, each frame is normalised with the statistics of its own
+    group, as if the G groups went through the model one after the other, and the running statistics
+    are updated once per group in that order. With defer_stats, the statistics of the groups are only
+    kept in group_stats, and apply_group_stats updates the running statistics with them later, in any
+    order (e.g. the order of one pass per frame interleaved with other passes). With num_groups = 1
+    (the default) or in eval mode, it is a plain BatchNorm2d.
+    """
+    num_groups = 1
+    defer_stats = False
+
+    def forward(self, x):
+        num_groups = self.num_groups
+        if num_groups == 1 or not self.training:
+            return super().forward(x)
+
+        # groups become channels: (n * G, C, H, W) -> (n, G * C, H, W), one cudnn call for all the groups
+        n, c = x.size(0) // num_groups, x.size(1)
+        channels_last = x.dim() == 4 and not x.is_contiguous() and x.is_contiguous(memory_format=torch.channels_last)
+        group_mean = torch.zeros(num_groups * c, device=x.device, dtype=torch.float32)
+        group_var = torch.ones(num_groups * c, device=x.device, dtype=torch.float32)
+
+        y = F.batch_norm(x.reshape(n, num_groups * c, *x.shape[2:]), group_mean, group_var,
+                         self.weight.repeat(num_groups) if self.affine else None, self.bias.repeat(num_groups) if self.affine else None,
+                         training=True, momentum=1.0, eps=self.eps)
+        y = y.reshape(x.shape)
+        if channels_last:
+            y = y.contiguous(memory_format=torch.channels_last)
+
+        if self.track_running_stats:
+            with torch.no_grad():
+                # with momentum 1.0 the buffers hold the statistics of every group (unbiased variance)
+                stats = torch.stack([group_mean.view(num_groups, c), group_var.view(num_groups, c)], dim=1)
+                if self.defer_stats:
+                    # in place, so that a DataParallel replica writes the buffer of the module itself
+                    self.group_stats.copy_(stats)
+                else:
+                    for mean, var in stats:
+                        self.update_running_stats(mean, var)
+
+        return y
+
+    def update_running_stats(self, mean, var):
+        # through .data: passes of the layer whose backward is still to come saved the buffers (unused
+        # by the backward of training mode) and must not see a new version of them
+        self.num_batches_tracked.data.add_(1)
+        momentum = 1.0 / float(self.num_batches_tracked) if self.momentum is None else self.momentum
+        self.running_mean.data.mul_(1 - momentum).add_(mean, alpha=momentum)
+        self.running_var.data.mul_(1 - momentum).add_(var, alpha=momentum)
+
+    def apply_group_stats(self, groups):
+        with torch.no_grad():
+            for group in groups:
+                self.update_running_stats(*self.group_stats[group])
+
+def set_bn_groups(model, num_groups, defer_stats=False):
+    """Number of interleaved groups of samples whose statistics the GroupedBatchNorm2d layers of model keep apart;
+    with defer_stats, their running statistics are only updated by apply_bn_group_stats."""
+    for module in model.modules():
+        if isinstance(module, GroupedBatchNorm2d):
+            module.num_groups = num_groups
+            module.defer_stats = defer_stats
+            if defer_stats and module.track_running_stats and getattr(module, 'group_stats', torch.empty(0)).shape != (num_groups, 2, module.num_features):
+                module.register_buffer('group_stats', torch.zeros(num_groups, 2, module.num_features, device=module.running_mean.device), persistent=False)
+
+def apply_bn_group_stats(model, groups):
+    """Updates the running statistics of the GroupedBatchNorm2d layers of model with the deferred statistics of groups, in that order."""
+    for module in model.modules():
+        if isinstance(module, GroupedBatchNorm2d) and module.training and module.track_running_stats:
+            module.apply_group_stats(groups)
+
+def has_grouped_bn(model):
+    return any(isinstance(module, GroupedBatchNorm2d) for module in model.modules())
+
 def group_norm(features):
     return nn.GroupNorm(4, features)
 #######################################################################
@@ -30,7 +108,8 @@ class Backbone(nn.Module, ABC_Model):
         if self.mode == 'fix': 
             self.norm_fn = FixedBatchNorm
         else:
-            self.norm_fn = nn.BatchNorm2d
+            # a plain BatchNorm2d unless set_bn_groups is used (fused forward of the frames of a triplet)
+            self.norm_fn = GroupedBatchNorm2d
 
         if 'efficientnet' in model_name:
             self.model = timm.create_model(model_name, pretrained=True)
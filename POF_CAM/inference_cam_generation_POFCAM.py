@@ -87,11 +87,12 @@ class POF_CAM_inference(Cam_generator_inference):
             self.cam_model.load_state_dict(loaded_dict)
 
     
-    def generate_cams_lateral(self, left_s, sample, right_s, flows, scales, cam_model):
-        
-        hr = generate_cams(sample, cam_model, scales, normalize = False)
-        hr_left = generate_cams(left_s, cam_model, scales, normalize = False)
-        hr_right = generate_cams(right_s, cam_model, scales, normalize = False)
+    def generate_cams_lateral(self, left_s, sample, right_s, flows, scales, cam_model, roi = None):
+
+        # roi: union box of the triplet, the full-size CAMs are then warped with the full flows
+        hr = generate_cams(sample, cam_model, scales, normalize = False, roi = roi)
+        hr_left = generate_cams(left_s, cam_model, scales, normalize = False, roi = roi)
+        hr_right = generate_cams(right_s, cam_model, scales, normalize = False, roi = roi)
         
         hr = torch.stack(hr).unsqueeze(0)
         hr_left = torch.stack(hr_left).unsqueeze(0)
@@ -133,7 +134,7 @@ class POF_CAM_inference(Cam_generator_inference):
                         samples, flows, masks, path = self.test_dataset[index_for_dataset]
                         left_s, sample, right_s = samples
                         _, gt, _ = masks
-                        hi_res_cams = self.generate_cams_lateral(left_s, sample, right_s, flows, self.scales, self.cam_model)
+                        hi_res_cams = self.generate_cams_lateral(left_s, sample, right_s, flows, self.scales, self.cam_model, roi = self.get_roi(path, sample))
                         mask = self.generate_masks(hi_res_cams, sample, gt, visualize = visualize)
                         ious.append(self.compute_iou(mask, gt))
 
@@ -160,7 +161,7 @@ class POF_CAM_inference(Cam_generator_inference):
                     
                     for index_for_dataset in range(len(self.test_dataset)):
                         sample, gt, path = self.test_dataset[index_for_dataset]
-                        hi_res_cams  = generate_cams(sample, self.cam_model, self.scales, normalize = norm)
+                        hi_res_cams  = generate_cams(sample, self.cam_model, self.scales, normalize = norm, roi = self.get_roi(path, sample))
                         mask = self.generate_masks(hi_res_cams, sample, gt, visualize = visualize)
                         ious.append(self.compute_iou(mask, gt))
 
@@ -186,7 +187,7 @@ class POF_CAM_inference(Cam_generator_inference):
                     for index_for_dataset in range(len(self.test_dataset)):
                         samples, flows, path = self.test_dataset[index_for_dataset]
                         left_s, sample, right_s = samples
-                        hi_res_cams = self.generate_cams_lateral(left_s, sample, right_s, flows, self.scales, self.cam_model)
+                        hi_res_cams = self.generate_cams_lateral(left_s, sample, right_s, flows, self.scales, self.cam_model, roi = self.get_roi(path, sample))
                         mask = self.generate_masks(hi_res_cams, sample, visualize = visualize)
                         if self.sam_enhance:
                             mask = self.sam_refinemnet(sample, mask, visualize = visualize)
@@ -199,7 +200,7 @@ class POF_CAM_inference(Cam_generator_inference):
                 else:
                     for index_for_dataset in range(len(self.test_dataset)):
                         sample, path  = self.test_dataset[index_for_dataset]
-                        hi_res_cams  = generate_cams(sample, self.cam_model, self.scales, normalize = norm)
+                        hi_res_cams  = generate_cams(sample, self.cam_model, self.scales, normalize = norm, roi = self.get_roi(path, sample))
                         mask = self.generate_masks(hi_res_cams, sample, visualize = visualize)
                         if self.sam_enhance:
                             mask = self.sam_refinemnet(sample, mask, visualize = visualize)
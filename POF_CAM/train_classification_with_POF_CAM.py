@@ -21,6 +21,9 @@ from general_utils.frame_utils import *
 from general_utils.torch_utils import *
 from general_utils.io_utils import *
 from general_utils.log_utils import *
+from general_utils.frame_cache import format_cache_stats
+from general_utils.amp_utils import Mixed_Precision
+from general_utils.prefetch_utils import Prefetcher
 
 from POF_core.networks import *
 from POFCAM_utils.optical_flow_utils import *
@@ -31,6 +34,16 @@ from POFCAM_utils.puzzle_utils import *
 class POF_CAM:
 
     def __init__(self, config, train_loader, validation_loader):
+        # Defaults of the optional settings
+        self.batch_augment = False
+        self.batch_augment_max_degree = 90
+        self.uint8_loader = False
+        self.prefetch_batches = 2
+        self.channels_last = False
+        self.clip_length = None
+        self.fused_forward = False
+        self.amp = False
+
         # Set all attributes from the dictionary
         for key, value in config.items():
             setattr(self, key, value)
@@ -87,10 +100,18 @@ class POF_CAM:
         self.log_func('[i] val_iteration : {:,}'.format(self.val_iteration))
         self.log_func('[i] max_iteration : {:,}'.format(self.max_iteration))
 
+        if self.clip_length is not None:
+            self.log_func('[i] clips of {} frames, {} triplets each'.format(self.clip_length, self.clip_length - 2))
+        if self.fused_forward:
+            self.log_func('[i] fused forward of the frames of every sample')
+
     def set_model(self):
 
         model = Classifier(self.architecture, num_classes=len(self.class_names), mode=self.mode)
 
+        if self.fused_forward and self.mode != 'fix' and not has_grouped_bn(model):
+            raise ValueError('fused_forward needs the per-frame BatchNorm statistics of the resnet backbones (or mode: fix)')
+
         param_groups = model.get_parameter_groups(print_fn=None)
 
         self.gap_fn = model.global_average_pooling_2d
@@ -98,6 +119,9 @@ class POF_CAM:
         model = model.cuda()
         model.train()
 
+        if self.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+
         self.log_func('[i] Architecture is {}'.format(self.architecture))
         self.log_func('[i] Total Params: %.2fM'%(calculate_parameters(model)))
         self.log_func()
@@ -146,140 +170,231 @@ class POF_CAM:
         self.train_timer = Timer()
         self.eval_timer = Timer()
 
-        self.train_meter = Average_Meter(['loss', 'class_loss', 'p_class_loss', 're_loss', 're_loss_puzz', 'alpha', 'beta'])
+        # losses summed on the device, read back only at the log and validation boundaries
+        self.train_meter = Device_Average_Meter(['loss', 'class_loss', 'p_class_loss', 're_loss', 're_loss_puzz', 'alpha', 'beta'])
+        self.epoch_meter = Device_Average_Meter(['loss', 'class_loss', 'p_class_loss', 're_loss', 're_loss_puzz'])
 
         self.writer = SummaryWriter(self.tensorboard_dir)
-        self.train_iterator = seruso_datasets.Iterator(self.train_loader)
-        self.valid_iterator = seruso_datasets.Iterator(self.validation_loader)
+        # batches are read ahead and copied to the GPU by background threads
+        self.train_iterator = Prefetcher(self.train_loader, num_batches=self.prefetch_batches)
+        self.valid_iterator = Prefetcher(self.validation_loader, num_batches=self.prefetch_batches)
 
         self.loss_option = self.loss_option.split('_')
-        
-
-    def evaluate_for_validation(self, loader, alpha, beta):
 
-        val_losses = []
-        val_class_losses = []
-        val_p_class_losses = []
-        val_re_losses = []
-        val_re_losses_puzz = []
+        self.mixed_precision = Mixed_Precision(self.amp)
+        self.log_func('[i] precision : {}'.format(self.mixed_precision))
 
+        # sampling grid of the CAM resolution built once
+        self.flow_warper = Flow_Warper()
 
-        self.model.eval()
-        self.eval_timer.tik()
-
-        with torch.no_grad():
-            length = len(loader)
-            for step, (images_lists, flows_lists, labels) in enumerate(loader):
+        # value of a black pixel after normalisation, used to fill the corners uncovered by the rotations
+        self.augment_fill = [-mean / std for mean, std in zip(self.imagenet_mean, self.imagenet_std)]
 
-                labels =  labels.cuda()
-
-                flows_left, flows_right = flows_lists
+        # with uint8_loader the loader ships uint8 CHW images, normalised here after the transfer
+        self.batch_normalize_fn = Batch_Normalize(self.imagenet_mean, self.imagenet_std, channels_last=self.channels_last)
+        
+    def prepare_images(self, images):
+        images = images.cuda()
+        if self.uint8_loader:
+            images = self.batch_normalize_fn(images)
+        return images
 
-                middle = len(images_lists)//2
 
-                central_images = images_lists [middle].cuda()
-                left_images = images_lists [middle-1].cuda()
-                right_images = images_lists [middle + 1].cuda()
+    def split_flows(self, flows_lists):
+        # flows of every central frame towards its left and right frames: the triplets come with them,
+        # the clips with the forward flows frame i -> i + 1
+        if self.clip_length is None:
+            flows_left, flows_right = flows_lists
+            return [flows_left], [flows_right]
+
+        return [-flow.cuda() for flow in flows_lists[:-1]], [flow.cuda() for flow in flows_lists[1:]]
+
+    def forward_model(self, images):
+        # backbone pass, under autocast with mixed precision; the outputs are cast back to float32 for the losses
+        with self.mixed_precision.autocast():
+            logits, features = self.model(images, with_cam=True)
+        return logits.float(), features.float()
+
+    def forward_fused(self, images):
+        """Single backbone pass on all the frames of the batch, the frames of every sample next to each
+        other. In training, the BatchNorm layers normalise each frame with the statistics of its own
+        group, as with one pass per frame; their running statistics are left to apply_bn_group_stats."""
+        num_frames = len(images)
+        batch = torch.stack(images, dim=1).flatten(0, 1)
+        if self.channels_last:
+            batch = batch.contiguous(memory_format=torch.channels_last)
+
+        set_bn_groups(self.model, num_frames, defer_stats=True)
+        try:
+            logits, features = self.forward_model(batch)
+        finally:
+            set_bn_groups(self.model, 1)
+
+        logits = logits.view(-1, num_frames, *logits.shape[1:]).unbind(dim=1)
+        features = features.view(-1, num_frames, *features.shape[1:]).unbind(dim=1)
+        return list(logits), list(features)
+
+    def repeat_labels(self, labels, images_lists):
+        # one row per central frame, in the order of forward_frames
+        return labels.repeat(len(images_lists) - 2, 1)
+
+    def forward_frames(self, images_lists, flows_lists, with_centre, batch_augment=False):
+        """Backbone pass on every frame of the batch (a triplet, or a clip of clip_length frames) and
+        reconstruction of the CAMs of the central frames from their warped neighbours.
+
+        Each frame goes through the backbone once, whatever the number of triplets it belongs to.
+        The outputs of the central frames are concatenated along the batch, frame after frame.
+        """
+        images = [self.prepare_images(images) for images in images_lists]
+        flows_left, flows_right = self.split_flows(flows_lists)
+
+        if batch_augment:
+            # flips and rotations of every frame on the GPU, with consistently warped flows
+            params = Three_images_batch_affine_transform.sample_params(images[0].size(0), self.batch_augment_max_degree, device=images[0].device, num_frames=len(images))
+            batch_transform = Three_images_batch_affine_transform(params, images[0].shape[-2:])
+
+            images = list(batch_transform(images, fill=self.augment_fill))
+
+            for i in range(len(images) - 2):
+                triplet_transform = Three_images_batch_affine_transform({key: value[:, i:i + 3] for key, value in params.items()}, images[0].shape[-2:])
+                flows_left[i], flows_right[i] = triplet_transform.transform_flows([flows_left[i].cuda(), flows_right[i].cuda()])
+
+        if self.fused_forward:
+            # all the frames in one pass, then the tiles of every central frame
+            frame_logits, cams = self.forward_fused(images)
+            logits = frame_logits[1:-1]
+
+            # running BatchNorm statistics updated in the order of the passes below: every central
+            # frame followed by its tiles, then the first and last frames
+            re_features_puzz = []
+            for i, central_images in enumerate(images[1:-1], 1):
+                apply_bn_group_stats(self.model, [i])
+                tiled_logits, tiled_features = self.forward_model(tile_features(central_images, self.num_pieces))
+                re_features_puzz.append(merge_features(tiled_features, self.num_pieces, self.batch_size))
+            apply_bn_group_stats(self.model, [0, len(images) - 1])
 
+        else:
+            # central frames (each followed by its tiles), then the first and last frames, as for a triplet
+            logits, cams, re_features_puzz = [], [], []
+            for central_images in images[1:-1]:
                 ###############################################################################
                 # Normal
                 ###############################################################################
-                logits, features_puzz = self.model(central_images, with_cam=True)
+                central_logits, central_features = self.forward_model(central_images)
+                logits.append(central_logits)
+                cams.append(central_features)
 
                 ###############################################################################
                 # Puzzle Module
                 ###############################################################################
-
                 tiled_images = tile_features(central_images, self.num_pieces)
 
-                tiled_logits, tiled_features = self.model(tiled_images, with_cam=True)
+                tiled_logits, tiled_features = self.forward_model(tiled_images)
 
-                re_features_puzz = merge_features(tiled_features, self.num_pieces, self.batch_size)
+                re_features_puzz.append(merge_features(tiled_features, self.num_pieces, self.batch_size))
 
-                ###############################################################################
-                # FlowCAM Module
-                ###############################################################################
+            ###############################################################################
+            # FlowCAM Module
+            ###############################################################################
+            first_logits, first_features = self.forward_model(images[0])
+            last_logits, last_features = self.forward_model(images[-1])
+            cams = [first_features] + cams + [last_features]
 
-                left_logits, left_features = self.model(left_images, with_cam=True)
-                right_logits, right_features = self.model(right_images, with_cam=True)
+        logits = torch.cat(logits)
+        features_puzz = torch.cat(cams[1:-1])
+        re_features_puzz = torch.cat(re_features_puzz)
 
-                if self.level == 'cam':
-                    features = make_cam(features_puzz)
-                    left_features = self.make_cam_non_norm(left_features)
-                    right_features = self.make_cam_non_norm(right_features)
+        if self.level == 'cam':
+            features = make_cam(features_puzz)
+            left_features = self.make_cam_non_norm(torch.cat(cams[:-2]))
+            right_features = self.make_cam_non_norm(torch.cat(cams[2:]))
 
-                flows_left = resize_flows_batch(flows_left, features.shape[-2:])
-                flows_right = resize_flows_batch(flows_right, features.shape[-2:])
+        flows_left = torch.cat([resize_flows_batch(flows, features.shape[-2:]) for flows in flows_left])
+        flows_right = torch.cat([resize_flows_batch(flows, features.shape[-2:]) for flows in flows_right])
 
-                warped_left, mask_left = warp(left_features.cuda(), flows_left.cuda())
-                warped_right, mask_right = warp(right_features.cuda(), flows_right.cuda())
+        # left and right neighbours warped in a single call
+        warped, masks = self.flow_warper(torch.stack([left_features, right_features], dim=1).cuda(), torch.stack([flows_left, flows_right], dim=1).cuda())
+        warped_left, warped_right = warped.unbind(dim=1)
 
-                re_features = self.cam_norm(torch.max(torch.stack([warped_left, features, warped_right], dim=1), dim=1)[0])
+        if with_centre:
+            re_features = self.cam_norm(torch.max(torch.stack([warped_left, features, warped_right], dim=1), dim=1)[0])
+        else:
+            re_features = self.cam_norm(torch.max(torch.stack([warped_left, warped_right], dim=1), dim=1)[0])
 
-                ###############################################################################
-                # Losses
-                ###############################################################################
-                if 'cl' in self.loss_option:
-                    class_loss = self.class_loss_fn(logits, labels).mean()
-                else:
-                    class_loss = torch.zeros(1).cuda()
-
-                if 'pcl' in self.loss_option:
-                    
-                    p_class_loss = self.class_loss_fn(self.gap_fn(re_features_puzz), labels).mean()
-                    t_class_loss = self.class_loss_fn(self.gap_fn(re_features), labels).mean()
-                else:
-                    p_class_loss = torch.zeros(1).cuda()
-                    t_class_loss = torch.zeros(1).cuda()
-
-                if 're' in self.loss_option:
-                    if self.re_loss_option == 'masking':
-                        class_mask = labels.unsqueeze(2).unsqueeze(3)
-                        
-                        re_loss = self.re_loss_fn(features, re_features) * class_mask
-                        re_loss = re_loss.mean()
-
-                        re_loss_puzz = self.re_loss_fn(features_puzz, re_features_puzz) * class_mask
-                        re_loss_puzz = re_loss_puzz.mean()
-
-                    elif self.re_loss_option == 'selection':
-                        re_loss = 0.
-                        for b_index in range(labels.size()[0]):
-                            class_indices = labels[b_index].nonzero(as_tuple=True)
-
-                            selected_features = features[b_index][class_indices]
-                            selected_re_features = re_features[b_index][class_indices]
-                            re_loss_per_feature = self.re_loss_fn(selected_features, selected_re_features).mean()
-                            re_loss += re_loss_per_feature
-                    
-                            selected_features_puzz = features_puzz[b_index][class_indices]
-                            selected_re_features_puzz = re_features_puzz[b_index][class_indices]
-                            re_loss_per_feature_puzz = self.re_loss_fn(selected_features_puzz, selected_re_features_puzz).mean()
-                            re_loss_puzz += re_loss_per_feature_puzz
-
-                        re_loss /= labels.size()[0]
-                        re_loss_puzz /= labels.size()[0]
-
-                    else:
-                        re_loss = self.re_loss_fn(features, re_features).mean()
-                        re_loss_puzz = self.re_loss_fn(features_puzz, re_features_puzz).mean()
-                else:
-                    re_loss = torch.zeros(1).cuda()
-                    re_loss_puzz = torch.zeros(1).cuda()
+        return logits, features_puzz, re_features_puzz, features, re_features
+
+    def compute_losses(self, labels, logits, features_puzz, re_features_puzz, features, re_features):
+
+        if 'cl' in self.loss_option:
+            class_loss = self.class_loss_fn(logits, labels).mean()
+        else:
+            class_loss = torch.zeros(1).cuda()
+
+        if 'pcl' in self.loss_option:
+            p_class_loss = self.class_loss_fn(self.gap_fn(re_features_puzz), labels).mean()
+            t_class_loss = self.class_loss_fn(self.gap_fn(re_features), labels).mean()
+
+        else:
+            p_class_loss = torch.zeros(1).cuda()
+            t_class_loss = torch.zeros(1).cuda()
+
+        if 're' in self.loss_option:
+            if self.re_loss_option == 'masking':
+                class_mask = labels.unsqueeze(2).unsqueeze(3)
+
+                re_loss = self.re_loss_fn(features, re_features) * class_mask
+                re_loss = re_loss.mean()
+
+                re_loss_puzz = self.re_loss_fn(features_puzz, re_features_puzz) * class_mask
+                re_loss_puzz = re_loss_puzz.mean()
+
+            elif self.re_loss_option == 'selection':
+                re_loss = selection_loss(self.re_loss_fn, features, re_features, labels)
+                re_loss_puzz = selection_loss(self.re_loss_fn, features_puzz, re_features_puzz, labels)
+
+            else:
+                re_loss = self.re_loss_fn(features, re_features).mean()
+                re_loss_puzz = self.re_loss_fn(features_puzz, re_features_puzz).mean()
+        else:
+            re_loss = torch.zeros(1).cuda()
+            re_loss_puzz = torch.zeros(1).cuda()
+
+        return class_loss, p_class_loss, re_loss, re_loss_puzz
+
+    def evaluate_for_validation(self, loader, alpha, beta):
+
+        val_meter = Device_Average_Meter(['loss', 'class_loss', 'p_class_loss', 're_loss', 're_loss_puzz'])
+
+        self.model.eval()
+        self.eval_timer.tik()
+
+        with torch.no_grad():
+            length = len(loader)
+            for step, (images_lists, flows_lists, labels) in enumerate(loader):
+
+                labels =  labels.cuda()
+
+                logits, features_puzz, re_features_puzz, features, re_features = self.forward_frames(images_lists, flows_lists, with_centre=True)
+                labels = self.repeat_labels(labels, images_lists)
+
+                class_loss, p_class_loss, re_loss, re_loss_puzz = self.compute_losses(labels, logits, features_puzz, re_features_puzz, features, re_features)
 
                 loss = class_loss + p_class_loss + beta*re_loss + alpha*re_loss_puzz
                 #################################################################################################
 
-                val_losses.append(loss.item())
-                val_class_losses.append(class_loss.item())
-                val_p_class_losses.append(p_class_loss.item())
-                val_re_losses.append(beta*re_loss.item())
-                val_re_losses_puzz.append(alpha*re_loss_puzz.item())
+                val_meter.add({
+                    'loss' : loss,
+                    'class_loss' : class_loss,
+                    'p_class_loss' : p_class_loss,
+                    're_loss' : beta*re_loss,
+                    're_loss_puzz' : alpha*re_loss_puzz,
+                })
 
         print(' ')
         self.model.train()
 
-        return val_losses, val_class_losses, val_p_class_losses, val_re_losses, val_re_losses_puzz
+        # mean losses over the validation set
+        return val_meter.get()
     
     def train(self):
 
@@ -295,13 +410,6 @@ class POF_CAM:
         re_losses_valid = []
         re_losses_puzz_valid = []
 
-
-        temp_losses = []
-        temp_class_losses = []
-        temp_p_class_losses= []
-        temp_re_losses = []
-        temp_re_losses_puzz = []
-
         best_val_loss = -1
 
         for iteration in range(self.max_iteration):
@@ -311,108 +419,10 @@ class POF_CAM:
 
             labels =  labels.cuda()
 
-            flows_left, flows_right = flows_lists
+            logits, features_puzz, re_features_puzz, features, re_features = self.forward_frames(images_lists, flows_lists, with_centre=False, batch_augment=self.batch_augment)
+            labels = self.repeat_labels(labels, images_lists)
 
-            middle = len(images_lists)//2
-
-            central_images = images_lists [middle].cuda()
-            left_images = images_lists [middle-1].cuda()
-            right_images = images_lists [middle + 1].cuda()
-
-            ###############################################################################
-            # Normal
-            ###############################################################################
-            logits, features_puzz = self.model(central_images, with_cam=True)
-
-            ###############################################################################
-            # Puzzle Module
-            ###############################################################################
-
-            tiled_images = tile_features(central_images, self.num_pieces)
-
-            tiled_logits, tiled_features = self.model(tiled_images, with_cam=True)
-
-            re_features_puzz = merge_features(tiled_features, self.num_pieces, self.batch_size)
-
-            ###############################################################################
-            # FlowCAM Module
-            ###############################################################################
-
-            left_logits, left_features = self.model(left_images, with_cam=True)
-            right_logits, right_features = self.model(right_images, with_cam=True)
-
-
-            if self.level == 'cam':
-                features = make_cam(features_puzz)
-                left_features = self.make_cam_non_norm(left_features)
-                right_features = self.make_cam_non_norm(right_features)
-
-            # stored_transform = Three_images_batch_trasform(params)
-            
-            # left_features, features, right_features = stored_transform([left_features, features, right_features], revert= True)
-
-            flows_left = resize_flows_batch(flows_left, features.shape[-2:])
-            flows_right = resize_flows_batch(flows_right, features.shape[-2:])
-
-            warped_left, mask_left = warp(left_features.cuda(), flows_left.cuda())
-            warped_right, mask_right = warp(right_features.cuda(), flows_right.cuda())
-
-            re_features = self.cam_norm(torch.max(torch.stack([warped_left, warped_right], dim=1), dim=1)[0])
-
-
-            ###############################################################################
-            # Losses
-            ###############################################################################
-            if 'cl' in self.loss_option:
-                class_loss = self.class_loss_fn(logits, labels).mean()
-            else:
-                class_loss = torch.zeros(1).cuda()
-
-            # class_loss = class_loss_fn(logits, labels).mean()
-
-            if 'pcl' in self.loss_option:        
-                p_class_loss = self.class_loss_fn(self.gap_fn(re_features_puzz), labels).mean()
-                t_class_loss = self.class_loss_fn(self.gap_fn(re_features), labels).mean()
-
-            else:
-                p_class_loss = torch.zeros(1).cuda()
-                t_class_loss = torch.zeros(1).cuda()
-
-            if 're' in self.loss_option:
-                if self.re_loss_option == 'masking':
-                    class_mask = labels.unsqueeze(2).unsqueeze(3)
-
-                    re_loss = self.re_loss_fn(features, re_features) * class_mask
-                    re_loss = re_loss.mean()
-                    
-                    re_loss_puzz = self.re_loss_fn(features_puzz, re_features_puzz) * class_mask
-                    re_loss_puzz = re_loss_puzz.mean()
-
-
-                elif self.re_loss_option == 'selection':
-                    re_loss = 0.
-                    for b_index in range(labels.size()[0]):
-                        class_indices = labels[b_index].nonzero(as_tuple=True)
-
-                        selected_features = features[b_index][class_indices]
-                        selected_re_features = re_features[b_index][class_indices]
-                        re_loss_per_feature = self.re_loss_fn(selected_features, selected_re_features).mean()
-                        re_loss += re_loss_per_feature
-                        
-                        selected_features_puzz = features_puzz[b_index][class_indices]
-                        selected_re_features_puzz = re_features_puzz[b_index][class_indices]
-                        re_loss_per_feature_puzz = self.re_loss_fn(selected_features_puzz, selected_re_features_puzz).mean()
-                        re_loss_puzz += re_loss_per_feature_puzz
-
-                    re_loss /= labels.size()[0]
-                    re_loss_puzz /= labels.size()[0]
-
-                else:
-                    re_loss = self.re_loss_fn(features, re_features).mean()            
-                    re_loss_puzz = self.re_loss_fn(features_puzz, re_features_puzz).mean()
-            else:
-                re_loss = torch.zeros(1).cuda()
-                re_loss_puzz = torch.zeros(1).cuda()
+            class_loss, p_class_loss, re_loss, re_loss_puzz = self.compute_losses(labels, logits, features_puzz, re_features_puzz, features, re_features)
 
             if self.alpha_schedule == 0.0:
                 alpha = self.glob_alpha
@@ -429,22 +439,23 @@ class POF_CAM:
             loss = class_loss + p_class_loss + beta*re_loss + alpha*re_loss_puzz
             #################################################################################################
 
-            temp_losses.append(loss.item())
-            temp_class_losses.append(class_loss.item())
-            temp_p_class_losses.append(p_class_loss.item())
-            temp_re_losses.append(beta*re_loss.item())
-            temp_re_losses_puzz.append(alpha*re_loss_puzz.item())
+            self.epoch_meter.add({
+                'loss' : loss,
+                'class_loss' : class_loss,
+                'p_class_loss' : p_class_loss,
+                're_loss' : beta*re_loss,
+                're_loss_puzz' : alpha*re_loss_puzz,
+            })
 
             self.optimizer.zero_grad()
-            loss.backward()
-            self.optimizer.step()
+            self.mixed_precision.step(loss, self.optimizer)
 
             self.train_meter.add({
-                'loss' : loss.item(),
-                'class_loss' : class_loss.item(),
-                'p_class_loss' : p_class_loss.item(),
-                're_loss' : re_loss.item(),
-                're_loss_puzz' : re_loss_puzz.item(),
+                'loss' : loss,
+                'class_loss' : class_loss,
+                'p_class_loss' : p_class_loss,
+                're_loss' : re_loss,
+                're_loss_puzz' : re_loss_puzz,
                 'alpha' : alpha,
                 'beta': beta,
             })
@@ -466,6 +477,7 @@ class POF_CAM:
                     'p_class_loss' : p_class_loss,
                     're_loss' : re_loss,
                     're_loss_puzz' : re_loss_puzz,
+                    'data_wait' : self.train_iterator.data_wait(clear=True) * 1000,
                     'time' : self.train_timer.tok(clear=True),
                 }
                 self.data_dic['train'].append(data)
@@ -480,6 +492,7 @@ class POF_CAM:
                     p_class_loss={p_class_loss:.4f}, \
                     re_loss={re_loss:.4f}, \
                     re_loss_puzz={re_loss_puzz:.4f}, \
+                    data_wait={data_wait:.1f}ms, \
                     time={time:.0f}sec'.format(**data)
                 )
 
@@ -489,6 +502,7 @@ class POF_CAM:
                 self.writer.add_scalar('Train/re_loss', re_loss, iteration)
                 self.writer.add_scalar('Train/re_loss_puzz', re_loss_puzz, iteration)
                 self.writer.add_scalar('Train/learning_rate', learning_rate, iteration)
+                self.writer.add_scalar('Train/data_wait_ms', data['data_wait'], iteration)
                 self.writer.add_scalar('Train/alpha', alpha, iteration)
                 self.writer.add_scalar('Train/beta', beta, iteration)
 
@@ -497,27 +511,21 @@ class POF_CAM:
             #################################################################################################
             if (iteration + 1) % self.val_iteration == 0:
                 
-                losses.append(np.mean(temp_losses))
-                class_losses.append(np.mean(temp_class_losses))
-                p_class_losses.append(np.mean(temp_p_class_losses))
-                re_losses.append(np.mean(temp_re_losses))
-                re_losses_puzz.append(np.mean(temp_re_losses_puzz))
-
-                temp_losses = []
-                temp_class_losses = []
-                temp_p_class_losses= []
-                temp_re_losses = []
-                temp_re_losses_puzz = []
+                train_loss, train_class_loss, train_p_class_loss, train_re_loss, train_re_loss_puzz = self.epoch_meter.get(clear=True)
 
-                val_losses, val_class_losses, val_p_class_losses, val_re_losses, val_re_losses_puzz = self.evaluate_for_validation(self.validation_loader, alpha, beta)
+                losses.append(train_loss)
+                class_losses.append(train_class_loss)
+                p_class_losses.append(train_p_class_loss)
+                re_losses.append(train_re_loss)
+                re_losses_puzz.append(train_re_loss_puzz)
 
-                val_loss = np.mean(val_losses)
+                val_loss, val_class_loss, val_p_class_loss, val_re_loss, val_re_loss_puzz = self.evaluate_for_validation(self.valid_iterator, alpha, beta)
 
-                losses_valid.append(np.mean(val_losses))
-                class_losses_valid.append(np.mean(val_class_losses))
-                p_class_losses_valid.append(np.mean(val_p_class_losses))
-                re_losses_valid.append(np.mean(val_re_losses))
-                re_losses_puzz_valid.append(np.mean(val_re_losses_puzz))
+                losses_valid.append(val_loss)
+                class_losses_valid.append(val_class_loss)
+                p_class_losses_valid.append(val_p_class_loss)
+                re_losses_valid.append(val_re_loss)
+                re_losses_puzz_valid.append(val_re_loss_puzz)
 
                 if best_val_loss == -1 or best_val_loss > val_loss:
                     best_val_loss = val_loss
@@ -545,7 +553,13 @@ class POF_CAM:
                 self.writer.add_scalar('Evaluation/val_loss', val_loss, iteration)
                 self.writer.add_scalar('Evaluation/best_val_loss', best_val_loss, iteration)
 
+                cache_stats = self.train_loader.dataset.frame_cache_stats()
+                if cache_stats:
+                    self.log_func('[i] {}'.format(format_cache_stats(cache_stats)))
+                    self.train_loader.dataset.reset_frame_cache_stats()
+
         self.writer.close()
+        self.train_iterator.close()
 
         self.train_loader.dataset.do_it_without_flows()
         self.validation_loader.dataset.do_it_without_flows()
@@ -615,9 +629,10 @@ class POF_CAM:
 
 
     def make_cam_non_norm(self, y, epsilon=1e-5):
-        return F.relu(y)
+        return F.relu(y.float())
 
     def cam_norm(self, x, epsilon=1e-5):
+        x = x.float()
         b, c, h, w = x.size()
 
         flat_x = x.view(b, c, (h * w))
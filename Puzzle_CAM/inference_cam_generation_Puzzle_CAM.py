@@ -98,7 +98,7 @@ class Puzzle_CAM_inference(Cam_generator_inference):
 
                 for index_for_dataset in range(len(self.test_dataset)):
                     sample, gt, path = self.test_dataset[index_for_dataset]
-                    hi_res_cams  = generate_cams(sample, self.cam_model, self.scales, normalize = norm)
+                    hi_res_cams  = generate_cams(sample, self.cam_model, self.scales, normalize = norm, roi = self.get_roi(path, sample))
                     mask = self.generate_masks(hi_res_cams, sample, gt, visualize = visualize)
                     ious.append(self.compute_iou(mask, gt))
 
@@ -124,7 +124,7 @@ class Puzzle_CAM_inference(Cam_generator_inference):
 
                 for index_for_dataset in range(len(self.test_dataset)):
                     sample, path  = self.test_dataset[index_for_dataset]
-                    hi_res_cams  = generate_cams(sample, self.cam_model, self.scales, normalize = norm)
+                    hi_res_cams  = generate_cams(sample, self.cam_model, self.scales, normalize = norm, roi = self.get_roi(path, sample))
                     mask = self.generate_masks(hi_res_cams, sample, visualize = visualize)
                     if self.sam_enhance:
                         mask = self.sam_refinemnet(sample, mask)
@@ -21,6 +21,9 @@ from general_utils.augment_utils import *
 from general_utils.frame_utils import *
 from general_utils.io_utils import *
 from general_utils.log_utils import *
+from general_utils.frame_cache import format_cache_stats
+from general_utils.amp_utils import Mixed_Precision
+from general_utils.prefetch_utils import Prefetcher
 
 from Puzzle_CAM_core.networks import *
 from Puzzle_CAM_utils.optim_utils import *
@@ -30,6 +33,12 @@ from Puzzle_CAM_utils.puzzle_utils import *
 class Puzzle_CAM:
 
     def __init__(self, config, train_loader, validation_loader):
+        # Defaults of the optional settings
+        self.uint8_loader = False
+        self.prefetch_batches = 2
+        self.channels_last = False
+        self.amp = False
+
         # Set all attributes from the dictionary
         for key, value in config.items():
             setattr(self, key, value)
@@ -93,6 +102,9 @@ class Puzzle_CAM:
         model = model.cuda()
         model.train()
 
+        if self.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+
         self.log_func('[i] Architecture is {}'.format(self.architecture))
         self.log_func('[i] Total Params: %.2fM'%(calculate_parameters(model)))
         self.log_func()
@@ -141,21 +153,39 @@ class Puzzle_CAM:
         self.train_timer = Timer()
         self.eval_timer = Timer()
 
-        self.train_meter = Average_Meter(['loss', 'class_loss', 'p_class_loss', 're_loss_puzz', 'alpha'])
+        # losses summed on the device, read back only at the log and validation boundaries
+        self.train_meter = Device_Average_Meter(['loss', 'class_loss', 'p_class_loss', 're_loss_puzz', 'alpha'])
+        self.epoch_meter = Device_Average_Meter(['loss', 'class_loss', 'p_class_loss', 're_loss_puzz'])
 
         self.writer = SummaryWriter(self.tensorboard_dir)
-        self.train_iterator = seruso_datasets.Iterator(self.train_loader)
-        self.valid_iterator = seruso_datasets.Iterator(self.validation_loader)
+        # batches are read ahead and copied to the GPU by background threads
+        self.train_iterator = Prefetcher(self.train_loader, num_batches=self.prefetch_batches)
+        self.valid_iterator = Prefetcher(self.validation_loader, num_batches=self.prefetch_batches)
 
         self.loss_option = self.loss_option.split('_')
+
+        self.mixed_precision = Mixed_Precision(self.amp)
+        self.log_func('[i] precision : {}'.format(self.mixed_precision))
+
+        # with uint8_loader the loader ships uint8 CHW images, normalised here after the transfer
+        self.batch_normalize_fn = Batch_Normalize(self.imagenet_mean, self.imagenet_std, channels_last=self.channels_last)
         
+    def prepare_images(self, images):
+        images = images.cuda()
+        if self.uint8_loader:
+            images = self.batch_normalize_fn(images)
+        return images
+
+    def forward_model(self, images):
+        # backbone pass, under autocast with mixed precision; the outputs are cast back to float32 for the losses
+        with self.mixed_precision.autocast():
+            logits, features = self.model(images, with_cam=True)
+        return logits.float(), features.float()
+
 
     def evaluate_for_validation(self, loader, alpha):
 
-        val_losses = []
-        val_class_losses = []
-        val_p_class_losses = []
-        val_re_losses_puzz = []
+        val_meter = Device_Average_Meter(['loss', 'class_loss', 'p_class_loss', 're_loss_puzz'])
 
         self.model.eval()
         self.eval_timer.tik()
@@ -164,13 +194,13 @@ class Puzzle_CAM:
             length = len(loader)
             for step, (images, labels) in enumerate(loader):
 
-                images = images.cuda()
+                images = self.prepare_images(images)
                 labels = labels.cuda()
 
                 ###############################################################################
                 # Normal
                 ###############################################################################
-                logits, features_puzz = self.model(images, with_cam=True)
+                logits, features_puzz = self.forward_model(images)
 
                 ###############################################################################
                 # Puzzle Module
@@ -178,7 +208,7 @@ class Puzzle_CAM:
 
                 tiled_images = tile_features(images, self.num_pieces)
 
-                tiled_logits, tiled_features = self.model(tiled_images, with_cam=True)
+                tiled_logits, tiled_features = self.forward_model(tiled_images)
 
                 re_features_puzz = merge_features(tiled_features, self.num_pieces, self.batch_size)
 
@@ -209,15 +239,7 @@ class Puzzle_CAM:
                         re_loss_puzz = re_loss_puzz.mean()
 
                     elif self.re_loss_option == 'selection':
-                        for b_index in range(labels.size()[0]):
-                            class_indices = labels[b_index].nonzero(as_tuple=True)
-                    
-                            selected_features_puzz = features_puzz[b_index][class_indices]
-                            selected_re_features_puzz = re_features_puzz[b_index][class_indices]
-                            re_loss_per_feature_puzz = self.re_loss_fn(selected_features_puzz, selected_re_features_puzz).mean()
-                            re_loss_puzz += re_loss_per_feature_puzz
-
-                        re_loss_puzz /= labels.size()[0]
+                        re_loss_puzz = selection_loss(self.re_loss_fn, features_puzz, re_features_puzz, labels)
 
                     else:
                         re_loss_puzz = self.re_loss_fn(features_puzz, re_features_puzz).mean()
@@ -232,15 +254,18 @@ class Puzzle_CAM:
                 loss = class_loss + p_class_loss + alpha*re_loss_puzz + conf_loss
                 #################################################################################################
 
-                val_losses.append(loss.item())
-                val_class_losses.append(class_loss.item())
-                val_p_class_losses.append(p_class_loss.item())
-                val_re_losses_puzz.append(alpha*re_loss_puzz.item())
+                val_meter.add({
+                    'loss' : loss,
+                    'class_loss' : class_loss,
+                    'p_class_loss' : p_class_loss,
+                    're_loss_puzz' : alpha*re_loss_puzz,
+                })
 
         print(' ')
         self.model.train()
 
-        return val_losses, val_class_losses, val_p_class_losses, val_re_losses_puzz
+        # mean losses over the validation set
+        return val_meter.get()
     
     def train(self):
 
@@ -254,23 +279,17 @@ class Puzzle_CAM:
         p_class_losses_valid = []
         re_losses_puzz_valid = []
 
-
-        temp_losses = []
-        temp_class_losses = []
-        temp_p_class_losses= []
-        temp_re_losses_puzz = []
-
         best_val_loss = -1
 
         for iteration in range(self.max_iteration):
 
             images, labels = self.train_iterator.get()
-            images, labels = images.cuda(), labels.cuda()
+            images, labels = self.prepare_images(images), labels.cuda()
 
             ###############################################################################
             # Normal
             ###############################################################################
-            logits, features_puzz = self.model(images, with_cam=True)
+            logits, features_puzz = self.forward_model(images)
 
             ###############################################################################
             # Puzzle Module
@@ -278,7 +297,7 @@ class Puzzle_CAM:
 
             tiled_images = tile_features(images, self.num_pieces)
 
-            tiled_logits, tiled_features = self.model(tiled_images, with_cam=True)
+            tiled_logits, tiled_features = self.forward_model(tiled_images)
 
             re_features_puzz = merge_features(tiled_features, self.num_pieces, self.batch_size)
 
@@ -311,15 +330,7 @@ class Puzzle_CAM:
 
 
                 elif self.re_loss_option == 'selection':
-                    for b_index in range(labels.size()[0]):
-                        class_indices = labels[b_index].nonzero(as_tuple=True)
-                        
-                        selected_features_puzz = features_puzz[b_index][class_indices]
-                        selected_re_features_puzz = re_features_puzz[b_index][class_indices]
-                        re_loss_per_feature_puzz = self.re_loss_fn(selected_features_puzz, selected_re_features_puzz).mean()
-                        re_loss_puzz += re_loss_per_feature_puzz
-
-                    re_loss_puzz /= labels.size()[0]
+                    re_loss_puzz = selection_loss(self.re_loss_fn, features_puzz, re_features_puzz, labels)
 
                 else:   
                     re_loss_puzz = self.re_loss_fn(features_puzz, re_features_puzz).mean()
@@ -340,20 +351,21 @@ class Puzzle_CAM:
             loss = class_loss + p_class_loss + alpha*re_loss_puzz + conf_loss
             #################################################################################################
 
-            temp_losses.append(loss.item())
-            temp_class_losses.append(class_loss.item())
-            temp_p_class_losses.append(p_class_loss.item())
-            temp_re_losses_puzz.append(alpha*re_loss_puzz.item())
+            self.epoch_meter.add({
+                'loss' : loss,
+                'class_loss' : class_loss,
+                'p_class_loss' : p_class_loss,
+                're_loss_puzz' : alpha*re_loss_puzz,
+            })
 
             self.optimizer.zero_grad()
-            loss.backward()
-            self.optimizer.step()
+            self.mixed_precision.step(loss, self.optimizer)
 
             self.train_meter.add({
-                'loss' : loss.item(),
-                'class_loss' : class_loss.item(),
-                'p_class_loss' : p_class_loss.item(),
-                're_loss_puzz' : re_loss_puzz.item(),
+                'loss' : loss,
+                'class_loss' : class_loss,
+                'p_class_loss' : p_class_loss,
+                're_loss_puzz' : re_loss_puzz,
                 'alpha' : alpha,
             })
 
@@ -372,6 +384,7 @@ class Puzzle_CAM:
                     'class_loss' : class_loss,
                     'p_class_loss' : p_class_loss,
                     're_loss_puzz' : re_loss_puzz,
+                    'data_wait' : self.train_iterator.data_wait(clear=True) * 1000,
                     'time' : self.train_timer.tok(clear=True),
                 }
                 self.data_dic['train'].append(data)
@@ -384,6 +397,7 @@ class Puzzle_CAM:
                     class_loss={class_loss:.4f}, \
                     p_class_loss={p_class_loss:.4f}, \
                     re_loss_puzz={re_loss_puzz:.4f}, \
+                    data_wait={data_wait:.1f}ms, \
                     time={time:.0f}sec'.format(**data)
                 )
 
@@ -392,6 +406,7 @@ class Puzzle_CAM:
                 self.writer.add_scalar('Train/p_class_loss', p_class_loss, iteration)
                 self.writer.add_scalar('Train/re_loss_puzz', re_loss_puzz, iteration)
                 self.writer.add_scalar('Train/learning_rate', learning_rate, iteration)
+                self.writer.add_scalar('Train/data_wait_ms', data['data_wait'], iteration)
                 self.writer.add_scalar('Train/alpha', alpha, iteration)
 
             #################################################################################################
@@ -399,24 +414,19 @@ class Puzzle_CAM:
             #################################################################################################
             if (iteration + 1) % self.val_iteration == 0:
                 
-                losses.append(np.mean(temp_losses))
-                class_losses.append(np.mean(temp_class_losses))
-                p_class_losses.append(np.mean(temp_p_class_losses))
-                re_losses_puzz.append(np.mean(temp_re_losses_puzz))
+                train_loss, train_class_loss, train_p_class_loss, train_re_loss_puzz = self.epoch_meter.get(clear=True)
 
-                temp_losses = []
-                temp_class_losses = []
-                temp_p_class_losses= []
-                temp_re_losses_puzz = []
+                losses.append(train_loss)
+                class_losses.append(train_class_loss)
+                p_class_losses.append(train_p_class_loss)
+                re_losses_puzz.append(train_re_loss_puzz)
 
-                val_losses, val_class_losses, val_p_class_losses, val_re_losses_puzz = self.evaluate_for_validation(self.validation_loader, alpha)
+                val_loss, val_class_loss, val_p_class_loss, val_re_loss_puzz = self.evaluate_for_validation(self.valid_iterator, alpha)
 
-                val_loss = np.mean(val_losses)
-
-                losses_valid.append(np.mean(val_losses))
-                class_losses_valid.append(np.mean(val_class_losses))
-                p_class_losses_valid.append(np.mean(val_p_class_losses))
-                re_losses_puzz_valid.append(np.mean(val_re_losses_puzz))
+                losses_valid.append(val_loss)
+                class_losses_valid.append(val_class_loss)
+                p_class_losses_valid.append(val_p_class_loss)
+                re_losses_puzz_valid.append(val_re_loss_puzz)
 
                 if best_val_loss == -1 or best_val_loss > val_loss:
                     best_val_loss = val_loss
@@ -444,7 +454,13 @@ class Puzzle_CAM:
                 self.writer.add_scalar('Evaluation/val_loss', val_loss, iteration)
                 self.writer.add_scalar('Evaluation/best_val_loss', best_val_loss, iteration)
 
+                cache_stats = self.train_loader.dataset.frame_cache_stats()
+                if cache_stats:
+                    self.log_func('[i] {}'.format(format_cache_stats(cache_stats)))
+                    self.train_loader.dataset.reset_frame_cache_stats()
+
         self.writer.close()
+        self.train_iterator.close()
 
         train_losses = {
             'Total Loss': losses,
@@ -31,11 +31,21 @@ from general_utils.augment_utils import *
 from general_utils.torch_utils import *
 from general_utils.augment_utils import *
 from general_utils.frame_utils import *
+from general_utils.frame_cache import format_cache_stats
+from general_utils.amp_utils import Mixed_Precision
+from general_utils.log_utils import Device_Average_Meter
+from general_utils.prefetch_utils import Prefetcher
 
 
 class standardClassifier:
 
     def __init__(self, config, train_loader, validation_loader):
+        # Defaults of the optional settings
+        self.uint8_loader = False
+        self.prefetch_batches = 2
+        self.channels_last = False
+        self.amp = False
+
         # Set all attributes from the dictionary
         for key, value in config.items():
             setattr(self, key, value)
@@ -103,6 +113,9 @@ class standardClassifier:
 
         model.cuda()
         model.train()
+
+        if self.channels_last:
+            model = model.to(memory_format=torch.channels_last)
         
         self.log_func('[i] Architecture is {}'.format(self.architecture))
         self.log_func('[i] Total Params: %.2fM'%(calculate_parameters(model)))
@@ -165,7 +178,21 @@ class standardClassifier:
 
         self.criterion = torch.nn.BCELoss()
         # self.criterion = nn.MultiLabelSoftMarginLoss(reduction='none').cuda()
-        self.dataloaders_dict = {"train": self.train_loader, "val": self.validation_loader}
+        # batches are read ahead and copied to the GPU by background threads
+        self.dataloaders_dict = {"train": Prefetcher(self.train_loader, num_batches=self.prefetch_batches),
+                                 "val": Prefetcher(self.validation_loader, num_batches=self.prefetch_batches)}
+
+        self.mixed_precision = Mixed_Precision(self.amp)
+        self.log_func('[i] precision : {}'.format(self.mixed_precision))
+
+        # with uint8_loader the loader ships uint8 CHW images, normalised here after the transfer
+        self.batch_normalize_fn = Batch_Normalize(self.imagenet_mean, self.imagenet_std, channels_last=self.channels_last)
+
+    def prepare_images(self, images):
+        images = images.cuda()
+        if self.uint8_loader:
+            images = self.batch_normalize_fn(images)
+        return images
 
 
     def train(self):
@@ -197,20 +224,23 @@ class standardClassifier:
                 else:
                     self.model.eval()   # Set model to evaluate mode
 
-                running_loss = 0.0
-                running_corrects = 0
+                # losses summed on the device, read back once at the end of the phase
+                phase_meter = Device_Average_Meter(['loss', 'error'])
                 num_samples = 0
 
                 # Iterate over data
                 for images, labels in tqdm(self.dataloaders_dict[phase]):
-                    images, labels = images.cuda(), labels.cuda()
+                    images, labels = self.prepare_images(images), labels.cuda()
 
                     # Zero the parameter gradients
                     self.optimizer_ft.zero_grad()
 
                     # Forward
                     with torch.set_grad_enabled(phase == 'train'):
-                        outputs = self.model(images)
+                        # BCELoss on the softmax outputs in float32 (it is not allowed under autocast)
+                        with self.mixed_precision.autocast():
+                            outputs = self.model(images)
+                        outputs = outputs.float()
                         # labels.data = labels.data
                         labels = labels.float()
 
@@ -219,18 +249,21 @@ class standardClassifier:
 
                         # Backward + optimize only if in training phase
                         if phase == 'train':
-                            loss.backward()
-                            self.optimizer_ft.step()
+                            self.mixed_precision.step(loss, self.optimizer_ft)
 
                     # Statistics
-                    running_loss += loss.item() * images.size(0)
-                    running_corrects += torch.mean(torch.abs(preds - labels.data))
+                    phase_meter.add({
+                        'loss' : loss * images.size(0),
+                        'error' : torch.mean(torch.abs(preds - labels.data)),
+                    })
                     num_samples += 1
 
+                mean_loss, epoch_acc = phase_meter.get()
+                running_loss = mean_loss * num_samples
+
                 epoch_loss = running_loss / self.batch_size * num_samples
-                epoch_acc = running_corrects.double() / num_samples
 
-                self.log_func('{} Loss: {:.4f} MSE: {:.4f}\n'.format(phase, epoch_loss, epoch_acc))
+                self.log_func('{} Loss: {:.4f} MSE: {:.4f} data_wait: {:.1f}ms\n'.format(phase, epoch_loss, epoch_acc, self.dataloaders_dict[phase].data_wait(clear=True) * 1000))
 
                 # Deep copy the model
                 if phase == 'val':
@@ -247,6 +280,11 @@ class standardClassifier:
                     train_losses.append(epoch_loss)
                     train_accuracies.append(epoch_acc)
 
+                    cache_stats = self.train_loader.dataset.frame_cache_stats()
+                    if cache_stats:
+                        self.log_func('[i] {}\n'.format(format_cache_stats(cache_stats)))
+                        self.train_loader.dataset.reset_frame_cache_stats()
+
         time_elapsed = time.time() - since
 
         self.log_func('Training complete in {:.0f}m {:.0f}s\n'.format(time_elapsed // 60, time_elapsed % 60))
@@ -0,0 +1,125 @@
+"""Parity and speed of mixed precision (general_utils.amp_utils) on a POF-CAM training step.
+
+A step runs the three frames of a triplet and the tiles of the central frame through the layers of
+Classifier (randomly initialised), then make_cam, warp and the class, puzzle and reconstruction
+losses in float32, as POF_CAM does. For the parity check, the float32 and mixed precision losses
+are computed on every batch with the same weights: the script fails when their relative difference
+exceeds --tolerance. (The gradients of a randomly initialised ResNet are too ill-conditioned to be
+compared: a 0.1% change of the inputs already moves them by most of their norm in float32.)
+Peak memory is reported on the GPU only.
+
+Run from the repository root:
+    python -m benchmarks.bench_amp --amp auto --image_size 512 --batch_size 8
+"""
+import sys
+import copy
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+
+from general_utils.amp_utils import Mixed_Precision
+from general_utils.torch_utils import make_cam, L1_Loss
+from POF_CAM.POFCAM_utils.optical_flow_utils import warp
+from POF_CAM.POFCAM_utils.puzzle_utils import tile_features, merge_features
+from benchmarks.bench_fused_forward import Bench_Classifier
+
+
+def pof_loss(model, mixed_precision, batch, num_pieces=4):
+    (left, centre, right), (flows_left, flows_right), labels = batch
+
+    def forward_model(images):
+        with mixed_precision.autocast():
+            logits, features = model(images)
+        return logits.float(), features.float()
+
+    logits, features = forward_model(centre)
+    _, tiled_features = forward_model(tile_features(centre, num_pieces))
+    re_features_puzz = merge_features(tiled_features, num_pieces, centre.size(0))
+    _, left_features = forward_model(left)
+    _, right_features = forward_model(right)
+
+    size = features.shape[-2:]
+    warped_left, _ = warp(torch.relu(left_features), nn.functional.interpolate(flows_left, size, mode='bilinear'))
+    warped_right, _ = warp(torch.relu(right_features), nn.functional.interpolate(flows_right, size, mode='bilinear'))
+    re_features = make_cam(torch.max(warped_left, warped_right))
+
+    class_loss_fn = nn.MultiLabelSoftMarginLoss()
+    class_mask = labels.unsqueeze(2).unsqueeze(3)
+    loss = class_loss_fn(logits, labels) + class_loss_fn(re_features_puzz.mean(dim=(2, 3)), labels) \
+        + (L1_Loss(make_cam(features), re_features) * class_mask).mean() + (L1_Loss(features, re_features_puzz) * class_mask).mean()
+    return loss
+
+def pof_step(model, optimizer, mixed_precision, batch):
+    loss = pof_loss(model, mixed_precision, batch)
+    optimizer.zero_grad()
+    mixed_precision.step(loss, optimizer)
+
+def time_steps(model, mixed_precision, batches, lr):
+    optimizer = torch.optim.SGD(model.parameters(), lr=lr, momentum=0.9)
+    pof_step(model, optimizer, mixed_precision, batches[0])  # warm-up
+
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for batch in batches:
+        pof_step(model, optimizer, mixed_precision, batch)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    step_time = (time.perf_counter() - start) / len(batches)
+    peak_memory = torch.cuda.max_memory_allocated() / 2**20 if torch.cuda.is_available() else None
+    return step_time, peak_memory
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare float32 and mixed precision POF-CAM training steps.")
+    parser.add_argument("--amp", type=str, default='auto', help="auto, fp16 or bf16 (see general_utils/amp_utils.py)")
+    parser.add_argument("--architecture", type=str, default='resnet50')
+    parser.add_argument("--image_size", type=int, default=512)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--num_classes", type=int, default=3)
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--lr", type=float, default=0.001)
+    parser.add_argument("--tolerance", type=float, default=0.05, help="maximum relative difference of the losses")
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+
+    model = Bench_Classifier(args.architecture, args.num_classes).to(device).train()
+    amp_model = copy.deepcopy(model)
+
+    size = (args.batch_size, 3, args.image_size, args.image_size)
+    flow_size = (args.batch_size, 2, args.image_size, args.image_size)
+    batches = [([torch.randn(size, device=device) for _ in range(3)],
+                [4 * torch.randn(flow_size, device=device) for _ in range(2)],
+                torch.randint(0, 2, (args.batch_size, args.num_classes), device=device).float()) for _ in range(args.steps)]
+
+    float32 = Mixed_Precision(False, device.type)
+    mixed_precision = Mixed_Precision(args.amp, device.type)
+
+    with torch.no_grad():
+        fp32_losses = [pof_loss(model, float32, batch).item() for batch in batches]
+        amp_losses = [pof_loss(amp_model, mixed_precision, batch).item() for batch in batches]
+    errors = [abs(a - b) / max(abs(a), 1e-12) for a, b in zip(fp32_losses, amp_losses)]
+
+    fp32_time, fp32_memory = time_steps(model, float32, batches, args.lr)
+    amp_time, amp_memory = time_steps(amp_model, mixed_precision, batches, args.lr)
+    images_per_step = args.batch_size * (3 + 4)
+
+    print('[i] batch             : triplets of {}x3x{}x{} ({}) on {}'.format(args.batch_size, args.image_size, args.image_size, args.architecture, device))
+    print('[i] precision         : {}'.format(mixed_precision))
+    print('[i] float32 losses    : {}'.format(', '.join('{:.4f}'.format(loss) for loss in fp32_losses)))
+    print('[i] amp losses        : {}'.format(', '.join('{:.4f}'.format(loss) for loss in amp_losses)))
+    print('[i] max difference    : {:.2e} (relative, tolerance {:.0e})'.format(max(errors), args.tolerance))
+    print('[i] float32           : {:.1f} ms/step, {:.1f} images/s{}'.format(fp32_time * 1000, images_per_step / fp32_time, '' if fp32_memory is None else ', peak {:.0f} MB'.format(fp32_memory)))
+    print('[i] amp               : {:.1f} ms/step, {:.1f} images/s{}'.format(amp_time * 1000, images_per_step / amp_time, '' if amp_memory is None else ', peak {:.0f} MB'.format(amp_memory)))
+    print('[i] speed-up          : {:.2f}x'.format(fp32_time / amp_time))
+
+    if max(errors) > args.tolerance:
+        print('[!] the mixed precision losses differ from float32 by more than the tolerance')
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
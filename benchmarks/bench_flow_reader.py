@@ -0,0 +1,67 @@
+"""Microbenchmark: legacy .flo reader vs. the memory-mapped reader.
+
+Run from the repository root:
+    python -m benchmarks.bench_flow_reader --height 1080 --width 1920 --num_flows 64
+"""
+import os
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import torch
+
+from general_utils import frame_utils
+from seruso_datasets import flow_to_tensor
+
+
+def legacy_load(path, negate):
+    flow = frame_utils.read_gen(path)
+    flow = np.array(flow).astype(np.float32)
+    if negate:
+        flow = -flow
+    return torch.from_numpy(flow).permute(2, 0, 1).float()
+
+def mmap_load(path, negate):
+    return flow_to_tensor(frame_utils.read_flow_mmap(path), negate = negate)
+
+def time_reader(load_fn, paths, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for i, path in enumerate(paths):
+            load_fn(path, negate = (i % 2 == 0))
+        best = min(best, time.perf_counter() - start)
+    return best / len(paths)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the legacy and memory-mapped .flo readers.")
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--num_flows", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = []
+        for i in range(args.num_flows):
+            path = os.path.join(tmp_dir, 'frame_{:04d}.flo'.format(i))
+            frame_utils.writeFlow(path, np.random.randn(args.height, args.width, 2).astype(np.float32))
+            paths.append(path)
+
+        for i, path in enumerate(paths):
+            assert torch.equal(legacy_load(path, i % 2 == 0), mmap_load(path, i % 2 == 0))
+
+        # warm the page cache so that both readers are measured on decoding, not on disk
+        time_reader(mmap_load, paths, 1)
+
+        legacy = time_reader(legacy_load, paths, args.repeats)
+        mmapped = time_reader(mmap_load, paths, args.repeats)
+
+    print('[i] flow size       : {}x{}'.format(args.height, args.width))
+    print('[i] legacy reader   : {:.2f} ms/flow'.format(legacy * 1000))
+    print('[i] mmap reader     : {:.2f} ms/flow'.format(mmapped * 1000))
+    print('[i] speed-up        : {:.2f}x'.format(legacy / mmapped))
+
+if __name__ == "__main__":
+    main()
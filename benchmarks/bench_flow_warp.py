@@ -0,0 +1,118 @@
+"""Parity and speed of Flow_Warper (cached pixel grid, validity mask from the sampling coordinates)
+against the former warp of POFCAM_utils.optical_flow_utils (meshgrid built with repeat on every call
+and a second grid_sample over a tensor of ones for the mask).
+
+The left and right warps of a POF-CAM step are timed as two former calls, two Flow_Warper calls, and
+a single batched Flow_Warper call on [B, 2, C, H, W]. The script fails when an output differs from the
+former one by more than 1e-6 or when any mask pixel differs.
+
+Run from the repository root:
+    python -m benchmarks.bench_flow_warp --batch_size 32 --num_classes 3 --cam_size 16
+"""
+import sys
+import time
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+from POF_CAM.POFCAM_utils.optical_flow_utils import Flow_Warper
+
+
+def legacy_warp(x, flo):
+    # former warp, with the mask created on the device of x instead of .cuda()
+    B, C, H, W = x.size()
+    xx = torch.arange(0, W).view(1,-1).repeat(H,1)
+    yy = torch.arange(0, H).view(-1,1).repeat(1,W)
+    xx = xx.view(1,1,H,W).repeat(B,1,1,1)
+    yy = yy.view(1,1,H,W).repeat(B,1,1,1)
+    grid = torch.cat((xx,yy),1).float().to(x.device)
+    vgrid = grid + flo
+
+    vgrid[:,0,:,:] = 2.0*vgrid[:,0,:,:]/max(W-1,1)-1.0
+    vgrid[:,1,:,:] = 2.0*vgrid[:,1,:,:]/max(H-1,1)-1.0
+
+    vgrid = vgrid.permute(0,2,3,1)
+    output = F.grid_sample(x, vgrid)
+    mask = torch.ones(x.size(), device=x.device)
+    mask = F.grid_sample(mask, vgrid)
+
+    mask[mask<0.9999] = 0
+    mask[mask>0] = 1
+
+    return output*mask, mask
+
+def check_parity(warper, device, num_trials=20):
+    output_error, mask_mismatches, num_pixels = 0., 0, 0
+    generator = torch.Generator().manual_seed(0)
+    for trial in range(num_trials):
+        b, c = 4, 3
+        h, w = [int(v) for v in torch.randint(1, 40, (2,), generator=generator)]
+        x = torch.rand(b, c, h, w, generator=generator).to(device)
+        # flows of a few pixels, with some of the samples leaving the frame; integer flows hit the borders exactly
+        flo = (torch.randn(b, 2, h, w, generator=generator) * 3 * (trial % 4)).to(device)
+        if trial % 5 == 0:
+            flo = flo.round()
+
+        reference, reference_mask = legacy_warp(x, flo)
+        output, mask = warper(x, flo)
+        output_error = max(output_error, (reference - output).abs().max().item())
+        mask_mismatches += int((reference_mask != mask.expand_as(reference_mask)).sum())
+        num_pixels += reference_mask.numel()
+
+        # T frames in one call
+        frames, flows = torch.stack([x, x.flip(0)], dim=1), torch.stack([flo, -flo], dim=1)
+        batched, _ = warper(frames, flows)
+        output_error = max(output_error, (batched[:, 0] - reference).abs().max().item())
+        output_error = max(output_error, (batched[:, 1] - legacy_warp(x.flip(0), -flo)[0]).abs().max().item())
+
+    return output_error, mask_mismatches, num_pixels
+
+def time_fn(fn, repeats):
+    fn()  # warm-up
+    best = float('inf')
+    for _ in range(repeats):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the former warp with Flow_Warper.")
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--num_classes", type=int, default=3)
+    parser.add_argument("--cam_size", type=int, default=16, help="CAM resolution (image_size / 32), or the image size at inference")
+    parser.add_argument("--repeats", type=int, default=50)
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+    warper = Flow_Warper()
+
+    output_error, mask_mismatches, num_pixels = check_parity(warper, device)
+
+    shape = (args.batch_size, args.num_classes, args.cam_size, args.cam_size)
+    flow_shape = (args.batch_size, 2, args.cam_size, args.cam_size)
+    left, right = torch.rand(shape, device=device), torch.rand(shape, device=device)
+    flows_left, flows_right = torch.randn(flow_shape, device=device) * 2, torch.randn(flow_shape, device=device) * 2
+
+    legacy_time = time_fn(lambda: (legacy_warp(left, flows_left), legacy_warp(right, flows_right)), args.repeats)
+    warper_time = time_fn(lambda: (warper(left, flows_left), warper(right, flows_right)), args.repeats)
+    batched_time = time_fn(lambda: warper(torch.stack([left, right], dim=1), torch.stack([flows_left, flows_right], dim=1)), args.repeats)
+
+    print('[i] CAMs              : 2 x {}x{}x{}x{} on {}'.format(*shape, device))
+    print('[i] parity            : max output difference {:.2e}, {} / {:,} mask pixels differ'.format(output_error, mask_mismatches, num_pixels))
+    print('[i] former warp       : {:.3f} ms'.format(legacy_time * 1000))
+    print('[i] Flow_Warper       : {:.3f} ms ({:.2f}x)'.format(warper_time * 1000, legacy_time / warper_time))
+    print('[i] batched (T=2)     : {:.3f} ms ({:.2f}x)'.format(batched_time * 1000, legacy_time / batched_time))
+
+    if output_error > 1e-6 or mask_mismatches > 0:
+        print('[!] Flow_Warper differs from the former warp')
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Microbenchmark: one backbone pass per frame of a triplet (POF_CAM) vs. a single fused pass on the
+3B batch with per-frame BatchNorm statistics (GroupedBatchNorm2d).
+
+A step is the forward and backward passes of the frames through the layers of Classifier
+(mode='normal'); the tiled forward of the Puzzle module is the same in both cases and left out.
+As in POF_CAM, the frames go through the model centre frames first, then the first and last frames,
+and the fused pass updates the running BatchNorm statistics in that order (apply_bn_group_stats).
+The weights are random (the ImageNet weights are not downloaded), the timings do not depend on them.
+
+Run from the repository root:
+    python -m benchmarks.bench_fused_forward --architecture resnet50 --image_size 512 --batch_size 8
+"""
+import copy
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+
+from POF_CAM.POF_core.arch_resnet import resnet
+from POF_CAM.POF_core.networks import GroupedBatchNorm2d, set_bn_groups, apply_bn_group_stats
+
+
+class Bench_Classifier(nn.Module):
+    """Layers and forward(x, with_cam=True) of Classifier, randomly initialised."""
+    def __init__(self, architecture, num_classes):
+        super().__init__()
+        backbone = resnet.ResNet(resnet.Bottleneck, resnet.layers_dic[architecture], strides=(2, 2, 2, 2), batch_norm_fn=GroupedBatchNorm2d)
+        self.stages = nn.Sequential(backbone.conv1, backbone.bn1, backbone.relu, backbone.maxpool,
+                                    backbone.layer1, backbone.layer2, backbone.layer3, backbone.layer4)
+        self.classifier = nn.Conv2d(2048, num_classes, 1, bias=False)
+
+    def forward(self, x):
+        features = self.classifier(self.stages(x))
+        return features.mean(dim=(2, 3)), features
+
+def get_frame_order(num_frames):
+    return list(range(1, num_frames - 1)) + [0, num_frames - 1]
+
+def sequential_forward(model, frames):
+    outputs = {i: model(frames[i]) for i in get_frame_order(len(frames))}
+    return [outputs[i] for i in range(len(frames))]
+
+def fused_forward(model, frames):
+    num_frames = len(frames)
+    set_bn_groups(model, num_frames, defer_stats=True)
+    try:
+        logits, features = model(torch.stack(frames, dim=1).flatten(0, 1))
+    finally:
+        set_bn_groups(model, 1)
+    apply_bn_group_stats(model, get_frame_order(num_frames))
+    return list(zip(logits.view(-1, num_frames, *logits.shape[1:]).unbind(dim=1), features.view(-1, num_frames, *features.shape[1:]).unbind(dim=1)))
+
+def step(model, forward_fn, frames):
+    outputs = forward_fn(model, frames)
+    loss = sum(logits.pow(2).mean() + features.relu().mean() for logits, features in outputs)
+    model.zero_grad(set_to_none=True)
+    loss.backward()
+    return outputs
+
+def time_step(model, forward_fn, frames, repeats):
+    step(model, forward_fn, frames)  # warm-up (cudnn algorithms, allocator)
+    best = float('inf')
+    for _ in range(repeats):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        step(model, forward_fn, frames)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare one backbone pass per frame with a fused pass on all the frames.")
+    parser.add_argument("--architecture", type=str, default='resnet50')
+    parser.add_argument("--image_size", type=int, default=512)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--num_frames", type=int, default=3)
+    parser.add_argument("--num_classes", type=int, default=3)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+
+    model = Bench_Classifier(args.architecture, args.num_classes).to(device).train()
+    fused_model = copy.deepcopy(model)
+    frames = [torch.randn(args.batch_size, 3, args.image_size, args.image_size, device=device) for _ in range(args.num_frames)]
+
+    # same outputs, gradients and running statistics up to float rounding
+    reference = step(model, sequential_forward, frames)
+    outputs = step(fused_model, fused_forward, frames)
+    output_error = max((a - b).abs().max().item() for pair, fused_pair in zip(reference, outputs) for a, b in zip(pair, fused_pair))
+    grad_error = max(((a.grad - b.grad).abs().max() / a.grad.abs().max().clamp(min=1e-12)).item() for a, b in zip(model.parameters(), fused_model.parameters()))
+    # the state dicts hold the running statistics, not the deferred group statistics of the fused model
+    stats_error = max((a - b).abs().max().item() for a, b in zip(model.state_dict().values(), fused_model.state_dict().values()))
+
+    sequential_time = time_step(model, sequential_forward, frames, args.repeats)
+    fused_time = time_step(fused_model, fused_forward, frames, args.repeats)
+
+    print('[i] frames            : {} x {}x3x{}x{} ({}) on {}'.format(args.num_frames, args.batch_size, args.image_size, args.image_size, args.architecture, device))
+    print('[i] max difference    : outputs {:.2e}, gradients {:.2e} (relative), running stats {:.2e}'.format(output_error, grad_error, stats_error))
+    print('[i] one pass / frame  : {:.1f} ms/step'.format(sequential_time * 1000))
+    print('[i] fused pass        : {:.1f} ms/step'.format(fused_time * 1000))
+    print('[i] speed-up          : {:.2f}x'.format(sequential_time / fused_time))
+
+if __name__ == "__main__":
+    main()
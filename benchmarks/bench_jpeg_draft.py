@@ -0,0 +1,77 @@
+"""Microbenchmark: full JPEG decode + Resize vs. reduced-scale (draft) decode + Resize, per triplet.
+
+Run from the repository root:
+    python -m benchmarks.bench_jpeg_draft --height 1080 --width 1920 --image_size 512
+"""
+import os
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+from PIL import Image
+from torchvision import transforms
+
+from general_utils import frame_utils
+
+
+def make_frame(path, height, width, rng):
+    # smooth content with some noise, closer to camera frames than pure noise
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([np.sin(x / 37.) + np.cos(y / 23.), np.sin((x + y) / 51.), np.cos(x / 17.) * np.sin(y / 29.)], axis=-1)
+    image = (base + 2) * 60 + rng.normal(0, 8, (height, width, 3))
+    Image.fromarray(np.clip(image, 0, 255).astype(np.uint8)).save(path, quality=90)
+
+def load_triplet(paths, resize, decode_size):
+    return [np.asarray(resize(frame_utils.draft_image(frame_utils.read_gen(path), decode_size).convert('RGB'))) for path in paths]
+
+def time_triplets(triplets, resize, decode_size, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for paths in triplets:
+            load_triplet(paths, resize, decode_size)
+        best = min(best, time.perf_counter() - start)
+    return best / len(triplets)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare full and reduced-scale JPEG decoding.")
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--image_size", type=int, default=512)
+    parser.add_argument("--num_triplets", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    resize = transforms.Resize((args.image_size, args.image_size))
+    decode_size = frame_utils.get_decode_size(transforms.Compose([resize]))
+    rng = np.random.default_rng(0)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = []
+        for i in range(args.num_triplets + 2):
+            path = os.path.join(tmp_dir, 'frame_{:04d}.jpg'.format(i))
+            make_frame(path, args.height, args.width, rng)
+            paths.append(path)
+        triplets = [paths[i:i + 3] for i in range(args.num_triplets)]
+
+        full = time_triplets(triplets, resize, None, args.repeats)
+        draft = time_triplets(triplets, resize, decode_size, args.repeats)
+
+        full_images = load_triplet(triplets[0], resize, None)
+        draft_images = load_triplet(triplets[0], resize, decode_size)
+        mean_abs_diff = np.mean([np.abs(a.astype(np.float32) - b.astype(np.float32)).mean() for a, b in zip(full_images, draft_images)])
+
+        with Image.open(paths[0]) as image:
+            image.draft(image.mode, decode_size)
+            draft_shape = image.size
+
+    print('[i] source / target     : {}x{} -> {}x{} (decoded at {}x{})'.format(args.width, args.height, args.image_size, args.image_size, *draft_shape))
+    print('[i] full decode         : {:.2f} ms/triplet'.format(full * 1000))
+    print('[i] draft decode        : {:.2f} ms/triplet'.format(draft * 1000))
+    print('[i] speed-up            : {:.2f}x'.format(full / draft))
+    print('[i] mean abs difference : {:.2f} / 255'.format(mean_abs_diff))
+
+if __name__ == "__main__":
+    main()
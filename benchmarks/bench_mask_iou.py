@@ -0,0 +1,68 @@
+"""Microbenchmark: IoU against JPEG ground-truth masks, decoded every time vs. packed once.
+
+The baseline reproduces SerusoTestDataset.get_mask + Resize + compute_iou for every prediction;
+the packed path decodes each mask once (GT_Mask_Cache) and computes IoUs with popcounts.
+
+Run from the repository root:
+    python -m benchmarks.bench_mask_iou --height 1080 --width 1920 --image_size 512 --num_predictions 8
+"""
+import os
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+from PIL import Image
+from torchvision import transforms
+
+from general_utils.mask_cache import GT_Mask_Cache
+
+
+def baseline_iou(predicted, mask_path, resize):
+    ground_truth = np.array(resize(Image.open(mask_path).convert("L"))) / 255 > 0.5
+    union = np.sum(np.logical_or(predicted, ground_truth))
+    return 1.0 if union == 0 else float(np.sum(np.logical_and(predicted, ground_truth)) / union)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare decoded and packed ground-truth masks for IoU evaluation.")
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--image_size", type=int, default=512)
+    parser.add_argument("--num_masks", type=int, default=16)
+    parser.add_argument("--num_predictions", type=int, default=8, help="Predictions evaluated per mask (models x SAM variants).")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    resize = transforms.Resize((args.image_size, args.image_size))
+    y, x = np.mgrid[0:args.height, 0:args.width]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mask_paths = []
+        for i in range(args.num_masks):
+            cy, cx, r = rng.uniform(0, args.height), rng.uniform(0, args.width), rng.uniform(100, 400)
+            path = os.path.join(tmp_dir, 'mask_{:04d}.jpg'.format(i))
+            Image.fromarray((((y - cy) ** 2 + (x - cx) ** 2 < r ** 2) * 255).astype(np.uint8)).save(path)
+            mask_paths.append(path)
+
+        predictions = rng.random((args.num_predictions, args.image_size, args.image_size)) > 0.7
+
+        start = time.perf_counter()
+        baseline = [baseline_iou(predicted, path, resize) for path in mask_paths for predicted in predictions]
+        baseline_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        cache = GT_Mask_Cache()
+        load_fn = lambda path: resize(Image.open(path).convert("L"))
+        packed = [cache.get(path, load_fn).iou(predicted) for path in mask_paths for predicted in predictions]
+        packed_time = time.perf_counter() - start
+
+    num_ious = len(baseline)
+    print('[i] masks / predictions : {} x {} at {}x{}'.format(args.num_masks, args.num_predictions, args.image_size, args.image_size))
+    print('[i] decode every time   : {:.2f} ms/IoU'.format(baseline_time / num_ious * 1000))
+    print('[i] packed masks        : {:.2f} ms/IoU'.format(packed_time / num_ious * 1000))
+    print('[i] speed-up            : {:.2f}x'.format(baseline_time / packed_time))
+    print('[i] max IoU difference  : {:.2e}'.format(np.abs(np.asarray(baseline) - np.asarray(packed)).max()))
+
+if __name__ == "__main__":
+    main()
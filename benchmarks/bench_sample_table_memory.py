@@ -0,0 +1,86 @@
+"""Memory benchmark: Python path lists vs. Sample_Table views in forked DataLoader-like workers.
+
+Each forked worker walks over every sample once (as an epoch of a DataLoader worker does) and
+reports how much of the parent memory it had to copy (Private_Dirty growth, Linux only).
+
+Run from the repository root:
+    python -m benchmarks.bench_sample_table_memory --num_samples 500000 --num_workers 8 16
+"""
+import os
+import argparse
+import multiprocessing
+
+import numpy as np
+
+from general_utils.manifest_utils import Triplet_Manifest
+from general_utils.sample_table import Sample_Table
+
+
+def get_private_dirty_kb():
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            if line.startswith('Private_Dirty:'):
+                return int(line.split()[1])
+    return 0
+
+def make_manifest(num_samples, frames_per_scene):
+    num_scenes = (num_samples + frames_per_scene - 1) // frames_per_scene
+    sample_scene = np.arange(num_samples) // frames_per_scene
+    sample_frame = np.arange(num_samples) % frames_per_scene + 1
+
+    return Triplet_Manifest(['after', 'before'], [0, 0], np.arange(num_scenes) % 2, ['video_{:05d}'.format(i) for i in range(num_scenes)],
+                            np.zeros(num_scenes), np.zeros((num_scenes, 2)), ['frame'], sample_scene, np.zeros(num_samples), sample_frame)
+
+def make_lists(manifest, img_root, flow_root):
+    # the representation the datasets used before Sample_Table
+    image_list, flow_list, label_list = [], [], []
+    for class_name, scene_dir, prefix, frame_nb in manifest.samples():
+        image_list.append([os.path.join(img_root, class_name, scene_dir, '{}_{:04d}.jpg'.format(prefix, frame_nb + i)) for i in range(3)])
+        flow_list.append([os.path.join(flow_root, class_name, scene_dir, '{}_{:04d}.flo'.format(prefix, frame_nb + i)) for i in range(2)])
+        label_list.append(class_name)
+    return image_list, flow_list, label_list
+
+def walk(lists, queue):
+    image_list, flow_list, label_list = lists
+    before = get_private_dirty_kb()
+    for index in range(len(image_list)):
+        image_list[index][1], flow_list[index][0], label_list[index]
+    queue.put(get_private_dirty_kb() - before)
+
+def measure(lists, num_workers):
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    workers = [context.Process(target=walk, args=(lists, queue)) for _ in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    copied_kb = sum(queue.get() for _ in workers)
+    for worker in workers:
+        worker.join()
+    return copied_kb / 1024
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the memory copied by forked workers for both sample representations.")
+    parser.add_argument("--num_samples", type=int, default=500000)
+    parser.add_argument("--frames_per_scene", type=int, default=300)
+    parser.add_argument("--num_workers", type=int, nargs='+', default=[8, 16])
+    args = parser.parse_args()
+
+    img_root = '/datasets/SERUSO_DATASETS/main_dataset/Before_after_no_backgrounds/training'
+    flow_root = '/datasets/SERUSO_DATASETS/main_dataset/optical_flows/training'
+
+    manifest = make_manifest(args.num_samples, args.frames_per_scene)
+
+    table = Sample_Table(manifest, {'image' : img_root, 'flow' : flow_root})
+    views = (table.paths('image', 3, '.jpg'), table.paths('flow', 2, '.flo'), table.labels())
+    lists = make_lists(manifest, img_root, flow_root)
+
+    assert all(list(a[i]) == list(b[i]) for a, b in zip(lists[:2], views[:2]) for i in (0, len(a) // 2, len(a) - 1))
+
+    print('[i] samples: {:,}'.format(args.num_samples))
+    for num_workers in args.num_workers:
+        lists_mb = measure(lists, num_workers)
+        table_mb = measure(views, num_workers)
+        print('[i] {:>2} workers: python lists copied {:8.1f} MB, sample table copied {:6.1f} MB'.format(num_workers, lists_mb, table_mb))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Simulation: frame cache hit rate of the random sampler vs. the scene_chunk sampler.
+
+Batches are dealt to the DataLoader workers round-robin and every worker holds its own LRU cache
+of decoded frames, as CamFlowDataset does with frame_cache_mb > 0.
+
+Run from the repository root:
+    python -m benchmarks.bench_scene_sampler --num_scenes 200 --frames_per_scene 120 --cache_frames 256
+"""
+import argparse
+
+import numpy as np
+
+from collections import OrderedDict
+from torch.utils.data import RandomSampler
+
+from general_utils.sampler_utils import SceneChunkSampler
+
+
+def simulate(indices, scene_ids, frame_ids, batch_size, num_workers, cache_frames):
+    caches = [OrderedDict() for _ in range(num_workers)]
+    hits, misses = 0, 0
+
+    for position, index in enumerate(indices):
+        cache = caches[(position // batch_size) % num_workers]
+        for i in range(3):
+            key = (scene_ids[index], frame_ids[index] + i)
+            if key in cache:
+                cache.move_to_end(key)
+                hits += 1
+            else:
+                misses += 1
+                cache[key] = True
+                if len(cache) > cache_frames:
+                    cache.popitem(last=False)
+
+    return hits / (hits + misses)
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate the frame cache hit rate of the samplers.")
+    parser.add_argument("--num_scenes", type=int, default=200)
+    parser.add_argument("--frames_per_scene", type=int, default=120)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--cache_frames", type=int, default=256, help="Frames held by the cache of each worker.")
+    parser.add_argument("--chunk_sizes", type=int, nargs='+', default=[4, 8, 16])
+    args = parser.parse_args()
+
+    num_triplets = args.frames_per_scene - 2
+    scene_ids = np.repeat(np.arange(args.num_scenes), num_triplets)
+    frame_ids = np.tile(np.arange(num_triplets), args.num_scenes)
+
+    random_indices = list(RandomSampler(range(len(scene_ids))))
+    print('[i] random              : hit_rate={:.1%}'.format(simulate(random_indices, scene_ids, frame_ids, args.batch_size, args.num_workers, args.cache_frames)))
+
+    for chunk_size in args.chunk_sizes:
+        chunk_indices = list(SceneChunkSampler(scene_ids, chunk_size))
+        hit_rate = simulate(chunk_indices, scene_ids, frame_ids, args.batch_size, args.num_workers, args.cache_frames)
+        print('[i] scene_chunk ({:>3})   : hit_rate={:.1%}'.format(chunk_size, hit_rate))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Microbenchmark: float32 loader output (Normalize + Transpose per sample) vs. uint8 loader
+output normalised per batch with Batch_Normalize.
+
+Run from the repository root:
+    python -m benchmarks.bench_uint8_loader --image_size 512 --batch_size 16
+"""
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from PIL import Image
+from torch.utils.data import default_collate
+
+from general_utils.augment_utils import Normalize, Transpose, To_Uint8_Tensor, Batch_Normalize
+
+
+def float_pipeline(images):
+    normalize, transpose = Normalize(), Transpose()
+    return default_collate([torch.from_numpy(transpose(normalize(image))) for image in images])
+
+def uint8_pipeline(images, batch_normalize, device):
+    to_tensor = To_Uint8_Tensor()
+    batch = default_collate([to_tensor(image) for image in images])
+    return batch_normalize(batch.to(device))
+
+def time_pipeline(fn, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the float32 and uint8 image loader outputs.")
+    parser.add_argument("--image_size", type=int, default=512)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    batch_normalize = Batch_Normalize()
+
+    rng = np.random.default_rng(0)
+    images = [Image.fromarray(rng.integers(0, 256, (args.image_size, args.image_size, 3), dtype=np.uint8)) for _ in range(args.batch_size)]
+
+    reference = float_pipeline(images)
+    assert torch.equal(reference, uint8_pipeline(images, batch_normalize, device).cpu())
+
+    float_time = time_pipeline(lambda: float_pipeline(images).to(device), args.repeats)
+    uint8_time = time_pipeline(lambda: uint8_pipeline(images, batch_normalize, device), args.repeats)
+
+    print('[i] batch             : {}x3x{}x{} on {}'.format(args.batch_size, args.image_size, args.image_size, device))
+    print('[i] float32 loader    : {:.2f} ms/batch, {:.1f} MB/batch'.format(float_time * 1000, reference.nbytes / 2**20))
+    print('[i] uint8 loader      : {:.2f} ms/batch, {:.1f} MB/batch'.format(uint8_time * 1000, reference.nbytes / 4 / 2**20))
+    print('[i] speed-up          : {:.2f}x'.format(float_time / uint8_time))
+
+if __name__ == "__main__":
+    main()
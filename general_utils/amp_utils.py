@@ -0,0 +1,50 @@
+import torch
+
+# Mixed precision of the trainers, selected by the amp setting of the configuration:
+#
+#   False / 'fp32'   float32 everywhere (default)
+#   True / 'auto'    float16 autocast with a GradScaler on the GPU, bfloat16 autocast on the CPU
+#   'fp16' / 'bf16'  force the autocast dtype (bfloat16 needs no loss scaling)
+#
+# Only the model forwards run under autocast. Their outputs are cast back to float32, so that the
+# CAM normalisations (max reductions), the flow warping and the losses keep running in float32.
+
+AMP_DTYPES = {'fp16': torch.float16, 'float16': torch.float16, 'bf16': torch.bfloat16, 'bfloat16': torch.bfloat16}
+
+
+def get_device_type():
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+def get_amp_dtype(amp, device_type):
+    if amp in (None, False, 'fp32', 'float32'):
+        return None
+    if amp is True or amp == 'auto':
+        return torch.float16 if device_type == 'cuda' else torch.bfloat16
+    if amp in AMP_DTYPES:
+        return AMP_DTYPES[amp]
+    raise ValueError('amp must be False, True, auto, fp16 or bf16, got {!r}'.format(amp))
+
+
+class Mixed_Precision:
+    """autocast context and loss-scaled backward/optimizer step of a trainer (no-ops in float32)."""
+    def __init__(self, amp=False, device_type=None):
+        self.device_type = get_device_type() if device_type is None else device_type
+        self.dtype = get_amp_dtype(amp, self.device_type)
+        self.enabled = self.dtype is not None
+
+        # float16 gradients underflow without loss scaling, bfloat16 has the exponent range of float32
+        self.scaler = torch.amp.GradScaler(self.device_type, enabled=self.dtype == torch.float16)
+
+    def __str__(self):
+        if not self.enabled:
+            return 'float32'
+        return '{} autocast on {}{}'.format(str(self.dtype).replace('torch.', ''), self.device_type, ' with loss scaling' if self.scaler.is_enabled() else '')
+
+    def autocast(self):
+        return torch.autocast(self.device_type, dtype=self.dtype, enabled=self.enabled)
+
+    def step(self, loss, optimizer):
+        """loss.backward() then optimizer.step(), skipped by the GradScaler when the gradients overflow."""
+        self.scaler.scale(loss).backward()
+        self.scaler.step(optimizer)
+        self.scaler.update()
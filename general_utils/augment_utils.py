@@ -1,11 +1,13 @@
 import cv2
-import random
 import numpy as np
 import torchvision.transforms.functional as F
 import torch
+import torch.nn.functional as F_nn
 
 from PIL import Image
 
+from general_utils.rng_utils import get_rng
+
 def convert_OpenCV_to_PIL(image):
     return Image.fromarray(image[..., ::-1])
 
@@ -67,6 +69,122 @@ class Three_images_batch_trasform:
             
             
 
+class Three_images_batch_affine_transform:
+    """Per-sample flips and rotations of a whole triplet batch with a single affine_grid/grid_sample call.
+
+    params holds [B, 3] tensors 'hflip', 'vflip' (bool) and 'angle' (degrees, counter-clockwise), one
+    column per frame [left, centre, right] (or [B, T] for the T frames of a clip, the images only);
+    as in Three_images_trasform the flips are applied before the rotation. The flows given on the centre frame (towards the left and the right frame) are
+    resampled and their vectors rotated so that they stay consistent with the transformed frames,
+    and revert=True maps tensors (e.g. CAMs) back to the original geometry.
+    """
+    def __init__(self, params, image_size):
+        self.params = params
+        self.image_size = tuple(image_size)
+
+        self.forward_theta = self.get_theta(params['hflip'], params['vflip'], params['angle'], image_size)
+        self.inverse_theta = torch.linalg.inv(self.forward_theta)
+
+    @staticmethod
+    def sample_params(batch_size, max_degree=90, device='cpu', generator=None, num_frames=3):
+        hflip = torch.randint(0, 2, (batch_size, num_frames), generator=generator).bool()
+        vflip = torch.randint(0, 2, (batch_size, num_frames), generator=generator).bool()
+        angle = torch.randint(-max_degree, max_degree + 1, (batch_size, num_frames), generator=generator).float()
+        return {'hflip' : hflip.to(device), 'vflip' : vflip.to(device), 'angle' : angle.to(device)}
+
+    @staticmethod
+    def from_list_params(params):
+        # [horizontal_flips, vertical_flips, rotation_degrees] as collated from CamFlowDataset(augment=True)
+        return {
+            'hflip' : torch.stack([torch.as_tensor(p) for p in params[0]], dim=1).bool(),
+            'vflip' : torch.stack([torch.as_tensor(p) for p in params[1]], dim=1).bool(),
+            'angle' : torch.stack([torch.as_tensor(p) for p in params[2]], dim=1).float(),
+        }
+
+    @staticmethod
+    def get_theta(hflip, vflip, angle, image_size):
+        # forward map of the centred pixel coordinates, expressed in normalised [-1, 1] coordinates: [B, 3, 3, 3]
+        h, w = image_size
+        scale = torch.tensor([max(w - 1, 1) / 2., max(h - 1, 1) / 2.], device=angle.device)
+
+        radians = torch.deg2rad(angle.float())
+        cos, sin = torch.cos(radians), torch.sin(radians)
+        flip_x = 1. - 2. * hflip.float()
+        flip_y = 1. - 2. * vflip.float()
+
+        theta = torch.zeros(angle.shape + (3, 3), device=angle.device)
+        theta[..., 0, 0] = cos * flip_x
+        theta[..., 0, 1] = sin * flip_y * scale[1] / scale[0]
+        theta[..., 1, 0] = -sin * flip_x * scale[0] / scale[1]
+        theta[..., 1, 1] = cos * flip_y
+        theta[..., 2, 2] = 1.
+        return theta
+
+    def resample(self, x, theta, fill=None):
+        # x: [B, 3, C, H, W], theta: [B, 3, 3, 3] mapping output to input coordinates
+        b, t, c, h, w = x.size()
+        x = x.reshape(b * t, c, h, w)
+
+        grid = F_nn.affine_grid(theta[..., :2, :].reshape(b * t, 2, 3).to(x.dtype), (b * t, c, h, w), align_corners=True)
+
+        if fill is None:
+            x = F_nn.grid_sample(x, grid, mode='bilinear', padding_mode='zeros', align_corners=True)
+        else:
+            fill = torch.as_tensor(fill, dtype=x.dtype, device=x.device).view(1, -1, 1, 1)
+            x = F_nn.grid_sample(x - fill, grid, mode='bilinear', padding_mode='zeros', align_corners=True) + fill
+
+        return x.view(b, t, c, h, w)
+
+    def __call__(self, images, revert=False, fill=None):
+        """images: [B, 3, C, H, W] tensor or list of three [B, C, H, W] tensors; fill is the per-channel
+        value of the uncovered corners (the normalised black for normalised images)."""
+        is_list = isinstance(images, (list, tuple))
+        if is_list:
+            images = torch.stack(list(images), dim=1)
+
+        theta = self.forward_theta if revert else self.inverse_theta
+        images = self.resample(images, theta.to(images.device), fill)
+
+        if is_list:
+            return tuple(torch.unbind(images, dim=1))
+        return images
+
+    def transform_flows(self, flows):
+        """flows: [B, 2, 2, h, w] tensor or list [flows_left, flows_right] of [B, 2, h, w] flows in pixels of
+        the flow resolution, defined on the centre frame and pointing to the left and right frames."""
+        is_list = isinstance(flows, (list, tuple))
+        if is_list:
+            flows = torch.stack(list(flows), dim=1)
+
+        b, _, _, h, w = flows.size()
+        forward_theta = self.forward_theta.to(flows.device, flows.dtype)
+        inverse_theta = self.inverse_theta.to(flows.device, flows.dtype)
+        scale = torch.tensor([max(w - 1, 1) / 2., max(h - 1, 1) / 2.], dtype=flows.dtype, device=flows.device).view(1, 1, 2, 1, 1)
+
+        # positions in the original centre frame of every output pixel
+        centre_inverse = inverse_theta[:, 1:2].expand(b, 2, 3, 3)
+        identity = torch.eye(3, dtype=flows.dtype, device=flows.device)[:2].expand(b * 2, 2, 3)
+
+        out_grid = F_nn.affine_grid(identity, (b * 2, 2, h, w), align_corners=True).view(b, 2, h, w, 2).permute(0, 1, 4, 2, 3)
+        src_grid = F_nn.affine_grid(centre_inverse[..., :2, :].reshape(b * 2, 2, 3), (b * 2, 2, h, w), align_corners=True)
+
+        sampled = F_nn.grid_sample(flows.reshape(b * 2, 2, h, w), src_grid, mode='bilinear', padding_mode='zeros', align_corners=True)
+        sampled = sampled.view(b, 2, 2, h, w)
+        src_grid = src_grid.view(b, 2, h, w, 2).permute(0, 1, 4, 2, 3)
+
+        # matched positions in the original side frames, moved into the transformed side frames
+        target = src_grid + sampled / scale
+        side_forward = forward_theta[:, [0, 2], :2, :2]
+        target = torch.einsum('btij,btjhw->btihw', side_forward, target)
+
+        inside = (src_grid.abs() <= 1.).all(dim=2, keepdim=True)
+        flows = (target - out_grid) * scale * inside
+
+        if is_list:
+            return tuple(torch.unbind(flows, dim=1))
+        return flows
+
+
 class RandomResize:
     def __init__(self, min_image_size, max_image_size):
         self.min_image_size = min_image_size
@@ -75,7 +193,7 @@ class RandomResize:
         self.modes = [Image.BICUBIC, Image.NEAREST]
     
     def __call__(self, image, mode=Image.BICUBIC):
-        rand_image_size = random.randint(self.min_image_size, self.max_image_size)
+        rand_image_size = int(get_rng().integers(self.min_image_size, self.max_image_size + 1))
         
         w, h = image.size
         if w < h:
@@ -100,7 +218,7 @@ class RandomResize_For_Segmentation:
     def __call__(self, data):
         image, mask = data['image'], data['mask']
 
-        rand_image_size = random.randint(self.min_image_size, self.max_image_size)
+        rand_image_size = int(get_rng().integers(self.min_image_size, self.max_image_size + 1))
         
         w, h = image.size
         if w < h:
@@ -122,7 +240,7 @@ class RandomHorizontalFlip:
         pass
 
     def __call__(self, image):
-        if bool(random.getrandbits(1)):
+        if bool(get_rng().integers(2)):
             return image.transpose(Image.FLIP_LEFT_RIGHT)
         return image
 
@@ -133,7 +251,7 @@ class RandomHorizontalFlip_For_Segmentation:
     def __call__(self, data):
         image, mask = data['image'], data['mask']
 
-        if bool(random.getrandbits(1)):
+        if bool(get_rng().integers(2)):
             data['image'] = image.transpose(Image.FLIP_LEFT_RIGHT)
             data['mask'] = mask.transpose(Image.FLIP_LEFT_RIGHT)
 
@@ -154,6 +272,41 @@ class Normalize:
         
         return norm_image
     
+class To_Uint8_Tensor:
+    """PIL image -> uint8 CHW tensor, for loaders that defer normalisation to Batch_Normalize."""
+    def __init__(self):
+        pass
+
+    def __call__(self, image):
+        return torch.from_numpy(np.array(image, dtype=np.uint8)).permute(2, 0, 1)
+
+class Batch_Normalize:
+    """Normalisation of a collated uint8 [..., 3, H, W] batch, bit-identical to Normalize.
+
+    Scale, mean and std are folded into a 3x256 float32 lookup table computed with Normalize
+    itself, so the whole step is a single gather on the device the batch lives on.
+    """
+    def __init__(self, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225), channels_last=False):
+        self.channels_last = channels_last
+
+        values = np.repeat(np.arange(256, dtype=np.uint8).reshape(1, 256, 1), 3, axis=2)
+        lut = Normalize(mean, std)(values)[0].T
+
+        self.lut = torch.from_numpy(np.ascontiguousarray(lut)).view(-1)
+        self.offsets = (torch.arange(3) * 256).view(3, 1, 1)
+
+    def __call__(self, images):
+        if self.lut.device != images.device:
+            self.lut = self.lut.to(images.device)
+            self.offsets = self.offsets.to(images.device)
+
+        norm_images = self.lut[images.long() + self.offsets]
+
+        if self.channels_last and norm_images.dim() == 4:
+            norm_images = norm_images.contiguous(memory_format=torch.channels_last)
+
+        return norm_images
+    
 class Denormalize:
     def __init__(self, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
         self.mean = mean
@@ -253,16 +406,16 @@ class RandomCrop:
 
         if w_space > 0:
             cont_left = 0
-            img_left = random.randrange(w_space + 1)
+            img_left = int(get_rng().integers(w_space + 1))
         else:
-            cont_left = random.randrange(-w_space + 1)
+            cont_left = int(get_rng().integers(-w_space + 1))
             img_left = 0
 
         if h_space > 0:
             cont_top = 0
-            img_top = random.randrange(h_space + 1)
+            img_top = int(get_rng().integers(h_space + 1))
         else:
-            cont_top = random.randrange(-h_space + 1)
+            cont_top = int(get_rng().integers(-h_space + 1))
             img_top = 0
 
         dst_bbox = {
@@ -48,9 +48,21 @@ def get_cam_of_scale(ori_image, scale, model_for_cam):
 
     return cams
 
-def generate_cams(ori_image, cam_model, scales, normalize = True):
-    
-    ori_w, ori_h = ori_image.shape[0], ori_image.shape[1]
+def generate_cams(ori_image, cam_model, scales, normalize = True, roi = None):
+
+    if roi is not None:
+        # only the (x0, y0, x1, y1) region goes through the model, its CAMs are pasted back into empty maps
+        x0, y0, x1, y1 = roi
+        ori_h, ori_w = ori_image.shape[:2]
+
+        hr = generate_cams(ori_image[y0:y1, x0:x1], cam_model, scales, normalize = False)
+        hr = [F.pad(hr_cams, (x0, ori_w - x1, y0, ori_h - y1)) for hr_cams in hr]
+
+        if normalize:
+            hr = [hr_cams / (hr_cams.max() + 1e-5) for hr_cams in hr]
+        return hr
+
+    ori_h, ori_w = ori_image.shape[0], ori_image.shape[1]
 
     strided_size = get_strided_size((ori_h, ori_w), 4)
     strided_up_size = get_strided_up_size((ori_h, ori_w), 16)
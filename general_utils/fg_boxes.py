@@ -0,0 +1,140 @@
+import os
+import math
+import argparse
+
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+from general_utils import frame_utils
+
+# The frames of the "no_backgrounds" datasets are black outside of the objects. The foreground box of
+# every frame (pixels brighter than a threshold, found on a reduced JPEG decode) is computed once and
+# stored with the union of the boxes of every triplet, in one sidecar index per split:
+#
+#   <fg_box_dir>/<split>.npz   sorted frame_paths, frame_boxes (n, 4), sorted triplet_paths (central
+#                              frames), triplet_boxes (m, 4)
+#
+# Boxes are (x0, y0, x1, y1) float32 fractions of the frame width and height (x1, y1 exclusive), so they
+# apply at any resolution (draft decodes, frame store, flow pyramid). Frames without foreground, and
+# frames missing from the index, get the full box.
+
+FULL_BOX = (0., 0., 1., 1.)
+
+
+def get_index_path(fg_box_dir, split):
+    return os.path.join(fg_box_dir, '{}.npz'.format(split))
+
+def get_foreground_box(image, threshold=16):
+    """Box of the pixels of an (h, w, 3) image whose brightest channel exceeds threshold."""
+    mask = np.asarray(image).max(axis=-1) > threshold
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if rows.size == 0:
+        return FULL_BOX
+
+    h, w = mask.shape
+    return (float(cols[0] / w), float(rows[0] / h), float((cols[-1] + 1) / w), float((rows[-1] + 1) / h))
+
+def union_boxes(boxes):
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    return tuple(boxes[:, :2].min(axis=0).tolist() + boxes[:, 2:].max(axis=0).tolist())
+
+def pad_box(box, padding=0.1, min_size=0.125):
+    """Grows a box by padding times its size on every side (and to at least min_size of the frame), clipped to the frame."""
+    x0, y0, x1, y1 = box
+    cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+    half_w = max((x1 - x0) * (0.5 + padding), min_size / 2)
+    half_h = max((y1 - y0) * (0.5 + padding), min_size / 2)
+    return (max(cx - half_w, 0.), max(cy - half_h, 0.), min(cx + half_w, 1.), min(cy + half_h, 1.))
+
+def to_pixels(box, size):
+    """(x0, y0, x1, y1) integer box covering box in a frame of size=(w, h)."""
+    w, h = size
+    x0, y0 = min(int(math.floor(box[0] * w)), w - 1), min(int(math.floor(box[1] * h)), h - 1)
+    x1, y1 = max(int(math.ceil(box[2] * w)), x0 + 1), max(int(math.ceil(box[3] * h)), y0 + 1)
+    return (x0, y0, min(x1, w), min(y1, h))
+
+def build_fg_box_index(dataset, index_path, decode_size=(256, 256), threshold=16, num_workers=8, print_fn=print):
+    """Writes the foreground boxes of the frames and triplets of a CamFlowDataset to index_path."""
+    frame_paths = np.unique(np.asarray([path for paths in dataset.image_list for path in paths], dtype=str))
+
+    def get_box(path):
+        image = frame_utils.draft_image(frame_utils.read_gen(str(path)), decode_size).convert('RGB')
+        return get_foreground_box(image, threshold)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        frame_boxes = np.asarray(list(executor.map(get_box, frame_paths)), dtype=np.float32).reshape(-1, 4)
+
+    rows = {path: row for row, path in enumerate(frame_paths.tolist())}
+    triplets = sorted((paths[1], union_boxes(frame_boxes[[rows[path] for path in paths]])) for paths in dataset.image_list)
+    triplet_paths = np.asarray([path for path, _ in triplets], dtype=str)
+    triplet_boxes = np.asarray([box for _, box in triplets], dtype=np.float32).reshape(-1, 4)
+
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, frame_paths=frame_paths, frame_boxes=frame_boxes, triplet_paths=triplet_paths, triplet_boxes=triplet_boxes)
+    os.replace(tmp_path, index_path)
+
+    if print_fn is not None:
+        area = lambda boxes: float(np.mean((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]))) if len(boxes) else 0.
+        print_fn('[i] {}: {:,} frames (mean box area {:.1%}), {:,} triplets (mean union area {:.1%})'.format(
+            index_path, len(frame_paths), area(frame_boxes), len(triplet_paths), area(triplet_boxes)))
+
+
+class Fg_Box_Index:
+    """Foreground boxes of a split written by build_fg_box_index, looked up by frame path."""
+    def __init__(self, index_path):
+        self.index_path = index_path
+
+        with np.load(index_path) as index:
+            self.frame_paths = index['frame_paths']
+            self.frame_boxes = index['frame_boxes']
+            self.triplet_paths = index['triplet_paths']
+            self.triplet_boxes = index['triplet_boxes']
+
+    @staticmethod
+    def lookup(paths, boxes, path):
+        row = np.searchsorted(paths, path)
+        if row >= len(paths) or paths[row] != path:
+            return FULL_BOX
+        return tuple(boxes[row].tolist())
+
+    def frame_box(self, path):
+        return self.lookup(self.frame_paths, self.frame_boxes, path)
+
+    def triplet_box(self, central_path):
+        """Union of the boxes of the triplet centred on central_path."""
+        return self.lookup(self.triplet_paths, self.triplet_boxes, central_path)
+
+    def union(self, paths):
+        return union_boxes([self.frame_box(path) for path in paths])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write the foreground boxes of the frames and triplets of the dataset splits.")
+    parser.add_argument("--config", type=str, required=True, help="YAML configuration (dataset_dir, flow_dir, fg_box_dir).")
+    parser.add_argument("--splits", type=str, nargs='+', default=['training', 'validation'], help="Splits of dataset_dir; 'test' reads dataset_dir as a test set.")
+    parser.add_argument("--decode_size", type=int, default=256, help="Frames are decoded at the smallest JPEG scale covering this size.")
+    parser.add_argument("--threshold", type=int, default=16, help="Pixels whose brightest channel exceeds threshold are foreground.")
+    parser.add_argument("--num_workers", type=int, default=8, help="Number of frames decoded in parallel.")
+    args = parser.parse_args()
+
+    import yaml
+    import seruso_datasets
+
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+
+    for split in args.splits:
+        classes_subfolders = config.get('classes_subfolders', ['before', 'after'])
+        if split == 'test':
+            dataset = seruso_datasets.SerusoTestDataset(img_root = config['dataset_dir'], classes_subfolders = classes_subfolders, manifest_dir = config.get('manifest_dir', None))
+        else:
+            dataset = seruso_datasets.Seruso_three_classes_flow(img_root = config['dataset_dir'], flow_root = config.get('flow_dir', config['dataset_dir']), classes_subfolders = classes_subfolders,
+                                                                dstype = split, manifest_dir = config.get('manifest_dir', None))
+        build_fg_box_index(dataset, get_index_path(config['fg_box_dir'], split), (args.decode_size, args.decode_size), args.threshold, args.num_workers)
+
+if __name__ == "__main__":
+    main()
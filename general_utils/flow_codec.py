@@ -0,0 +1,83 @@
+import os
+import argparse
+
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+from general_utils import frame_utils
+
+# Converts the float32 .flo files of an optical_flows tree into compact .flo files (float16, or int16
+# with a per-file scale, see frame_utils.encode_flow_compact) in a mirror tree, and reports the
+# endpoint error (EPE, Euclidean distance between the original and the decoded vector) introduced.
+# The readers detect compact files by their tag, so flow_dir can simply point to the new tree.
+
+
+def find_flow_files(flow_root):
+    flow_paths = []
+    for dir_path, _, file_names in os.walk(flow_root):
+        flow_paths += [os.path.join(dir_path, name) for name in file_names if name.endswith('.flo')]
+    return sorted(flow_paths)
+
+def compact_flow_file(src_path, dst_path, codec):
+    """Writes the compact version of src_path to dst_path, returns the statistics of the conversion."""
+    flow = np.asarray(frame_utils.read_flow_mmap(src_path), dtype=np.float32)
+    buffer = frame_utils.encode_flow_compact(flow, codec)
+
+    tmp_path = dst_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(buffer)
+    os.replace(tmp_path, dst_path)
+
+    epe = np.sqrt(((frame_utils.decode_flow_compact(buffer) - flow) ** 2).sum(axis=-1))
+
+    return {
+        'pixels' : epe.size,
+        'epe_sum' : float(epe.sum(dtype=np.float64)),
+        'epe_max' : float(epe.max()) if epe.size else 0.,
+        'src_bytes' : os.path.getsize(src_path),
+        'dst_bytes' : len(buffer),
+    }
+
+def convert_flow_tree(flow_root, out_root, codec='int16', num_workers=8, print_fn=print):
+    """Writes the compact version of every .flo file of flow_root at the same relative path in out_root."""
+    if os.path.abspath(out_root) == os.path.abspath(flow_root):
+        raise ValueError('The conversion is lossy, out_root must differ from flow_root')
+
+    def convert(src_path):
+        dst_path = os.path.join(out_root, os.path.relpath(src_path, flow_root))
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        return compact_flow_file(src_path, dst_path, codec)
+
+    flow_paths = find_flow_files(flow_root)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        stats = list(executor.map(convert, flow_paths))
+
+    report = {
+        'files' : len(stats),
+        'src_mb' : sum(s['src_bytes'] for s in stats) / 1024**2,
+        'dst_mb' : sum(s['dst_bytes'] for s in stats) / 1024**2,
+        'epe_max' : max([s['epe_max'] for s in stats], default=0.),
+        'epe_mean' : sum(s['epe_sum'] for s in stats) / max(sum(s['pixels'] for s in stats), 1),
+    }
+
+    if print_fn is not None:
+        print_fn('[i] converted {:,} flows to {} in {}'.format(report['files'], codec, out_root))
+        print_fn('[i] size: {:.1f} MB -> {:.1f} MB'.format(report['src_mb'], report['dst_mb']))
+        print_fn('[i] endpoint error: max={:.5f} px, mean={:.6f} px'.format(report['epe_max'], report['epe_mean']))
+
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the .flo files of an optical_flows tree to a compact codec and report the endpoint error.")
+    parser.add_argument("--flow_root", type=str, required=True, help="Root of the optical_flows tree.")
+    parser.add_argument("--out_root", type=str, required=True, help="Root of the converted tree (same relative paths).")
+    parser.add_argument("--codec", type=str, default='int16', choices=sorted(frame_utils.COMPACT_FLOW_TAGS), help="int16 (fixed-point, per-file scale) or float16.")
+    parser.add_argument("--num_workers", type=int, default=8, help="Number of files converted in parallel.")
+    args = parser.parse_args()
+
+    convert_flow_tree(args.flow_root, args.out_root, args.codec, args.num_workers)
+
+if __name__ == "__main__":
+    main()
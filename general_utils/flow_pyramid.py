@@ -0,0 +1,118 @@
+import os
+import math
+import argparse
+
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+from general_utils.frame_store import resize_flow
+
+# A flow pyramid holds every flow of a split already resized to the CAM resolutions of the backbones,
+# i.e. image_size / stride for each stride (rounded up, as the strided convolutions do):
+#
+#   flows_{w}x{h}.npy  float32 (num_flows, h, w, 2)  one array per level, vectors in pixels of the level
+#   index.npz          sorted flow_paths (row i of every level is flow_paths[i]), image_size and sizes
+#
+# Levels are computed from the original flows with the same bilinear resize as resize_flows_batch, so
+# a trainer reading the level of its feature maps gets the flows it would have computed itself.
+
+PYRAMID_STRIDES = (8, 16, 32)
+INDEX_NAME = 'index.npz'
+
+
+def get_level_size(image_size, stride):
+    """(w, h) of the feature maps of a backbone with the given output stride, for square inputs."""
+    side = math.ceil(image_size / stride)
+    return (side, side)
+
+def get_level_name(size):
+    return 'flows_{}x{}.npy'.format(*size)
+
+def build_flow_pyramid(dataset, out_dir, image_size, strides=PYRAMID_STRIDES, num_workers=8, print_fn=print):
+    """Writes the flows of every sample of a CamFlowDataset at image_size / stride for every stride."""
+    os.makedirs(out_dir, exist_ok=True)
+
+    flow_paths = np.unique(np.asarray([path for paths in dataset.flow_list for path in paths], dtype=str))
+    sizes = sorted(set(get_level_size(image_size, stride) for stride in strides), reverse=True)
+
+    levels = [np.lib.format.open_memmap(os.path.join(out_dir, get_level_name(size) + '.tmp'), mode='w+', dtype=np.float32, shape=(len(flow_paths), size[1], size[0], 2))
+              for size in sizes]
+
+    def write_flow(i):
+        flow = dataset.read_flow(str(flow_paths[i]))
+        for size, level in zip(sizes, levels):
+            level[i] = resize_flow(flow, size)
+        return flow.nbytes
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        source_bytes = sum(executor.map(write_flow, range(len(flow_paths))))
+
+    for level in levels:
+        level.flush()
+    del levels
+
+    for size in sizes:
+        os.replace(os.path.join(out_dir, get_level_name(size) + '.tmp'), os.path.join(out_dir, get_level_name(size)))
+
+    np.savez(os.path.join(out_dir, INDEX_NAME), flow_paths=flow_paths, image_size=np.asarray(image_size), sizes=np.asarray(sizes))
+
+    if print_fn is not None:
+        print_fn('[i] stored {:,} flows in {} ({:.1f} MB read)'.format(len(flow_paths), out_dir, source_bytes / 1024**2))
+        for size in sizes:
+            print_fn('[i]   {}x{}: {:.1f} MB'.format(size[0], size[1], len(flow_paths) * size[0] * size[1] * 8 / 1024**2))
+
+
+class Flow_Pyramid:
+    """Reads the flows of one level of a pyramid written by build_flow_pyramid, by their original path."""
+    def __init__(self, pyramid_dir, size):
+        self.pyramid_dir = pyramid_dir
+        self.size = tuple(size)
+
+        with np.load(os.path.join(pyramid_dir, INDEX_NAME)) as index:
+            self.flow_paths = index['flow_paths']
+            self.image_size = int(index['image_size'])
+            sizes = [tuple(size) for size in index['sizes'].tolist()]
+
+        if self.size not in sizes:
+            raise ValueError('Flow pyramid {} has no {}x{} level (levels: {})'.format(pyramid_dir, *self.size, ', '.join('{}x{}'.format(*s) for s in sizes)))
+
+        self.flows = None
+
+    def flow(self, flow_path):
+        """(h, w, 2) float32 read-only view of a flow at the level size."""
+        if self.flows is None:
+            self.flows = np.load(os.path.join(self.pyramid_dir, get_level_name(self.size)), mmap_mode='r')
+
+        row = np.searchsorted(self.flow_paths, flow_path)
+        if row >= len(self.flow_paths) or self.flow_paths[row] != flow_path:
+            raise KeyError('{} is not in the flow pyramid {}'.format(flow_path, self.pyramid_dir))
+        return self.flows[row]
+
+    def __getstate__(self):
+        # every DataLoader worker maps the level itself
+        state = self.__dict__.copy()
+        state['flows'] = None
+        return state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write the flows of the training and validation sets at the CAM resolutions of the backbones.")
+    parser.add_argument("--config", type=str, required=True, help="Training YAML configuration (dataset_dir, flow_dir, image_size, flow_pyramid_dir).")
+    parser.add_argument("--strides", type=int, nargs='+', default=list(PYRAMID_STRIDES), help="Output strides of the levels.")
+    parser.add_argument("--num_workers", type=int, default=8, help="Number of flows read in parallel.")
+    args = parser.parse_args()
+
+    import yaml
+    import seruso_datasets
+
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+
+    for dstype in ['training', 'validation']:
+        dataset = seruso_datasets.Seruso_three_classes_flow(img_root = config['dataset_dir'], flow_root = config['flow_dir'], dstype = dstype,
+                                                            flow_format = config.get('flow_format', 'mmap'), manifest_dir = config.get('manifest_dir', None))
+        build_flow_pyramid(dataset, os.path.join(config['flow_pyramid_dir'], dstype), config['image_size'], args.strides, args.num_workers)
+
+if __name__ == "__main__":
+    main()
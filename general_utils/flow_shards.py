@@ -0,0 +1,149 @@
+import os
+import json
+import argparse
+import struct
+
+import numpy as np
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from general_utils import frame_utils
+
+# A shard packs every flow of one scene (e.g. training/before/video_000/*.flo) into a single file:
+#
+#   +----------+------------+-------------------+---------+-----------------------------+
+#   | FLOSHRD1 | index size | JSON offset index | padding | float32 (h, w, 2) payloads  |
+#   +----------+------------+-------------------+---------+-----------------------------+
+#
+# The index maps each original file name to [offset, h, w], with offsets relative to the payload
+# start. The shard of a scene lives next to where its directory would be: video_000.flowshard.
+
+SHARD_MAGIC = b'FLOSHRD1'
+SHARD_EXT = '.flowshard'
+SHARD_ALIGN = 64
+
+
+def get_shard_path(flow_path):
+    return os.path.dirname(flow_path) + SHARD_EXT
+
+def pack_scene(scene_dir, shard_path):
+    names = sorted(name for name in os.listdir(scene_dir) if os.path.splitext(name)[-1] in ['.flo', '.pfm'])
+
+    flows = []
+    index = {}
+    offset = 0
+
+    for name in names:
+        flow = frame_utils.read_flow_mmap(os.path.join(scene_dir, name))
+        h, w = flow.shape[:2]
+        flows.append(flow)
+        index[name] = [offset, h, w]
+        offset += h * w * 2 * 4
+
+    index_bytes = json.dumps(index).encode('utf-8')
+    header_size = len(SHARD_MAGIC) + 8 + len(index_bytes)
+    padding = (-header_size) % SHARD_ALIGN
+
+    tmp_path = shard_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(SHARD_MAGIC)
+        f.write(struct.pack('<Q', len(index_bytes)))
+        f.write(index_bytes)
+        f.write(b'\0' * padding)
+        for flow in flows:
+            f.write(np.ascontiguousarray(flow, dtype='<f4').tobytes())
+    os.replace(tmp_path, shard_path)
+
+    return len(names)
+
+def find_scene_dirs(flow_root):
+    scene_dirs = []
+    for dir_path, _, file_names in os.walk(flow_root):
+        if any(name.endswith('.flo') or name.endswith('.pfm') for name in file_names):
+            scene_dirs.append(dir_path)
+    return sorted(scene_dirs)
+
+def convert_flow_tree(flow_root, out_root=None, num_workers=8, print_fn=print):
+    """Packs every scene directory of an optical_flows tree into one shard per scene.
+
+    With out_root=None the shards are written next to the scene directories of flow_root.
+    """
+    if out_root is None:
+        out_root = flow_root
+
+    def convert(scene_dir):
+        shard_path = os.path.join(out_root, os.path.relpath(scene_dir, flow_root)) + SHARD_EXT
+        os.makedirs(os.path.dirname(shard_path), exist_ok=True)
+        return pack_scene(scene_dir, shard_path)
+
+    scene_dirs = find_scene_dirs(flow_root)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        num_flows = sum(executor.map(convert, scene_dirs))
+
+    if print_fn is not None:
+        print_fn('[i] packed {:,} flows from {:,} scenes into {}'.format(num_flows, len(scene_dirs), out_root))
+
+    return num_flows
+
+
+class FlowShardReader:
+    """Reads flows out of per-scene shards with one memory-mapped slice per flow.
+
+    Each shard is opened once (per process) and kept mapped in a small LRU, so reading a flow
+    costs no open() call. Flow paths are the ones the datasets already build, e.g.
+    <flow_root>/training/before/video_000/frame_0001.flo, which resolves to the entry
+    frame_0001.flo of <flow_root>/training/before/video_000.flowshard.
+    """
+    def __init__(self, max_open_shards=64):
+        self.max_open_shards = max_open_shards
+        self.shards = OrderedDict()
+
+    def open_shard(self, shard_path):
+        with open(shard_path, 'rb') as f:
+            if f.read(len(SHARD_MAGIC)) != SHARD_MAGIC:
+                raise ValueError('Invalid flow shard: {}'.format(shard_path))
+            index_size, = struct.unpack('<Q', f.read(8))
+            index = json.loads(f.read(index_size).decode('utf-8'))
+
+        header_size = len(SHARD_MAGIC) + 8 + index_size
+        payload_offset = header_size + (-header_size) % SHARD_ALIGN
+        payload = np.memmap(shard_path, dtype='<f4', mode='r', offset=payload_offset)
+
+        return index, payload
+
+    def get_shard(self, shard_path):
+        if shard_path in self.shards:
+            self.shards.move_to_end(shard_path)
+        else:
+            self.shards[shard_path] = self.open_shard(shard_path)
+            if len(self.shards) > self.max_open_shards:
+                self.shards.popitem(last=False)
+        return self.shards[shard_path]
+
+    def read(self, flow_path):
+        index, payload = self.get_shard(get_shard_path(flow_path))
+
+        offset, h, w = index[os.path.basename(flow_path)]
+        start = offset // 4
+
+        return payload[start:start + h * w * 2].reshape(h, w, 2)
+
+    def __getstate__(self):
+        # memory maps are not shared with DataLoader workers; each worker maps its own shards
+        state = self.__dict__.copy()
+        state['shards'] = OrderedDict()
+        return state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack per-frame .flo files into one shard per scene.")
+    parser.add_argument("--flow_root", type=str, required=True, help="Root of the optical_flows tree.")
+    parser.add_argument("--out_root", type=str, default=None, help="Where to write the shards (default: next to the scenes).")
+    parser.add_argument("--num_workers", type=int, default=8, help="Number of scenes packed in parallel.")
+    args = parser.parse_args()
+
+    convert_flow_tree(args.flow_root, args.out_root, args.num_workers)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import torch
+
+from collections import OrderedDict
+
+MAX_WORKERS = 64
+
+
+def get_worker_slot():
+    # slot 0 is the main process, slot i+1 is DataLoader worker i
+    worker_info = torch.utils.data.get_worker_info()
+    if worker_info is None:
+        return 0
+    return min(worker_info.id + 1, MAX_WORKERS)
+
+def get_image_nbytes(image):
+    if hasattr(image, 'nbytes'):
+        return image.nbytes
+    w, h = image.size
+    return w * h * len(image.getbands())
+
+
+class Cache_Counters:
+    """Hit/miss counters per DataLoader worker, in shared memory so that the main process can read them."""
+    def __init__(self):
+        # [slot, (hits, misses)]
+        self.counters = torch.zeros((MAX_WORKERS + 1, 2), dtype=torch.int64).share_memory_()
+
+    def count(self, hit):
+        self.counters.numpy()[get_worker_slot(), 0 if hit else 1] += 1
+
+    def stats(self):
+        stats = []
+        for slot, (hits, misses) in enumerate(self.counters.tolist()):
+            if hits + misses > 0:
+                stats.append({
+                    'worker' : slot - 1,
+                    'hits' : hits,
+                    'misses' : misses,
+                    'hit_rate' : hits / (hits + misses),
+                })
+        return stats
+
+    def reset_stats(self):
+        self.counters.zero_()
+
+
+class LRU_Frame_Cache(Cache_Counters):
+    """Bounded LRU cache of decoded frames, keyed by path.
+
+    Every DataLoader worker holds its own copy of the cache (max_bytes is a per-worker budget),
+    while the hit/miss counters live in shared memory so that the main process can read them.
+    Cached images are shared between samples and must not be modified in place; the PIL and
+    torchvision transforms used by the datasets always return new images.
+    """
+    def __init__(self, max_bytes):
+        super(LRU_Frame_Cache, self).__init__()
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.frames = OrderedDict()
+
+    def get(self, key, load_fn):
+        if key in self.frames:
+            self.frames.move_to_end(key)
+            self.count(hit=True)
+            return self.frames[key][0]
+
+        self.count(hit=False)
+
+        frame = load_fn(key)
+        nbytes = get_image_nbytes(frame)
+
+        if nbytes <= self.max_bytes:
+            self.frames[key] = (frame, nbytes)
+            self.current_bytes += nbytes
+
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self.frames.popitem(last=False)
+                self.current_bytes -= evicted_nbytes
+
+        return frame
+
+    def clear(self):
+        self.frames = OrderedDict()
+        self.current_bytes = 0
+
+    def __getstate__(self):
+        # workers started with the spawn method begin with an empty cache
+        state = self.__dict__.copy()
+        state['frames'] = OrderedDict()
+        state['current_bytes'] = 0
+        return state
+
+
+def format_cache_stats(stats):
+    hits = sum(s['hits'] for s in stats)
+    misses = sum(s['misses'] for s in stats)
+    if hits + misses == 0:
+        return 'frame cache: unused'
+
+    per_worker = ', '.join('w{}={:.1%}'.format(s['worker'], s['hit_rate']) for s in stats)
+    return 'frame cache: hit_rate={:.1%} ({:,} hits, {:,} misses) [{}]'.format(hits / (hits + misses), hits, misses, per_worker)
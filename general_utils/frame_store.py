@@ -0,0 +1,148 @@
+import os
+import argparse
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from torchvision import transforms
+from concurrent.futures import ThreadPoolExecutor
+
+from general_utils import frame_utils
+
+# A frame store holds every frame and flow of a split already resized to the training resolution:
+#
+#   frames.npy   uint8   (num_frames, h, w, 3)  frames resized with transforms.Resize((h, w))
+#   flows.npy    float32 (num_flows, h, w, 2)   flows resized bilinearly, vectors rescaled to (w, h)
+#   index.npz    sorted frame_paths / flow_paths (row i of frames.npy is frame_paths[i]), size and
+#                draft_decode (JPEGs decoded at a reduced DCT scale first, as with draft_decode: True)
+#
+# Both arrays are memory-mapped when reading, so a frame is a slice of the page cache, not a decode.
+
+FRAMES_NAME = 'frames.npy'
+FLOWS_NAME = 'flows.npy'
+INDEX_NAME = 'index.npz'
+
+
+def resize_flow(flow, size):
+    """(H, W, 2) flow -> (h, w, 2) flow at size=(w, h), with the vectors expressed in the new pixels."""
+    h, w = size[1], size[0]
+    flow = torch.from_numpy(np.array(flow, dtype=np.float32)).permute(2, 0, 1).unsqueeze(0)
+    factor_y, factor_x = flow.shape[-2] / h, flow.shape[-1] / w
+
+    flow = F.interpolate(flow, size=(h, w), mode='bilinear', align_corners=False)[0]
+    flow[0] /= factor_x
+    flow[1] /= factor_y
+
+    return flow.permute(1, 2, 0).numpy()
+
+def build_frame_store(dataset, out_dir, size, num_workers=8, draft_decode=True, print_fn=print):
+    """Writes the frames and flows of every sample of a CamFlowDataset, resized to size=(w, h).
+
+    With draft_decode, the JPEGs are decoded as the datasets do with decode_size, at the smallest
+    DCT scale still covering size, so that the stored frames match the pixels of the decode path.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    size = tuple(size)
+
+    frame_paths = np.unique(np.asarray([path for paths in dataset.image_list for path in paths], dtype=str))
+    flow_paths = np.unique(np.asarray([path for paths in dataset.flow_list for path in paths], dtype=str))
+
+    resize = transforms.Resize((size[1], size[0]))
+
+    frames = np.lib.format.open_memmap(os.path.join(out_dir, FRAMES_NAME + '.tmp'), mode='w+', dtype=np.uint8, shape=(len(frame_paths), size[1], size[0], 3))
+    flows = np.lib.format.open_memmap(os.path.join(out_dir, FLOWS_NAME + '.tmp'), mode='w+', dtype=np.float32, shape=(len(flow_paths), size[1], size[0], 2))
+
+    def write_frame(i):
+        # the decode of the datasets, then the same resize as the training transforms
+        image = frame_utils.read_gen(str(frame_paths[i]))
+        if draft_decode:
+            image = frame_utils.draft_image(image, size)
+        frames[i] = np.asarray(resize(image.convert('RGB')))
+
+    def write_flow(i):
+        flows[i] = resize_flow(dataset.read_flow(str(flow_paths[i])), size)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        list(executor.map(write_frame, range(len(frame_paths))))
+        list(executor.map(write_flow, range(len(flow_paths))))
+
+    frames.flush()
+    flows.flush()
+    del frames, flows
+
+    os.replace(os.path.join(out_dir, FRAMES_NAME + '.tmp'), os.path.join(out_dir, FRAMES_NAME))
+    os.replace(os.path.join(out_dir, FLOWS_NAME + '.tmp'), os.path.join(out_dir, FLOWS_NAME))
+    np.savez(os.path.join(out_dir, INDEX_NAME), frame_paths=frame_paths, flow_paths=flow_paths, size=np.asarray(size), draft_decode=np.asarray(draft_decode))
+
+    if print_fn is not None:
+        print_fn('[i] stored {:,} frames and {:,} flows at {}x{} ({}) in {}'.format(len(frame_paths), len(flow_paths), size[0], size[1],
+                                                                                 'draft decode' if draft_decode else 'full decode', out_dir))
+
+
+class Frame_Store:
+    """Reads frames and flows out of a store written by build_frame_store, by their original path."""
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+        with np.load(os.path.join(store_dir, INDEX_NAME)) as index:
+            self.frame_paths = index['frame_paths']
+            self.flow_paths = index['flow_paths']
+            self.size = tuple(index['size'].tolist())
+            # stores written before draft_decode was recorded hold full decodes
+            self.draft_decode = bool(index['draft_decode']) if 'draft_decode' in index else False
+
+        self.frames = None
+        self.flows = None
+
+    def open(self):
+        self.frames = np.load(os.path.join(self.store_dir, FRAMES_NAME), mmap_mode='r')
+        self.flows = np.load(os.path.join(self.store_dir, FLOWS_NAME), mmap_mode='r')
+
+    def get_row(self, paths, path):
+        row = np.searchsorted(paths, path)
+        if row >= len(paths) or paths[row] != path:
+            raise KeyError('{} is not in the frame store {}'.format(path, self.store_dir))
+        return row
+
+    def frame(self, image_path):
+        """(h, w, 3) uint8 read-only view of a frame."""
+        if self.frames is None:
+            self.open()
+        return self.frames[self.get_row(self.frame_paths, image_path)]
+
+    def flow(self, flow_path):
+        """(h, w, 2) float32 read-only view of a flow."""
+        if self.flows is None:
+            self.open()
+        return self.flows[self.get_row(self.flow_paths, flow_path)]
+
+    def __getstate__(self):
+        # every DataLoader worker maps the arrays itself
+        state = self.__dict__.copy()
+        state['frames'] = None
+        state['flows'] = None
+        return state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write the frames and flows of the training and validation sets, resized, into memory-mapped stores.")
+    parser.add_argument("--config", type=str, required=True, help="Training YAML configuration (dataset_dir, flow_dir, image_size, frame_store_dir).")
+    parser.add_argument("--num_workers", type=int, default=8, help="Number of frames decoded in parallel.")
+    args = parser.parse_args()
+
+    import yaml
+    import seruso_datasets
+
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+
+    size = (config['image_size'], config['image_size'])
+    draft_decode = config.get('draft_decode', True)
+    for dstype in ['training', 'validation']:
+        dataset = seruso_datasets.Seruso_three_classes_flow(img_root = config['dataset_dir'], flow_root = config['flow_dir'], dstype = dstype,
+                                                            flow_format = config.get('flow_format', 'mmap'), manifest_dir = config.get('manifest_dir', None))
+        build_frame_store(dataset, os.path.join(config['frame_store_dir'], dstype), size, args.num_workers, draft_decode)
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,21 @@
 import numpy as np
 from PIL import Image
+import os
 from os.path import *
 import re
 import cv2
 
 TAG_CHAR = np.array([202021.25], np.float32)
+FLO_HEADER_BYTES = 12
+
+# Compact flows keep the .flo extension but start with their own tag, followed by the width, the
+# height and the scale of the values (1 for float16); the payload is (h, w, 2) little-endian values.
+COMPACT_FLOW_TAGS = {'float16' : b'FLH1', 'int16' : b'FLQ1'}
+COMPACT_HEADER_BYTES = 16
+INT16_MAX = 32767
 
 def readFlow(fn):
-    """ Read .flo file in Middlebury format"""
+    """ Read .flo file in Middlebury format (or a compact .flo, see encode_flow_compact)"""
     # Code adapted from:
     # http://stackoverflow.com/questions/28013200/reading-middlebury-flow-files-with-python-bytes-array-numpy
 
@@ -15,13 +23,17 @@ def readFlow(fn):
     # print 'fn = %s'%(fn)
     
     with open(fn, 'rb') as f:
-        magic = np.fromfile(f, np.float32, count=1)
+        tag = f.read(4)
+        if tag in COMPACT_FLOW_TAGS.values():
+            # compact flow (see encode_flow_compact), decoded from the same open file
+            return decode_flow_compact(tag + f.read())
+        magic = np.frombuffer(tag, np.float32, count=len(tag) // 4)
         if 202021.25 != magic:
             print('Magic number incorrect. Invalid .flo file')
             return None
         else:
-            w = np.fromfile(f, np.int32, count=1)
-            h = np.fromfile(f, np.int32, count=1)
+            w = np.fromfile(f, np.int32, count=1)[0]
+            h = np.fromfile(f, np.int32, count=1)[0]
             # print 'Reading %d x %d flo file\n' % (w, h)
             data = np.fromfile(f, np.float32, count=2*int(w)*int(h))
             # Reshape data into 3D array (columns, rows, bands)
@@ -65,6 +77,58 @@ def readPFM(file):
     data = np.flipud(data)
     return data
 
+def readFlowMmap(fn):
+    """ Read .flo file in Middlebury format as a read-only memory-mapped view.
+
+    The header is validated against the file size and the payload is returned
+    as a (h, w, 2) float32 array backed by the page cache, without any copy.
+    Compact flows (see encode_flow_compact) are decoded into a new array.
+    """
+    with open(fn, 'rb') as f:
+        tag = f.read(4)
+        if tag in COMPACT_FLOW_TAGS.values():
+            # compact flows are small, they are decoded instead
+            return decode_flow_compact(tag + f.read())
+        if len(tag) != 4 or np.frombuffer(tag, np.float32)[0] != TAG_CHAR[0]:
+            raise ValueError('Magic number incorrect. Invalid .flo file: {}'.format(fn))
+        w, h = np.fromfile(f, '<i4', count=2)
+        size = os.fstat(f.fileno()).st_size
+
+    w, h = int(w), int(h)
+    if w <= 0 or h <= 0 or size != FLO_HEADER_BYTES + 8 * w * h:
+        raise ValueError('Malformed .flo header ({}x{}, {} bytes): {}'.format(w, h, size, fn))
+
+    return np.memmap(fn, dtype='<f4', mode='r', offset=FLO_HEADER_BYTES, shape=(h, w, 2))
+
+def readPFMMmap(fn):
+    """ Read .pfm file as a read-only memory-mapped view (bottom-up rows are flipped as a view). """
+    with open(fn, 'rb') as f:
+        header = f.readline().rstrip()
+        if header == b'PF':
+            channels = 3
+        elif header == b'Pf':
+            channels = 1
+        else:
+            raise ValueError('Not a PFM file: {}'.format(fn))
+
+        dim_match = re.match(rb'^(\d+)\s(\d+)\s$', f.readline())
+        if not dim_match:
+            raise ValueError('Malformed PFM header: {}'.format(fn))
+        width, height = map(int, dim_match.groups())
+
+        scale = float(f.readline().rstrip())
+        offset = f.tell()
+        size = os.fstat(f.fileno()).st_size
+
+    if size != offset + 4 * width * height * channels:
+        raise ValueError('Malformed PFM payload ({}x{}x{}, {} bytes): {}'.format(width, height, channels, size, fn))
+
+    endian = '<' if scale < 0 else '>'
+    shape = (height, width, 3) if channels == 3 else (height, width)
+    data = np.memmap(fn, dtype=endian + 'f4', mode='r', offset=offset, shape=shape)
+
+    return np.flipud(data)
+
 def writeFlow(filename,uv,v=None):
     """ Write optical flow to file.
     
@@ -103,8 +167,100 @@ def read_gen(file_name, pil=False):
     elif ext == '.bin' or ext == '.raw':
         return np.load(file_name)
     elif ext == '.flo':
-        return readFlow(file_name).astype(np.float32)
+        # Middlebury or compact flows, a single open either way
+        return readFlow(file_name).astype(np.float32, copy=False)
     elif ext == '.pfm':
         flow = readPFM(file_name).astype(np.float32)
         return flow[:, :, :-1]
-    return []
\ No newline at end of file
+    return []
+
+def draft_image(image, size):
+    """ Asks the JPEG decoder of a not yet loaded image for the smallest DCT scale (1/1 to 1/8)
+    whose output is still at least size=(w, h); other formats are left untouched. """
+    if size is not None and image.format == 'JPEG':
+        image.draft(image.mode, tuple(size))
+    return image
+
+def get_decode_size(transform):
+    """ (w, h) a frame can be decoded at without loss for transform, i.e. the size of a leading
+    transforms.Resize, or None when the transform does not start by resizing. """
+    transforms_list = getattr(transform, 'transforms', [transform])
+    if not transforms_list or type(transforms_list[0]).__name__ != 'Resize':
+        return None
+
+    size = transforms_list[0].size
+    if isinstance(size, int):
+        return (size, size)
+    if len(size) == 1:
+        return (size[0], size[0])
+    return (size[1], size[0])
+
+def read_flow_mmap(file_name):
+    """ Zero-copy counterpart of read_gen for flow files: returns a read-only (h, w, 2) view. """
+    ext = splitext(file_name)[-1]
+    if ext == '.flo':
+        return readFlowMmap(file_name)
+    elif ext == '.pfm':
+        return readPFMMmap(file_name)[:, :, :-1]
+    raise ValueError('Unsupported flow file: {}'.format(file_name))
+
+def flow_to_bytes(flow):
+    """ Serialises a (h, w, 2) flow into the bytes of the equivalent .flo file. """
+    h, w = flow.shape[:2]
+    return TAG_CHAR.tobytes() + np.array([w, h], '<i4').tobytes() + np.ascontiguousarray(flow, dtype='<f4').tobytes()
+
+def flow_from_bytes(buffer):
+    """ Read-only (h, w, 2) view of the content of a .flo file held in memory. """
+    if bytes(buffer[:4]) in COMPACT_FLOW_TAGS.values():
+        return decode_flow_compact(buffer)
+    if len(buffer) < FLO_HEADER_BYTES or np.frombuffer(buffer, '<f4', count=1)[0] != TAG_CHAR[0]:
+        raise ValueError('Magic number incorrect. Invalid .flo buffer')
+    w, h = np.frombuffer(buffer, '<i4', count=2, offset=4).tolist()
+    if w <= 0 or h <= 0 or len(buffer) != FLO_HEADER_BYTES + 8 * w * h:
+        raise ValueError('Malformed .flo header ({}x{}, {} bytes)'.format(w, h, len(buffer)))
+    return np.frombuffer(buffer, '<f4', offset=FLO_HEADER_BYTES).reshape(h, w, 2)
+
+def encode_flow_compact(flow, codec='int16'):
+    """ Serialises a (h, w, 2) flow as float16, or as int16 values times a per-file scale
+    (max |value| / 32767, i.e. an error of at most scale / 2 per component). """
+    flow = np.asarray(flow, dtype=np.float32)
+    h, w = flow.shape[:2]
+
+    if codec == 'float16':
+        scale = np.float32(1.)
+        payload = flow.astype('<f2')
+    elif codec == 'int16':
+        max_abs = np.abs(flow).max() if flow.size else 0.
+        scale = np.float32(max_abs / INT16_MAX) if max_abs > 0 else np.float32(1.)
+        payload = np.clip(np.rint(flow / scale), -INT16_MAX, INT16_MAX).astype('<i2')
+    else:
+        raise ValueError('Unknown flow codec: {} (expected {})'.format(codec, ', '.join(COMPACT_FLOW_TAGS)))
+
+    return COMPACT_FLOW_TAGS[codec] + np.array([w, h], '<i4').tobytes() + np.array([scale], '<f4').tobytes() + payload.tobytes()
+
+def decode_flow_compact(buffer):
+    """ (h, w, 2) float32 flow out of the bytes written by encode_flow_compact. """
+    codecs = {tag: codec for codec, tag in COMPACT_FLOW_TAGS.items()}
+    codec = codecs.get(bytes(buffer[:4]))
+    if codec is None:
+        raise ValueError('Invalid compact flow tag: {}'.format(bytes(buffer[:4])))
+
+    w, h = np.frombuffer(buffer, '<i4', count=2, offset=4).tolist()
+    scale = np.frombuffer(buffer, '<f4', count=1, offset=12)[0]
+    if w <= 0 or h <= 0 or len(buffer) != COMPACT_HEADER_BYTES + 4 * w * h:
+        raise ValueError('Malformed compact flow header ({}x{}, {} bytes)'.format(w, h, len(buffer)))
+
+    payload = np.frombuffer(buffer, '<f2' if codec == 'float16' else '<i2', offset=COMPACT_HEADER_BYTES).reshape(h, w, 2)
+    if codec == 'float16':
+        return payload.astype(np.float32)
+    return payload.astype(np.float32) * scale
+
+def readFlowCompact(fn):
+    """ Read a compact .flo file (float16 or int16 codec) as a (h, w, 2) float32 array. """
+    with open(fn, 'rb') as f:
+        return decode_flow_compact(f.read())
+
+def writeFlowCompact(filename, flow, codec='int16'):
+    """ Write a (h, w, 2) flow with the float16 or int16 codec of encode_flow_compact. """
+    with open(filename, 'wb') as f:
+        f.write(encode_flow_compact(flow, codec))
@@ -1,3 +1,4 @@
+import torch
 import numpy as np
 from .txt_utils import add_txt
 
@@ -45,3 +46,38 @@ class Average_Meter:
     def clear(self):
         self.data_dic = {key : [] for key in self.keys}
 
+class Device_Average_Meter(Average_Meter):
+    """Average_Meter keeping running sums of the tensor values (losses) on their device.
+
+    add never synchronises with the host (no .item()): the sums are only read back by get, all
+    together, e.g. at the log and validation boundaries. Python numbers are summed on the host.
+    """
+    def add(self, dic):
+        for key, value in dic.items():
+            if torch.is_tensor(value):
+                value = value.detach().float().reshape(())
+            self.sums[key] = self.sums[key] + value
+            self.counts[key] += 1
+
+    def get(self, keys=None, clear=False):
+        if keys is None:
+            keys = self.keys
+
+        # a single device to host copy for all the keys
+        sums = [self.sums[key] for key in keys]
+        tensors = [value for value in sums if torch.is_tensor(value)]
+        host_values = iter(torch.stack(tensors).tolist() if tensors else [])
+        sums = [next(host_values) if torch.is_tensor(value) else value for value in sums]
+
+        dataset = [float(value) / self.counts[key] if self.counts[key] else float('nan') for key, value in zip(keys, sums)]
+        if clear:
+            self.clear()
+
+        if len(dataset) == 1:
+            dataset = dataset[0]
+
+        return dataset
+
+    def clear(self):
+        self.sums = {key : 0. for key in self.keys}
+        self.counts = {key : 0 for key in self.keys}
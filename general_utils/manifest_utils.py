@@ -0,0 +1,181 @@
+import os
+import hashlib
+
+import numpy as np
+
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+
+MANIFEST_VERSION = 1
+
+
+class Triplet_Manifest:
+    """Compact list of the [frame_n, frame_n+1, frame_n+2] triplets found under <base_dir>/<class>/<scene>/.
+
+    Scenes are stored once (class, name, image size, directory mtime) and samples are integer
+    arrays pointing into the scene and prefix tables; image, flow and mask paths are rebuilt
+    from them by the datasets. The sample order is the one of the original glob-based scan.
+    """
+    def __init__(self, class_names, class_mtimes, scene_class, scene_names, scene_mtimes, scene_sizes,
+                 prefixes, sample_scene, sample_prefix, sample_frame):
+        self.class_names = list(class_names)
+        self.class_mtimes = np.asarray(class_mtimes, dtype=np.int64)
+        self.scene_class = np.asarray(scene_class, dtype=np.int32)
+        self.scene_names = np.asarray(scene_names, dtype=str)
+        self.scene_mtimes = np.asarray(scene_mtimes, dtype=np.int64)
+        self.scene_sizes = np.asarray(scene_sizes, dtype=np.int32).reshape(-1, 2)
+        self.prefixes = np.asarray(prefixes, dtype=str)
+        self.sample_scene = np.asarray(sample_scene, dtype=np.int32)
+        self.sample_prefix = np.asarray(sample_prefix, dtype=np.int32)
+        self.sample_frame = np.asarray(sample_frame, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.sample_scene)
+
+    def samples(self):
+        """Yields (class_name, scene_name, prefix, frame_nb) for every triplet."""
+        for scene_id, prefix_id, frame_nb in zip(self.sample_scene.tolist(), self.sample_prefix.tolist(), self.sample_frame.tolist()):
+            yield self.class_names[self.scene_class[scene_id]], str(self.scene_names[scene_id]), str(self.prefixes[prefix_id]), frame_nb
+
+    def save(self, manifest_path):
+        os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+        tmp_path = manifest_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f,
+                     version=np.int32(MANIFEST_VERSION),
+                     class_names=np.asarray(self.class_names, dtype=str),
+                     class_mtimes=self.class_mtimes,
+                     scene_class=self.scene_class,
+                     scene_names=self.scene_names,
+                     scene_mtimes=self.scene_mtimes,
+                     scene_sizes=self.scene_sizes,
+                     prefixes=self.prefixes,
+                     sample_scene=self.sample_scene,
+                     sample_prefix=self.sample_prefix,
+                     sample_frame=self.sample_frame)
+        os.replace(tmp_path, manifest_path)
+
+    @classmethod
+    def load(cls, manifest_path):
+        with np.load(manifest_path, allow_pickle=False) as data:
+            if int(data['version']) != MANIFEST_VERSION:
+                return None
+            return cls(data['class_names'].tolist(), data['class_mtimes'], data['scene_class'], data['scene_names'],
+                       data['scene_mtimes'], data['scene_sizes'], data['prefixes'], data['sample_scene'],
+                       data['sample_prefix'], data['sample_frame'])
+
+
+def get_manifest_path(manifest_dir, base_dir, class_names):
+    key = '|'.join([os.path.abspath(base_dir)] + list(class_names))
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(manifest_dir, 'manifest_{}.npz'.format(digest))
+
+def list_scenes(class_dir):
+    # same entries and order as sorted(glob(class_dir/*/*.jpg)), which skips hidden names
+    scenes = [entry.name for entry in os.scandir(class_dir) if entry.is_dir() and not entry.name.startswith('.')]
+    return sorted(scenes, key=lambda name: name + '/')
+
+def scan_scene(scene_dir):
+    """Returns the (prefix, frame_nb) of every frame that starts a complete triplet, and the image size."""
+    names = sorted(name for name in os.listdir(scene_dir) if name.endswith('.jpg') and not name.startswith('.'))
+    existing = set(names)
+
+    triplets = []
+    for filename in names:
+        no_ext_filename = os.path.splitext(filename)[0]
+        prefix, frame_nb = no_ext_filename.split('_')
+        frame_nb = int(frame_nb)
+
+        if all('{}_{:04d}.jpg'.format(prefix, frame_nb + i) in existing for i in range(3)):
+            triplets.append((prefix, frame_nb))
+
+    size = (0, 0)
+    if names:
+        with Image.open(os.path.join(scene_dir, names[0])) as image:
+            size = image.size
+
+    return triplets, size
+
+def load_triplet_manifest(base_dir, class_names, manifest_dir=None, num_workers=16, print_fn=print):
+    """Builds (or loads) the triplet manifest of base_dir/<class_name>/<scene>/*.jpg.
+
+    With manifest_dir=None the directories are scanned every time, otherwise the manifest is
+    persisted there and only the scenes whose directory mtime changed are scanned again.
+    Scenes are listed and scanned in parallel.
+    """
+    cached = None
+    manifest_path = None
+
+    if manifest_dir is not None:
+        manifest_path = get_manifest_path(manifest_dir, base_dir, class_names)
+        if os.path.isfile(manifest_path):
+            cached = Triplet_Manifest.load(manifest_path)
+
+    cached_scenes = {}
+    cached_classes = {}
+    if cached is not None:
+        scene_samples = [[] for _ in range(len(cached.scene_names))]
+        for sample_id, scene_id in enumerate(cached.sample_scene.tolist()):
+            scene_samples[scene_id].append(sample_id)
+
+        for scene_id, scene_name in enumerate(cached.scene_names.tolist()):
+            class_name = cached.class_names[cached.scene_class[scene_id]]
+            samples = scene_samples[scene_id]
+            triplets = [(str(cached.prefixes[cached.sample_prefix[i]]), int(cached.sample_frame[i])) for i in samples]
+            cached_scenes[(class_name, scene_name)] = (int(cached.scene_mtimes[scene_id]), triplets, tuple(cached.scene_sizes[scene_id].tolist()))
+            cached_classes.setdefault(class_name, []).append(scene_name)
+
+        for class_name, class_mtime in zip(cached.class_names, cached.class_mtimes.tolist()):
+            cached_classes[class_name] = (class_mtime, cached_classes.get(class_name, []))
+
+    def get_class_scenes(class_name):
+        class_dir = os.path.join(base_dir, class_name)
+        class_mtime = os.stat(class_dir).st_mtime_ns
+        if class_name in cached_classes and cached_classes[class_name][0] == class_mtime:
+            return class_mtime, cached_classes[class_name][1]
+        return class_mtime, list_scenes(class_dir)
+
+    def get_scene(key):
+        class_name, scene_name = key
+        scene_dir = os.path.join(base_dir, class_name, scene_name)
+        scene_mtime = os.stat(scene_dir).st_mtime_ns
+        if key in cached_scenes and cached_scenes[key][0] == scene_mtime:
+            return scene_mtime, cached_scenes[key][1], cached_scenes[key][2], False
+        triplets, size = scan_scene(scene_dir)
+        return scene_mtime, triplets, size, True
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        class_entries = list(executor.map(get_class_scenes, class_names))
+
+        keys = [(class_name, scene_name) for class_name, (_, scenes) in zip(class_names, class_entries) for scene_name in scenes]
+        scenes = list(executor.map(get_scene, keys))
+
+    num_scanned = sum(1 for scene in scenes if scene[3])
+    class_mtimes = [class_mtime for class_mtime, _ in class_entries]
+    if cached is not None and num_scanned == 0 and len(keys) == len(cached_scenes) and class_mtimes == cached.class_mtimes.tolist():
+        return cached
+
+    prefixes = {}
+    scene_class, scene_names, scene_mtimes, scene_sizes = [], [], [], []
+    sample_scene, sample_prefix, sample_frame = [], [], []
+
+    for scene_id, ((class_name, scene_name), (scene_mtime, triplets, size, _)) in enumerate(zip(keys, scenes)):
+        scene_class.append(class_names.index(class_name))
+        scene_names.append(scene_name)
+        scene_mtimes.append(scene_mtime)
+        scene_sizes.append(size)
+
+        for prefix, frame_nb in triplets:
+            sample_scene.append(scene_id)
+            sample_prefix.append(prefixes.setdefault(prefix, len(prefixes)))
+            sample_frame.append(frame_nb)
+
+    manifest = Triplet_Manifest(class_names, class_mtimes, scene_class, scene_names, scene_mtimes,
+                                scene_sizes, list(prefixes), sample_scene, sample_prefix, sample_frame)
+
+    if manifest_path is not None:
+        manifest.save(manifest_path)
+        if print_fn is not None:
+            print_fn('[i] manifest {}: {:,} triplets in {:,} scenes ({:,} scanned)'.format(manifest_path, len(manifest), len(keys), num_scanned))
+
+    return manifest
@@ -0,0 +1,142 @@
+import os
+
+import numpy as np
+import torch
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Ground-truth masks are decoded once at the evaluation resolution, binarised as compute_iou did
+# (value / 255 > 0.5) and kept as np.packbits bit-planes: 1 bit per pixel, and IoUs computed with
+# bitwise ops and popcounts over bytes. On disk, a cache file holds the masks of one resolution:
+#
+#   gt_masks_{w}x{h}.npz   sorted paths, bits (num_masks, ceil(h * w / 8)) uint8, shape (h, w) and
+#                          stamps (num_masks, 2) int64, the mtime (ns) and size of each mask file
+#
+# A cached mask is used only while the stamp of its file is unchanged, masks re-exported or
+# corrected on disk are decoded again.
+
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(bits):
+    """Number of set bits of a uint8 array."""
+    if hasattr(np, 'bitwise_count'):
+        return int(np.bitwise_count(bits).sum(dtype=np.int64))
+    return int(POPCOUNT_TABLE[bits].sum(dtype=np.int64))
+
+def binarize_mask(mask):
+    if isinstance(mask, torch.Tensor):
+        mask = mask.cpu().detach().numpy()
+    return np.asarray(mask) != 0
+
+def get_cache_name(size):
+    return 'gt_masks_full.npz' if size is None else 'gt_masks_{}x{}.npz'.format(*size)
+
+def get_stamp(path):
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+class Packed_Mask:
+    """Binary (h, w) mask stored as packed bits.
+
+    np.array(mask) gives the uint8 0/255 image back, so a Packed_Mask can replace the PIL ground
+    truth anywhere (visualisation, np.array(gt) / 255 > 0.5).
+    """
+    def __init__(self, bits, shape):
+        self.bits = bits
+        self.shape = tuple(shape)
+        self.count = popcount(bits)
+
+    @classmethod
+    def from_image(cls, mask):
+        mask = np.asarray(mask) / 255 > 0.5
+        return cls(np.packbits(mask.reshape(-1)), mask.shape)
+
+    def unpack(self):
+        return np.unpackbits(self.bits, count=self.shape[0] * self.shape[1]).reshape(self.shape).astype(bool)
+
+    def __array__(self, dtype=None, copy=None):
+        mask = self.unpack().astype(np.uint8) * 255
+        return mask if dtype is None else mask.astype(dtype)
+
+    def iou(self, predicted_mask_binary):
+        predicted = binarize_mask(predicted_mask_binary)
+        if predicted.shape != self.shape:
+            raise ValueError('Predicted mask of shape {} for a ground truth of shape {}'.format(predicted.shape, self.shape))
+
+        predicted_bits = np.packbits(predicted.reshape(-1))
+        intersection = popcount(np.bitwise_and(predicted_bits, self.bits))
+        union = popcount(predicted_bits) + self.count - intersection
+
+        if union == 0:
+            return 1.0
+        return intersection / union
+
+
+class GT_Mask_Cache:
+    """Packed ground-truth masks keyed by path, optionally persisted in cache_path."""
+    def __init__(self, cache_path=None):
+        self.cache_path = cache_path
+        self.masks = {}
+        self.stamps = {}
+        self.checked = set()
+        self.dirty = False
+
+        if cache_path is not None and os.path.isfile(cache_path):
+            with np.load(cache_path) as data:
+                # cache files without stamps cannot be checked against the masks on disk
+                if 'stamps' in data:
+                    shape = tuple(data['shape'].tolist())
+                    for path, bits, stamp in zip(data['paths'].tolist(), data['bits'], data['stamps'].tolist()):
+                        self.masks[path] = Packed_Mask(bits, shape)
+                        self.stamps[path] = tuple(stamp)
+
+    def check(self, key):
+        """True when the cached mask of key is the one of its file on disk, otherwise drops it."""
+        if key in self.checked:
+            return True
+
+        stamp = get_stamp(key)
+        if key in self.masks and self.stamps.get(key) == stamp:
+            self.checked.add(key)
+            return True
+
+        # stamped before decoding, a file rewritten meanwhile is decoded again by the next run
+        self.masks.pop(key, None)
+        self.stamps[key] = stamp
+        return False
+
+    def add(self, key, mask):
+        self.masks[key] = mask
+        self.checked.add(key)
+        self.dirty = True
+
+    def get(self, key, load_fn):
+        if not self.check(key):
+            self.add(key, Packed_Mask.from_image(load_fn(key)))
+        return self.masks[key]
+
+    def build(self, keys, load_fn, num_workers=8):
+        """Decodes the masks of keys not cached yet, or whose file changed since they were cached."""
+        missing = sorted(key for key in set(keys) if not self.check(key))
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            for key, mask in zip(missing, executor.map(lambda key: Packed_Mask.from_image(load_fn(key)), missing)):
+                self.add(key, mask)
+
+    def save(self):
+        if self.cache_path is None or not self.dirty or not self.masks:
+            return
+
+        paths = sorted(self.masks)
+        shapes = set(self.masks[path].shape for path in paths)
+        if len(shapes) > 1:
+            raise ValueError('Masks of several resolutions cannot be stored in {}'.format(self.cache_path))
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, paths=np.asarray(paths, dtype=str), bits=np.stack([self.masks[path].bits for path in paths]), shape=np.asarray(shapes.pop()),
+                     stamps=np.asarray([self.stamps[path] for path in paths], dtype=np.int64))
+        os.replace(tmp_path, self.cache_path)
+        self.dirty = False
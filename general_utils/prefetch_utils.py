@@ -0,0 +1,155 @@
+import time
+import queue
+import threading
+
+import torch
+
+
+def to_device(data, device, non_blocking=False, pin_memory=False):
+    # moves every tensor of a (nested) list/tuple/dict batch, as collated by the DataLoader
+    if torch.is_tensor(data):
+        if pin_memory and not data.is_pinned():
+            data = data.pin_memory()
+        return data.to(device, non_blocking=non_blocking)
+    if isinstance(data, (list, tuple)):
+        return type(data)(to_device(d, device, non_blocking, pin_memory) for d in data)
+    if isinstance(data, dict):
+        return {k: to_device(v, device, non_blocking, pin_memory) for k, v in data.items()}
+    return data
+
+def record_stream(data, stream):
+    # tells the caching allocator that tensors copied on the side stream are used on the compute stream
+    if torch.is_tensor(data):
+        data.record_stream(stream)
+    elif isinstance(data, (list, tuple)):
+        for d in data:
+            record_stream(d, stream)
+    elif isinstance(data, dict):
+        for d in data.values():
+            record_stream(d, stream)
+
+
+class Prefetcher:
+    """Stages the next num_batches batches of a DataLoader on the device ahead of time.
+
+    A background thread pulls the batches, pins them and copies them to the device with
+    non-blocking copies on a side CUDA stream; the consumer only waits for the copy of the batch
+    it takes. Without a CUDA device the batches stay on the CPU and are only read ahead.
+
+    get() is the drop-in replacement of seruso_datasets.Iterator (endless, wraps around the
+    epochs), while iterating the prefetcher yields a single epoch like the DataLoader does.
+    Use one or the other on a given prefetcher. The time spent waiting for data is accumulated
+    and returned by data_wait().
+    """
+    def __init__(self, loader, device=None, num_batches=2):
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+        self.loader = loader
+        self.device = torch.device(device)
+        self.num_batches = max(num_batches, 1)
+        self.use_cuda = self.device.type == 'cuda'
+        self.stream = torch.cuda.Stream(self.device) if self.use_cuda else None
+
+        self.queue = None
+        self.thread = None
+        self.stop_event = threading.Event()
+
+        self.wait_time = 0.
+        self.wait_count = 0
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def produce(self, endless):
+        try:
+            while not self.stop_event.is_set():
+                # the augmentation streams of the workers are derived from the epoch (see rng_utils)
+                if hasattr(self.loader.dataset, 'set_epoch'):
+                    self.loader.dataset.set_epoch(self.epoch)
+                self.epoch += 1
+
+                for data in self.loader:
+                    if self.use_cuda:
+                        with torch.cuda.stream(self.stream):
+                            data = to_device(data, self.device, non_blocking=True, pin_memory=True)
+                            event = torch.cuda.Event()
+                            event.record(self.stream)
+                    else:
+                        event = None
+
+                    if not self.put((data, event)):
+                        return
+
+                if not endless:
+                    break
+            self.put(StopIteration())
+        except Exception as e:
+            self.put(e)
+
+    def put(self, item):
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def start(self, endless):
+        self.stop_event.clear()
+        self.queue = queue.Queue(maxsize=self.num_batches)
+        self.thread = threading.Thread(target=self.produce, args=(endless,), daemon=True)
+        self.thread.start()
+
+    def close(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+
+    def next(self):
+        start = time.perf_counter()
+        item = self.queue.get()
+        self.wait_time += time.perf_counter() - start
+        self.wait_count += 1
+
+        if isinstance(item, Exception):
+            self.thread = None
+            raise item
+
+        data, event = item
+        if event is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(event)
+            record_stream(data, current_stream)
+
+        return data
+
+    def get(self):
+        if self.thread is None:
+            self.start(endless=True)
+        return self.next()
+
+    def __iter__(self):
+        self.close()
+        self.start(endless=False)
+        try:
+            while True:
+                try:
+                    data = self.next()
+                except StopIteration:
+                    return
+                yield data
+        finally:
+            # the epoch may be left early (break), the reader thread must not stay blocked
+            self.close()
+
+    def data_wait(self, clear=False):
+        """Returns the mean time (in seconds) spent waiting for a batch since the last clear."""
+        mean_wait = self.wait_time / max(self.wait_count, 1)
+        if clear:
+            self.wait_time = 0.
+            self.wait_count = 0
+        return mean_wait
@@ -0,0 +1,72 @@
+import random
+
+import numpy as np
+import torch
+
+from general_utils.frame_cache import get_worker_slot
+
+# Random streams of the data pipeline. Instead of reseeding from OS entropy for every sample, each
+# DataLoader worker draws from generators seeded with (seed, epoch, worker slot), so that an epoch
+# can be replayed exactly, e.g. when a training is resumed. The epoch lives in shared memory: the
+# main process sets it between two epochs (Prefetcher) and the workers pick it up on their next sample.
+
+_current = None
+_fallback = np.random.default_rng()
+
+
+class Worker_RNG:
+    """np.random.Generator and torch.Generator of the calling process, derived from (seed, epoch, worker)."""
+    def __init__(self, seed=0):
+        self.seed = seed
+        self.epoch = torch.zeros(1, dtype=torch.int64).share_memory_()
+
+        self.key = None
+        self.generator = None
+        self.torch_generator = None
+
+    def set_epoch(self, epoch):
+        self.epoch.fill_(epoch)
+
+    def reseed(self):
+        slot = get_worker_slot()
+        self.key = (int(self.epoch), slot)
+
+        seed_sequence = np.random.SeedSequence([self.seed, self.key[0], slot])
+        states = seed_sequence.generate_state(4).tolist()
+
+        self.generator = np.random.default_rng(seed_sequence)
+        self.torch_generator = torch.Generator().manual_seed(states[0] | states[1] << 32)
+
+        if slot > 0:
+            # a worker owns its process: the global generators (e.g. torchvision's ColorJitter) follow too
+            torch.manual_seed(states[0] | states[1] << 32)
+            np.random.seed(states[2])
+            random.seed(states[3])
+
+    def get(self):
+        """Generator of the current epoch, which also becomes the one returned by get_rng()."""
+        global _current
+        if self.key != (int(self.epoch), get_worker_slot()):
+            self.reseed()
+        _current = self
+        return self.generator
+
+    def __getstate__(self):
+        # processes started with spawn derive their own streams
+        state = self.__dict__.copy()
+        state.update(key=None, generator=None, torch_generator=None)
+        return state
+
+
+def get_rng():
+    """np.random.Generator of the dataset being read by this process (see Worker_RNG.get)."""
+    return _fallback if _current is None else _current.generator
+
+def get_torch_generator():
+    return None if _current is None else _current.torch_generator
+
+def worker_init_fn(worker_id):
+    """DataLoader worker_init_fn: derives the streams of the worker from the Worker_RNG of its dataset."""
+    rng = getattr(torch.utils.data.get_worker_info().dataset, 'rng', None)
+    if rng is not None:
+        rng.reseed()
@@ -0,0 +1,121 @@
+import os
+
+import numpy as np
+
+
+class Sample_Table:
+    """Compact table of the triplet samples of a Triplet_Manifest, with paths rebuilt on demand.
+
+    Instead of Python lists of path strings (whose refcount updates copy the pages of every
+    forked DataLoader worker), the table only holds NumPy arrays: one directory per scene and per
+    kind of file (images, flows, masks), the interned frame prefixes, and the scene, prefix and
+    frame number of every sample. The datasets expose it through Path_List_View and
+    Label_List_View, which behave like the former image_list/flow_list/mask_list/label_list.
+    """
+    def __init__(self, manifest, roots):
+        self.class_names = list(manifest.class_names)
+        self.scene_class = manifest.scene_class
+        self.prefixes = manifest.prefixes
+        self.sample_scene = manifest.sample_scene
+        self.sample_prefix = manifest.sample_prefix
+        self.sample_frame = manifest.sample_frame
+
+        # e.g. roots = {'image' : <img_root>/training, 'flow' : <flow_root>/training}
+        scenes = list(zip(manifest.scene_class.tolist(), manifest.scene_names.tolist()))
+        self.scene_dirs = {kind: np.asarray([os.path.join(root, self.class_names[class_id], scene_name) for class_id, scene_name in scenes], dtype=str)
+                           for kind, root in roots.items()}
+
+    def __len__(self):
+        return len(self.sample_scene)
+
+    def get_paths(self, kind, index, count, ext):
+        scene_dir = str(self.scene_dirs[kind][self.sample_scene[index]])
+        prefix = str(self.prefixes[self.sample_prefix[index]])
+        frame_nb = int(self.sample_frame[index])
+        return [os.path.join(scene_dir, '{}_{:04d}{}'.format(prefix, frame_nb + i, ext)) for i in range(count)]
+
+    def get_label(self, index):
+        return self.class_names[self.scene_class[self.sample_scene[index]]]
+
+    def clip_starts(self, clip_length):
+        """Index of the first triplet of every clip of clip_length consecutive frames.
+
+        Clips tile each run of consecutive triplets (same scene and prefix); the last clip of a run
+        is aligned to its end, overlapping the previous one, so that every triplet is covered. Runs
+        shorter than a clip are skipped.
+        """
+        num_triplets = clip_length - 2
+        breaks = (np.diff(self.sample_scene) != 0) | (np.diff(self.sample_prefix) != 0) | (np.diff(self.sample_frame) != 1)
+        run_starts = np.flatnonzero(np.r_[True, breaks]).tolist()
+        run_ends = run_starts[1:] + [len(self)]
+
+        starts = []
+        for run_start, run_end in zip(run_starts, run_ends):
+            last_start = run_end - num_triplets
+            if last_start < run_start:
+                continue
+            starts += list(range(run_start, last_start, num_triplets)) + [last_start]
+
+        return np.asarray(starts, dtype=np.int64)
+
+    def paths(self, kind, count, ext, indices = None):
+        return Path_List_View(self, kind, count, ext, indices)
+
+    def labels(self, indices = None):
+        return Label_List_View(self, indices)
+
+
+def get_sample_index(indices, index):
+    return index if indices is None else int(indices[index])
+
+
+class Path_List_View:
+    """Read-only list of [path_0, ..., path_count-1] per sample, built from a Sample_Table.
+
+    With indices, only the samples of these indices are listed (e.g. the first triplet of every clip).
+    """
+    def __init__(self, table, kind, count, ext, indices = None):
+        self.table = table
+        self.kind = kind
+        self.count = count
+        self.ext = ext
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.table) if self.indices is None else len(self.indices)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('sample index out of range')
+        return self.table.get_paths(self.kind, get_sample_index(self.indices, index), self.count, self.ext)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.table.get_paths(self.kind, get_sample_index(self.indices, index), self.count, self.ext)
+
+
+class Label_List_View:
+    """Read-only list of the class name of every sample, built from a Sample_Table."""
+    def __init__(self, table, indices = None):
+        self.table = table
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.table) if self.indices is None else len(self.indices)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('sample index out of range')
+        return self.table.get_label(get_sample_index(self.indices, index))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.table.get_label(get_sample_index(self.indices, index))
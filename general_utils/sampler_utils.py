@@ -0,0 +1,57 @@
+import os
+
+import numpy as np
+
+from torch.utils.data import Sampler
+
+
+def get_scene_ids(image_paths):
+    # scene of a sample = directory of its frames, samples of a scene are contiguous in the datasets
+    scene_dirs = [os.path.dirname(image_path) for image_path in image_paths]
+    _, scene_ids = np.unique(np.asarray(scene_dirs), return_inverse=True)
+    return scene_ids.reshape(-1)
+
+
+class SceneChunkSampler(Sampler):
+    """Shuffles chunks of chunk_size consecutive triplets of the same scene instead of single triplets.
+
+    Consecutive triplets share two of their three frames and their flows sit in the same directory
+    (or flow shard), so keeping them together in a batch turns scattered reads into sequential ones
+    and lets the frame cache hit. Every epoch the chunk boundaries are moved by a random offset
+    within each scene and all the chunks of all the scenes are shuffled, so each sample is still
+    drawn exactly once per epoch in an order that changes from epoch to epoch.
+
+    A chunk_size that divides the batch size keeps the chunks of a batch aligned.
+    """
+    def __init__(self, scene_ids, chunk_size=8, seed=0):
+        self.scene_ids = np.asarray(scene_ids)
+        self.chunk_size = max(int(chunk_size), 1)
+        self.seed = seed
+        self.epoch = 0
+
+        # sample indices of every scene, in dataset (i.e. frame) order
+        order = np.argsort(self.scene_ids, kind='stable')
+        boundaries = np.flatnonzero(np.diff(self.scene_ids[order])) + 1
+        self.scenes = np.split(order, boundaries) if len(order) > 0 else []
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.scene_ids)
+
+    def __iter__(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        self.epoch += 1
+
+        chunks = []
+        for scene in self.scenes:
+            offset = rng.integers(self.chunk_size)
+            split_points = np.arange(offset, len(scene), self.chunk_size)
+            chunks.extend(chunk for chunk in np.split(scene, split_points) if len(chunk) > 0)
+
+        if not chunks:
+            return iter([])
+
+        chunk_order = rng.permutation(len(chunks))
+        return iter(np.concatenate([chunks[i] for i in chunk_order]).tolist())
@@ -0,0 +1,292 @@
+import os
+import mmap
+import fcntl
+import hashlib
+import tempfile
+import multiprocessing.util
+
+import numpy as np
+
+from PIL import Image
+
+from general_utils.frame_cache import Cache_Counters
+
+# A shared region is one file in /dev/shm mapped by every process using it, i.e. every DataLoader
+# worker of every training run on the host:
+#
+#   | header (4 KiB) | num_slots records (8 x uint64) | num_slots payloads (slot_bytes each) |
+#
+# The cache is direct-mapped: a key (path) lives in slot hash(key) % num_slots, whatever was there
+# before is overwritten. Each record is [seq, key hash, nbytes, kind, dtype, shape0, shape1, shape2].
+# Writers take a POSIX lock on their record and bump seq to odd while writing and back to even
+# when done (seqlock); readers copy the payload and check that seq did not move meanwhile,
+# otherwise they count a miss. Locks die with their process, and a writer killed mid-write only
+# leaves an odd seq, which the next writer of the slot repairs.
+#
+# Coordination uses <region>.lock: every process using the region holds a shared flock on it (the
+# kernel drops it if the process dies). A process that obtains it exclusively is alone: on joining,
+# it removes a region left behind by crashed processes, on exit it removes the region; in both cases
+# it unlinks the lock file too, still holding the lock. A process whose lock file was unlinked
+# meanwhile (its flock is on a stale inode) opens the new one and locks again. The region is
+# created lazily, by the first process storing an item, which fixes the slot size.
+
+REGION_MAGIC = 0x53525553464d4331
+HEADER_BYTES = 4096
+RECORD_FIELDS = 8
+RECORD_BYTES = RECORD_FIELDS * 8
+
+KIND_ARRAY = 1
+KIND_IMAGE = 2
+
+DTYPES = [np.uint8, np.float32, np.float16, np.int16, np.float64]
+
+
+def get_shared_dir():
+    return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+def hash_key(key):
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little') | 1
+
+
+class Shared_Region:
+    """Direct-mapped, fixed-capacity array store in a shared memory file (see the layout above)."""
+    def __init__(self, path, capacity_bytes):
+        self.path = path
+        self.capacity_bytes = capacity_bytes
+
+        self.pid = None
+        self.lock_file = None
+        self.fd = None
+        self.buffer = None
+        self.records = None
+        self.payloads = None
+        self.num_slots = 0
+        self.slot_bytes = 0
+
+    def join(self):
+        """Registers the calling process as a user of the region (idempotent, once per process)."""
+        if self.pid == os.getpid():
+            return
+
+        # in a forked child, the inherited lock_file/fd belong to the parent (the flock lives in the
+        # open file description), the mapping can be kept
+        self.pid = os.getpid()
+        self.fd = None
+
+        while True:
+            self.lock_file = open(self.get_lock_path(), 'a+')
+
+            # alone: a region still there was left by crashed processes, start from a fresh one
+            try:
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.unmap()
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                    self.remove_lock_file()
+                    continue
+            except BlockingIOError:
+                pass
+            fcntl.flock(self.lock_file, fcntl.LOCK_SH)
+
+            if self.is_lock_file_current():
+                break
+            self.lock_file.close()
+
+        # negative priority: in the main process, runs once its DataLoader workers have been terminated
+        multiprocessing.util.Finalize(self, self.detach, exitpriority=-10)
+
+    def get_lock_path(self):
+        return self.path + '.lock'
+
+    def is_lock_file_current(self):
+        # False when the last process unlinked the lock file between our open and our flock
+        try:
+            return os.stat(self.get_lock_path()).st_ino == os.fstat(self.lock_file.fileno()).st_ino
+        except FileNotFoundError:
+            return False
+
+    def remove_lock_file(self):
+        """Unlinks and closes the lock file, to be called holding the exclusive flock."""
+        if self.is_lock_file_current():
+            os.remove(self.get_lock_path())
+        self.lock_file.close()
+        self.lock_file = None
+
+    def is_attached(self):
+        return self.pid == os.getpid() and self.fd is not None
+
+    def read_header(self):
+        if not os.path.isfile(self.path) or os.path.getsize(self.path) < HEADER_BYTES:
+            return None
+        header = np.fromfile(self.path, dtype=np.uint64, count=3)
+        if len(header) != 3 or int(header[0]) != REGION_MAGIC:
+            return None
+        num_slots, slot_bytes = int(header[1]), int(header[2])
+        if os.path.getsize(self.path) != HEADER_BYTES + num_slots * (RECORD_BYTES + slot_bytes):
+            return None
+        return num_slots, slot_bytes
+
+    def create(self, slot_bytes):
+        # capacity is the configured budget, bounded by half of the free space of the shared filesystem
+        stat = os.statvfs(os.path.dirname(self.path))
+        capacity_bytes = min(self.capacity_bytes, stat.f_bavail * stat.f_frsize // 2)
+        num_slots = capacity_bytes // (RECORD_BYTES + slot_bytes)
+        if num_slots == 0:
+            return None
+
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.truncate(HEADER_BYTES + num_slots * (RECORD_BYTES + slot_bytes))
+            f.write(np.asarray([REGION_MAGIC, num_slots, slot_bytes], dtype=np.uint64).tobytes())
+        os.replace(tmp_path, self.path)
+
+        return num_slots, slot_bytes
+
+    def attach(self, slot_bytes=None):
+        """Maps the region, creating it (with slots of slot_bytes) if needed. Returns False when it
+        does not exist and slot_bytes is None, or when the capacity cannot hold a single slot."""
+        if self.is_attached():
+            return True
+        self.join()
+
+        if self.records is not None and self.read_header() == (self.num_slots, self.slot_bytes):
+            # mapping inherited from the parent process
+            self.fd = os.open(self.path, os.O_RDWR)
+            return True
+        self.unmap()
+
+        # creation is serialised by a POSIX lock on the lock file (independent of the flocks)
+        fcntl.lockf(self.lock_file, fcntl.LOCK_EX)
+        try:
+            layout = self.read_header()
+            if layout is None and slot_bytes is not None:
+                layout = self.create(slot_bytes)
+            if layout is None:
+                return False
+            fd = os.open(self.path, os.O_RDWR)
+        finally:
+            fcntl.lockf(self.lock_file, fcntl.LOCK_UN)
+
+        self.num_slots, self.slot_bytes = layout
+        self.fd = fd
+        self.buffer = mmap.mmap(self.fd, HEADER_BYTES + self.num_slots * (RECORD_BYTES + self.slot_bytes))
+        self.records = np.frombuffer(self.buffer, dtype=np.uint64, count=self.num_slots * RECORD_FIELDS, offset=HEADER_BYTES).reshape(self.num_slots, RECORD_FIELDS)
+        self.payloads = np.frombuffer(self.buffer, dtype=np.uint8, offset=HEADER_BYTES + self.num_slots * RECORD_BYTES).reshape(self.num_slots, self.slot_bytes)
+
+        return True
+
+    def unmap(self):
+        self.records = None
+        self.payloads = None
+        self.buffer = None
+
+    def detach(self):
+        if self.pid != os.getpid():
+            return
+
+        self.unmap()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+        # the last process attached removes the region (released first, so that of several processes
+        # detaching at the same time the last one always gets the exclusive lock)
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.remove_lock_file()
+        except BlockingIOError:
+            self.lock_file.close()
+            self.lock_file = None
+
+        self.pid = None
+
+    def get(self, key_hash):
+        slot = key_hash % self.num_slots
+        record = self.records[slot]
+
+        seq = int(record[0])
+        if seq % 2 == 1 or int(record[1]) != key_hash or int(record[2]) == 0:
+            return None
+
+        nbytes, kind, dtype, shape = int(record[2]), int(record[3]), int(record[4]), tuple(int(n) for n in record[5:8] if n > 0)
+        payload = self.payloads[slot, :nbytes].copy()
+
+        if int(record[0]) != seq or int(record[1]) != key_hash:
+            return None
+
+        return kind, payload.view(DTYPES[dtype]).reshape(shape)
+
+    def put(self, key_hash, kind, array):
+        array = np.ascontiguousarray(array)
+        if array.nbytes > self.slot_bytes or array.ndim > 3 or array.dtype.type not in DTYPES:
+            return False
+
+        slot = key_hash % self.num_slots
+        record_offset = HEADER_BYTES + slot * RECORD_BYTES
+
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB, RECORD_BYTES, record_offset)
+        except (BlockingIOError, PermissionError):
+            # another process is writing this slot
+            return False
+
+        try:
+            record = self.records[slot]
+            seq = int(record[0])
+            seq += seq % 2
+
+            record[0] = seq + 1
+            self.payloads[slot, :array.nbytes] = array.reshape(-1).view(np.uint8)
+            record[1:8] = [key_hash, array.nbytes, kind, DTYPES.index(array.dtype.type)] + list(array.shape) + [0] * (3 - array.ndim)
+            record[0] = seq + 2
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, RECORD_BYTES, record_offset)
+
+        return True
+
+    def __getstate__(self):
+        # processes started with spawn attach by themselves
+        state = self.__dict__.copy()
+        state.update(pid=None, lock_file=None, fd=None, buffer=None, records=None, payloads=None)
+        return state
+
+
+class Shared_Frame_Cache(Cache_Counters):
+    """Host-wide cache of decoded frames (PIL images) or flows (arrays), keyed by path.
+
+    Drop-in replacement of LRU_Frame_Cache: a single copy in /dev/shm is shared by the DataLoader
+    workers of every run attached to the same region name. capacity_mb is the size of the region;
+    the first item stored fixes the slot size, so all items should have the same size (frames
+    resized to frame_cache_resize, flows of a single resolution); larger items are not cached.
+    """
+    def __init__(self, name, capacity_mb, shared_dir=None):
+        super(Shared_Frame_Cache, self).__init__()
+        shared_dir = get_shared_dir() if shared_dir is None else shared_dir
+        self.region = Shared_Region(os.path.join(shared_dir, 'seruso_cache_{}'.format(name)), capacity_mb * 1024 * 1024)
+        # the main process stays registered until its DataLoader workers are gone
+        self.region.join()
+
+    def get(self, key, load_fn):
+        key_hash = hash_key(key)
+
+        if self.region.attach():
+            item = self.region.get(key_hash)
+            if item is not None:
+                self.count(hit=True)
+                kind, array = item
+                return Image.fromarray(array) if kind == KIND_IMAGE else array
+
+        self.count(hit=False)
+
+        value = load_fn(key)
+        array = np.asarray(value)
+        if self.region.attach(slot_bytes=array.nbytes):
+            self.region.put(key_hash, KIND_IMAGE if isinstance(value, Image.Image) else KIND_ARRAY, array)
+
+        return value
+
+    def clear(self):
+        pass
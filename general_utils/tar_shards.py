@@ -0,0 +1,150 @@
+import os
+import io
+import json
+import tarfile
+import argparse
+
+from general_utils import frame_utils
+
+# A tar shard holds complete samples, one after the other, so that it can be streamed sequentially:
+#
+#   000000042.json       {"label": ..., "images": [3 paths], "flows": [2 paths], "masks": [3 paths]}
+#   000000042.img0.jpg   original JPEG bytes of images[0] (same for img1, img2)
+#   000000042.flow0.flo  .flo bytes of flows[0] (same for flow1), whatever the flow_format of the dataset
+#   000000042.mask0.jpg  original JPEG bytes of masks[0] (test set only)
+#
+# The paths are the ones of the exported dataset: they are only used as keys (frame cache, returned
+# image paths), nothing is read from them when streaming. index.json describes the export.
+
+INDEX_NAME = 'index.json'
+SHARD_PATTERN = 'shard_{:06d}.tar'
+MEMBER_FIELDS = {'img' : 'images', 'flow' : 'flows', 'mask' : 'masks'}
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def add_member(tar, name, payload):
+    info = tarfile.TarInfo(name)
+    info.size = len(payload)
+    tar.addfile(info, io.BytesIO(payload))
+
+def get_sample_members(dataset, index):
+    """Returns the (suffix, payload) members of sample index of a dataset, metadata first."""
+    # the test set has no labels, the training/validation sets have no masks
+    label_list = getattr(dataset, 'label_list', [])
+    mask_list = getattr(dataset, 'mask_list', [])
+
+    meta = {
+        'label' : label_list[index] if index < len(label_list) else None,
+        'images' : list(dataset.image_list[index]),
+        'flows' : list(dataset.flow_list[index]),
+        'masks' : list(mask_list[index]) if index < len(mask_list) else [],
+    }
+
+    members = [('json', json.dumps(meta).encode('utf-8'))]
+    members += [('img{}.jpg'.format(i), read_file(path)) for i, path in enumerate(meta['images'])]
+    members += [('flow{}.flo'.format(i), frame_utils.flow_to_bytes(dataset.read_flow(path))) for i, path in enumerate(meta['flows'])]
+    members += [('mask{}.jpg'.format(i), read_file(path)) for i, path in enumerate(meta['masks'])]
+
+    return members
+
+def export_tar_shards(dataset, out_dir, kind, shard_size_mb=1024, print_fn=print):
+    """Writes every sample of a Seruso_three_classes_flow (kind='train') or SerusoTestDataset
+    (kind='test') into tar shards of about shard_size_mb each, in dataset order."""
+    assert kind in ['train', 'test']
+    os.makedirs(out_dir, exist_ok=True)
+
+    shards = []
+    tar = None
+
+    def close_shard():
+        tar.close()
+        os.replace(os.path.join(out_dir, shards[-1]['name'] + '.tmp'), os.path.join(out_dir, shards[-1]['name']))
+
+    for index in range(len(dataset)):
+        members = get_sample_members(dataset, index)
+        sample_bytes = sum(len(payload) for _, payload in members)
+
+        if tar is None or (shards[-1]['bytes'] > 0 and shards[-1]['bytes'] + sample_bytes > shard_size_mb * 1024 * 1024):
+            if tar is not None:
+                close_shard()
+            shards.append({'name' : SHARD_PATTERN.format(len(shards)), 'num_samples' : 0, 'bytes' : 0})
+            tar = tarfile.open(os.path.join(out_dir, shards[-1]['name'] + '.tmp'), 'w')
+
+        for suffix, payload in members:
+            add_member(tar, '{:09d}.{}'.format(index, suffix), payload)
+
+        shards[-1]['num_samples'] += 1
+        shards[-1]['bytes'] += sample_bytes
+
+    if tar is not None:
+        close_shard()
+
+    index = {
+        'kind' : kind,
+        'class_names' : list(dataset.class_names),
+        'num_samples' : len(dataset),
+        'shards' : [{'name' : shard['name'], 'num_samples' : shard['num_samples']} for shard in shards],
+    }
+    with open(os.path.join(out_dir, INDEX_NAME), 'w') as f:
+        json.dump(index, f, indent=1)
+
+    if print_fn is not None:
+        print_fn('[i] exported {:,} samples into {:,} shards in {}'.format(len(dataset), len(shards), out_dir))
+
+    return index
+
+def load_shard_index(shard_dir):
+    with open(os.path.join(shard_dir, INDEX_NAME)) as f:
+        return json.load(f)
+
+def iter_tar_samples(shard_path):
+    """Streams the samples of a shard as (meta, {path: payload}) with the payloads keyed by their original path."""
+    key, meta, payloads = None, None, {}
+
+    with tarfile.open(shard_path, 'r|') as tar:
+        for info in tar:
+            if not info.isfile():
+                continue
+
+            sample_key, suffix = info.name.split('.', 1)
+            payload = tar.extractfile(info).read()
+
+            if sample_key != key:
+                if meta is not None:
+                    yield meta, payloads
+                key, meta, payloads = sample_key, None, {}
+
+            if suffix == 'json':
+                meta = json.loads(payload.decode('utf-8'))
+            else:
+                stem = suffix.split('.')[0]
+                payloads[meta[MEMBER_FIELDS[stem[:-1]]][int(stem[-1])]] = payload
+
+    if meta is not None:
+        yield meta, payloads
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the Seruso datasets into tar shards for sequential streaming.")
+    parser.add_argument("--img_root", type=str, required=True, help="Image root (training/validation) or test set root.")
+    parser.add_argument("--flow_root", type=str, default=None, help="Optical flow root of the training/validation sets.")
+    parser.add_argument("--dstype", type=str, default='training', help="training, validation or test.")
+    parser.add_argument("--out_dir", type=str, required=True, help="Where to write the shards.")
+    parser.add_argument("--flow_format", type=str, default='mmap', help="How the flows are read (flo, mmap or shard).")
+    parser.add_argument("--shard_size_mb", type=int, default=1024, help="Approximate size of a shard.")
+    args = parser.parse_args()
+
+    import seruso_datasets
+
+    if args.dstype == 'test':
+        dataset = seruso_datasets.SerusoTestDataset(img_root = args.img_root, flow_format = args.flow_format)
+        export_tar_shards(dataset, args.out_dir, 'test', args.shard_size_mb)
+    else:
+        dataset = seruso_datasets.Seruso_three_classes_flow(img_root = args.img_root, flow_root = args.flow_root, dstype = args.dstype, flow_format = args.flow_format)
+        export_tar_shards(dataset, args.out_dir, 'train', args.shard_size_mb)
+
+if __name__ == "__main__":
+    main()
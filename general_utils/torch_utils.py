@@ -36,6 +36,18 @@ def L1_Loss(A_tensors, B_tensors):
 def L2_Loss(A_tensors, B_tensors):
     return torch.pow(A_tensors - B_tensors, 2)
 
+def selection_loss(loss_fn, A_tensors, B_tensors, labels):
+    """Reconstruction loss restricted to the classes of every sample, averaged over the batch.
+
+    Vectorised form of the loop over labels[b].nonzero(): the mean of loss_fn over the selected
+    channels and pixels of each sample [B, C, H, W], then over the samples (a sample without any
+    class counts as 0).
+    """
+    mask = (labels != 0).to(A_tensors.dtype)
+    per_channel = loss_fn(A_tensors, B_tensors).mean(dim=(2, 3))
+    per_sample = (per_channel * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+    return per_sample.mean()
+
 # ratio = 0.2, top=20%
 def Online_Hard_Example_Mining(values, ratio=0.2):
     b, c, h, w = values.size()
@@ -46,8 +58,8 @@ def shannon_entropy_loss(logits, activation=torch.sigmoid, epsilon=1e-5):
     return -torch.sum(v * torch.log(v+epsilon), dim=1).mean()
 
 def make_cam(y, epsilon=1e-5):
-    # relu(x) = max(x, 0)
-    x = F.relu(y)
+    # relu(x) = max(x, 0), in float32 with mixed precision
+    x = F.relu(y.float())
     
     b, c, h, w = x.size()
 
@@ -15,12 +15,16 @@ from general_utils.torch_utils import *
 from general_utils.cam_utils import *
 from general_utils.log_utils import *
 from general_utils.io_utils import *
+from general_utils.mask_cache import Packed_Mask
 from SAM_enhancement.sam_enhancer import SAME
 
 
 class Cam_generator_inference:
 
     def __init__(self, config, test_dataset, sam_enhance = False):
+        # Defaults of the optional settings
+        self.roi_crop = False
+
         # Set all attributes from the dictionary
         for key, value in config.items():
             setattr(self, key, value)
@@ -39,6 +43,10 @@ class Cam_generator_inference:
 
     def compute_iou(self, predicted_mask_binary, ground_truth_mask):
 
+        if isinstance(ground_truth_mask, Packed_Mask):
+            # bitwise ops and popcounts on the packed bits
+            return ground_truth_mask.iou(predicted_mask_binary)
+
         ground_truth_mask = np.array(ground_truth_mask)/255
         ground_truth_mask_binary = (ground_truth_mask > 0.5).astype(int)
 
@@ -68,6 +76,12 @@ class Cam_generator_inference:
 
         return iou
 
+    def get_roi(self, path, sample):
+        # with roi_crop, only the padded foreground box of the sample goes through the model (general_utils/fg_boxes.py)
+        if not self.roi_crop:
+            return None
+        return self.test_dataset.get_roi(path, (sample.shape[1], sample.shape[0]))
+
     def adjust_state_dict(self, state_dict, remove_module=False):
         """
         Adjust state dictionary keys to be compatible with single or multi-GPU setups.
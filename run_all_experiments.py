@@ -11,6 +11,10 @@ import seruso_datasets
 from torchvision import transforms
 from torch.utils.data import DataLoader
 from general_utils.augment_utils import *
+from general_utils.sampler_utils import SceneChunkSampler, get_scene_ids
+from general_utils.flow_pyramid import get_level_size
+from general_utils.rng_utils import worker_init_fn
+from general_utils.fg_boxes import get_index_path
 from POF_CAM.train_classification_with_POF_CAM import POF_CAM
 from Puzzle_CAM.train_classification_with_Puzzle_CAM import Puzzle_CAM
 from Standard_classifier.train_classification_with_standardClassifier import standardClassifier
@@ -35,6 +39,18 @@ def get_dataloaders(config):
 
     dataset_dir = config['dataset_dir']
     flow_dir = config['flow_dir']
+    flow_format = config.get('flow_format', 'mmap')
+    frame_cache_mb = config.get('frame_cache_mb', 0)
+    # frame/flow caches in /dev/shm shared by every run on the host (0 disables them)
+    shared_cache_kwargs = dict(shared_cache_mb = config.get('shared_cache_mb', 0), shared_flow_cache_mb = config.get('shared_flow_cache_mb', 0),
+                               shared_cache_dir = config.get('shared_cache_dir', None))
+    manifest_dir = config.get('manifest_dir', None)
+    # frames and flows cropped to the padded foreground box of the sample (boxes of general_utils/fg_boxes.py)
+    fg_box_dir = config.get('fg_box_dir', None)
+    roi_crop = config.get('roi_crop', False)
+    # JPEGs decoded at a reduced DCT scale that still covers input_size; the crops are taken from full-resolution frames
+    decode_size = 'auto' if config.get('draft_decode', True) and not roi_crop else None
+    frame_cache_resize = None if roi_crop else input_size
 
 
     train_transforms = [
@@ -44,29 +60,128 @@ def get_dataloaders(config):
     if 'colorjitter' in augment:
         train_transforms.append(transforms.ColorJitter(brightness=0.3, contrast=0.3, saturation=0.3, hue=0.1))
 
-    train_transform = transforms.Compose(train_transforms + \
-        [
+    if config.get('uint8_loader', False):
+        # uint8 CHW images, normalised by the trainers after collation (Batch_Normalize);
+        # RandomCrop(image_size) is dropped as it is the identity right after Resize(input_size)
+        train_transform = transforms.Compose(train_transforms + [To_Uint8_Tensor()])
+        test_transform = transforms.Compose([
+            transforms.Resize(input_size),
+            To_Uint8_Tensor()
+        ])
+
+    else:
+        train_transform = transforms.Compose(train_transforms + \
+            [
+                Normalize(imagenet_mean, imagenet_std),
+                RandomCrop(image_size),
+                Transpose()
+            ]
+        )
+        test_transform = transforms.Compose([
+
+            transforms.Resize(input_size),
             Normalize(imagenet_mean, imagenet_std),
             RandomCrop(image_size),
             Transpose()
-        ]
-    )
-    test_transform = transforms.Compose([
-
-        transforms.Resize(input_size),
-        Normalize(imagenet_mean, imagenet_std),
-        RandomCrop(image_size),
-        Transpose()
-    ])
+        ])
 
 
     # Remake the test tranform, right now using no augmentation
 
-    train_dataset = seruso_datasets.Seruso_three_classes_flow(img_root = dataset_dir, flow_root = flow_dir, dstype = 'training', transform = train_transform, augment = False)
-    val_dataset = seruso_datasets.Seruso_three_classes_flow(img_root = dataset_dir, flow_root = flow_dir, dstype = 'validation', transform = test_transform, augment = False)
-
-    train_loader = DataLoader(train_dataset, batch_size = batch_size, num_workers = num_workers, shuffle=True, drop_last=True)
-    validation_loader = DataLoader(val_dataset, batch_size = batch_size, num_workers = num_workers, shuffle=True, drop_last=True)
+    # workers are kept alive across epochs, batches are pinned for the asynchronous copies of the Prefetcher,
+    # each worker draws its augmentations from a stream derived from (seed, epoch, worker)
+    loader_kwargs = dict(batch_size = batch_size, num_workers = num_workers, drop_last = True,
+                         pin_memory = torch.cuda.is_available(), persistent_workers = num_workers > 0,
+                         worker_init_fn = worker_init_fn)
+    seed = config.get('seed', 0)
+
+    shard_dir = config.get('shard_dir', None)
+
+    # POF_CAM: clips of clip_length consecutive frames instead of triplets (null: triplets)
+    clip_length = config.get('clip_length', None)
+    assert shard_dir is None or (clip_length is None and not roi_crop)
+
+    if shard_dir is not None:
+        # samples streamed from the tar shards of general_utils.tar_shards (<shard_dir>/training, <shard_dir>/validation)
+        shuffle_buffer = config.get('shuffle_buffer', 256)
+
+        train_dataset = seruso_datasets.TarShardDataset(os.path.join(shard_dir, 'training'), transform = train_transform, augment = False, frame_cache_mb = frame_cache_mb,
+                                                        frame_cache_resize = input_size, decode_size = decode_size, shuffle_buffer = shuffle_buffer, seed = seed)
+        val_dataset = seruso_datasets.TarShardDataset(os.path.join(shard_dir, 'validation'), transform = test_transform, augment = False, frame_cache_mb = frame_cache_mb,
+                                                      frame_cache_resize = input_size, decode_size = decode_size, shuffle_buffer = shuffle_buffer, seed = seed)
+
+        train_loader = DataLoader(train_dataset, **loader_kwargs)
+        validation_loader = DataLoader(val_dataset, **loader_kwargs)
+
+        return train_loader, validation_loader, np.asarray(train_dataset.class_names)
+
+    # dataset_dir / flow_dir can also be lists of roots, concatenated (and optionally weighted) by CombinedDataset
+    dataset_dirs = dataset_dir if isinstance(dataset_dir, (list, tuple)) else [dataset_dir]
+    flow_dirs = flow_dir if isinstance(flow_dir, (list, tuple)) else [flow_dir] * len(dataset_dirs)
+    assert len(flow_dirs) == len(dataset_dirs)
+
+    # frames and flows pre-resized by general_utils/frame_store.py (<frame_store_dir>/training, <frame_store_dir>/validation)
+    frame_store_dir = config.get('frame_store_dir', None)
+    assert frame_store_dir is None or len(dataset_dirs) == 1
+
+    def get_frame_store(dstype):
+        return None if frame_store_dir is None else os.path.join(frame_store_dir, dstype)
+
+    def get_fg_boxes(dstype):
+        return None if fg_box_dir is None else get_index_path(fg_box_dir, dstype)
+
+    roi_kwargs = dict(roi_crop = roi_crop, roi_padding = config.get('roi_padding', 0.1))
+    assert not roi_crop or frame_store_dir is None
+
+    # flows stored at the CAM resolution of the backbone by general_utils/flow_pyramid.py (<flow_pyramid_dir>/training, ...)
+    flow_pyramid_dir = config.get('flow_pyramid_dir', None)
+    flow_size = get_level_size(image_size, config.get('flow_stride', 32))
+    assert flow_pyramid_dir is None or len(dataset_dirs) == 1
+    # the pyramid levels are already at the CAM resolution, too coarse to be cropped to the boxes
+    assert not roi_crop or flow_pyramid_dir is None
+
+    def get_flow_pyramid(dstype):
+        return None if flow_pyramid_dir is None else os.path.join(flow_pyramid_dir, dstype)
+
+    train_datasets, val_datasets = [], []
+    for img_root, flow_root in zip(dataset_dirs, flow_dirs):
+        train_datasets.append(seruso_datasets.Seruso_three_classes_flow(img_root = img_root, flow_root = flow_root, dstype = 'training', transform = train_transform, augment = False, flow_format = flow_format,
+                                                                        frame_cache_mb = frame_cache_mb, frame_cache_resize = frame_cache_resize, decode_size = decode_size, frame_store = get_frame_store('training'),
+                                                                        flow_pyramid = get_flow_pyramid('training'), flow_size = flow_size, seed = seed, clip_length = clip_length,
+                                                                        fg_boxes = get_fg_boxes('training'), manifest_dir = manifest_dir, **roi_kwargs, **shared_cache_kwargs))
+        val_datasets.append(seruso_datasets.Seruso_three_classes_flow(img_root = img_root, flow_root = flow_root, dstype = 'validation', transform = test_transform, augment = False, flow_format = flow_format,
+                                                                      frame_cache_mb = frame_cache_mb, frame_cache_resize = frame_cache_resize, decode_size = decode_size, frame_store = get_frame_store('validation'),
+                                                                      flow_pyramid = get_flow_pyramid('validation'), flow_size = flow_size, seed = seed, clip_length = clip_length,
+                                                                      fg_boxes = get_fg_boxes('validation'), manifest_dir = manifest_dir, **roi_kwargs, **shared_cache_kwargs))
+
+    dataset_weights = config.get('dataset_weights', None)
+
+    if len(train_datasets) == 1:
+        train_dataset, val_dataset = train_datasets[0], val_datasets[0]
+    else:
+        train_dataset = seruso_datasets.CombinedDataset(train_datasets, dataset_weights)
+        val_dataset = seruso_datasets.CombinedDataset(val_datasets)
+
+    sampler = config.get('sampler', 'random')
+    assert sampler in ['random', 'scene_chunk']
+    if sampler == 'scene_chunk' and dataset_weights is not None and len(train_datasets) > 1:
+        raise ValueError('sampler: scene_chunk cannot be combined with dataset_weights, the training sources are then drawn by weight')
+
+    if dataset_weights is not None and len(train_datasets) > 1:
+        # training sources drawn in proportion to dataset_weights
+        train_loader = DataLoader(train_dataset, sampler = train_dataset.get_sampler(), **loader_kwargs)
+        validation_loader = DataLoader(val_dataset, shuffle = True, **loader_kwargs)
+
+    elif sampler == 'scene_chunk':
+        # shuffled chunks of consecutive triplets of a scene, for frame cache hits and sequential reads
+        chunk_size = config.get('scene_chunk_size', 8)
+
+        train_loader = DataLoader(train_dataset, sampler = SceneChunkSampler(get_scene_ids(train_dataset.image_paths()), chunk_size, seed), **loader_kwargs)
+        validation_loader = DataLoader(val_dataset, sampler = SceneChunkSampler(get_scene_ids(val_dataset.image_paths()), chunk_size, seed), **loader_kwargs)
+
+    else:
+        train_loader = DataLoader(train_dataset, shuffle = True, **loader_kwargs)
+        validation_loader = DataLoader(val_dataset, shuffle = True, **loader_kwargs)
 
     class_names = np.asarray(train_dataset.class_names)
 
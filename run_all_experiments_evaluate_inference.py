@@ -6,6 +6,7 @@ import torch
 import seruso_datasets
 from torchvision import transforms
 from general_utils.augment_utils import *
+from general_utils.fg_boxes import get_index_path
 from POF_CAM.inference_cam_generation_POFCAM import POF_CAM_inference
 from Puzzle_CAM.inference_cam_generation_Puzzle_CAM import Puzzle_CAM_inference
 from Standard_classifier.inference_cam_generation_Standard_classifier import Std_classifier_inference
@@ -20,6 +21,9 @@ def get_dataloader(config):
     imagenet_std = config['imagenet_std']
     dataset_dir = config['dataset_dir']
     classes_subfolders = config['classes_subfolders']
+    # foreground boxes of the test set, for roi_crop (general_utils/fg_boxes.py --splits test)
+    fg_box_dir = config.get('fg_box_dir', None)
+    fg_boxes = None if fg_box_dir is None else get_index_path(fg_box_dir, 'test')
     
     input_size = (image_size, image_size)
     
@@ -29,7 +33,9 @@ def get_dataloader(config):
         Normalize(imagenet_mean, imagenet_std),
     ])
     
-    test_dataset = seruso_datasets.SerusoTestDataset(img_root = dataset_dir, classes_subfolders = classes_subfolders, transform= test_transform, with_flow = config['with_flows'], with_mask = True)
+    test_dataset = seruso_datasets.SerusoTestDataset(img_root = dataset_dir, classes_subfolders = classes_subfolders, transform= test_transform, with_flow = config['with_flows'], with_mask = True, flow_format = config.get('flow_format', 'mmap'),
+                                                    manifest_dir = config.get('manifest_dir', None), pack_masks = config.get('pack_masks', False), mask_cache_dir = config.get('mask_cache_dir', None),
+                                                    fg_boxes = fg_boxes, roi_padding = config.get('roi_padding', 0.1))
     
     return test_dataset
 
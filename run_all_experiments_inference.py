@@ -6,6 +6,7 @@ import torch
 import seruso_datasets
 from torchvision import transforms
 from general_utils.augment_utils import *
+from general_utils.fg_boxes import get_index_path
 from POF_CAM.inference_cam_generation_POFCAM import POF_CAM_inference
 from Puzzle_CAM.inference_cam_generation_Puzzle_CAM import Puzzle_CAM_inference
 from Standard_classifier.inference_cam_generation_Standard_classifier import Std_classifier_inference
@@ -20,7 +21,15 @@ def get_dataloader(config):
     imagenet_std = config['imagenet_std']
     dataset_dir = config['dataset_dir']
     flow_dir = config['flow_dir']
+    flow_format = config.get('flow_format', 'mmap')
+    manifest_dir = config.get('manifest_dir', None)
     classes_subfolders = config['classes_subfolders']
+    # foreground boxes of the splits, for roi_crop (general_utils/fg_boxes.py)
+    fg_box_dir = config.get('fg_box_dir', None)
+    roi_kwargs = dict(roi_padding = config.get('roi_padding', 0.1))
+
+    def get_fg_boxes(dstype):
+        return None if fg_box_dir is None else get_index_path(fg_box_dir, dstype)
     
     input_size = (image_size, image_size)
     
@@ -30,8 +39,10 @@ def get_dataloader(config):
         Normalize(imagenet_mean, imagenet_std),
     ])
     
-    train_dataset = seruso_datasets.Seruso_three_classes_flow(img_root = dataset_dir, flow_root = flow_dir, classes_subfolders = classes_subfolders, return_img_path = True, dstype = 'training', transform = test_transform, augment = False)
-    val_dataset = seruso_datasets.Seruso_three_classes_flow(img_root = dataset_dir, flow_root = flow_dir, classes_subfolders = classes_subfolders, return_img_path = True, dstype = 'validation', transform = test_transform, augment = False)
+    train_dataset = seruso_datasets.Seruso_three_classes_flow(img_root = dataset_dir, flow_root = flow_dir, classes_subfolders = classes_subfolders, return_img_path = True, dstype = 'training', transform = test_transform, augment = False, flow_format = flow_format, manifest_dir = manifest_dir,
+                                                              fg_boxes = get_fg_boxes('training'), **roi_kwargs)
+    val_dataset = seruso_datasets.Seruso_three_classes_flow(img_root = dataset_dir, flow_root = flow_dir, classes_subfolders = classes_subfolders, return_img_path = True, dstype = 'validation', transform = test_transform, augment = False, flow_format = flow_format, manifest_dir = manifest_dir,
+                                                            fg_boxes = get_fg_boxes('validation'), **roi_kwargs)
     
     class_names = np.asarray(train_dataset.class_names)
     
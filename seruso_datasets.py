@@ -1,8 +1,10 @@
 import os
+import io
 import cv2
+import bisect
 import math
-import random
 import glob
+import warnings
 import numpy as np
 import torch
 import torch.utils.data as data
@@ -16,6 +18,17 @@ from typing import Any, Callable, cast, Dict, List, Optional, Tuple, Union
 from PIL import Image
 
 from general_utils import frame_utils, torch_utils
+from general_utils.flow_shards import FlowShardReader
+from general_utils.frame_cache import LRU_Frame_Cache
+from general_utils.shared_frame_cache import Shared_Frame_Cache
+from general_utils.frame_store import Frame_Store
+from general_utils.flow_pyramid import Flow_Pyramid
+from general_utils.fg_boxes import Fg_Box_Index, pad_box, to_pixels
+from general_utils.mask_cache import GT_Mask_Cache, get_cache_name
+from general_utils.rng_utils import Worker_RNG
+from general_utils.manifest_utils import load_triplet_manifest
+from general_utils.sample_table import Sample_Table
+from general_utils.tar_shards import load_shard_index, iter_tar_samples
 from general_utils.augment_utils import *
 from imageio import imread
 
@@ -29,6 +42,26 @@ def pil_loader(path: str) -> Image.Image:
         img = Image.open(f)
         return img.convert("RGB")
 
+def flow_to_tensor(flow, negate = False):
+    # Single copy from a (possibly memory-mapped, read-only) HWC flow into a contiguous CHW float32 tensor
+    if flow.dtype != np.float32 or not flow.dtype.isnative or any(stride < 0 for stride in flow.strides):
+        flow = np.ascontiguousarray(flow, dtype=np.float32)
+
+    h, w, c = flow.shape
+    out = torch.empty((c, h, w), dtype=torch.float32)
+
+    with warnings.catch_warnings():
+        # torch warns about non-writable arrays; the source view is only read
+        warnings.simplefilter('ignore', UserWarning)
+        src = torch.from_numpy(flow).permute(2, 0, 1)
+
+    if negate:
+        torch.neg(src, out=out)
+    else:
+        out.copy_(src)
+
+    return out
+
 class Iterator:
     def __init__(self, loader):
         self.loader = loader
@@ -48,26 +81,102 @@ class Iterator:
 
 
 class CombinedDataset(data.Dataset):
-    def __init__(self, datasets):
-        self.datasets = datasets
+    """Concatenation of several datasets sharing the same classes (e.g. several dataset roots).
+
+    An index is mapped to its source with a bisect over the cumulative sizes. weights gives the
+    relative sampling weight of each source (as a whole, whatever its size) and is used by
+    get_sampler(); without weights every sample is equally likely, as with shuffle=True.
+    """
+    def __init__(self, datasets, weights = None):
+        self.datasets = list(datasets)
+        self.weights = None if weights is None else [float(weight) for weight in weights]
+
+        if self.weights is not None and len(self.weights) != len(self.datasets):
+            raise ValueError('Expected {} source weights, got {}'.format(len(self.datasets), len(self.weights)))
+
+        for dataset in self.datasets[1:]:
+            if list(dataset.class_names) != list(self.datasets[0].class_names):
+                raise ValueError('Combined datasets must have the same classes: {} vs {}'.format(dataset.class_names, self.datasets[0].class_names))
+
+        self.cumulative_sizes = np.cumsum([len(dataset) for dataset in self.datasets]).tolist()
+
+        # the sources draw from a single stream per worker
+        self.rng = self.datasets[0].rng
+        for dataset in self.datasets:
+            dataset.rng = self.rng
+
+    @property
+    def class_names(self):
+        return self.datasets[0].class_names
 
     def __len__(self):
-        length = 0 
-        for i in range(len(self.datasets)):
-            length += len(self.datsaets[i])
-        return length
+        return self.cumulative_sizes[-1] if self.cumulative_sizes else 0
+
+    def get_source(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('index {} out of range for {} samples'.format(index, len(self)))
+
+        dataset_index = bisect.bisect_right(self.cumulative_sizes, index)
+        start = self.cumulative_sizes[dataset_index - 1] if dataset_index > 0 else 0
+        return dataset_index, index - start
 
     def __getitem__(self, index):
-        i = 0
-        for j in range(len(self.datasets)):
-            if i + len(self.datasets[j]) >= index:
-                yield self.datasets[j][index-i]
-                break
-            i += len(self.datasets[j])
+        dataset_index, sample_index = self.get_source(index)
+        return self.datasets[dataset_index][sample_index]
 
     def __add__(self, other):
-        self.datasets.append(other)
-        return self
+        weights = None if self.weights is None else self.weights + [1.]
+        return CombinedDataset(self.datasets + [other], weights)
+
+    def sample_weights(self):
+        weights = self.weights if self.weights is not None else [len(dataset) for dataset in self.datasets]
+        return np.concatenate([np.full(len(dataset), weight / max(len(dataset), 1)) for dataset, weight in zip(self.datasets, weights)])
+
+    def get_sampler(self, num_samples = None, generator = None):
+        # samples with replacement, each source being drawn in proportion to its weight
+        return data.WeightedRandomSampler(torch.from_numpy(self.sample_weights()), len(self) if num_samples is None else num_samples,
+                                          replacement = True, generator = generator)
+
+    def image_paths(self):
+        return [path for dataset in self.datasets for path in dataset.image_paths()]
+
+    def set_epoch(self, epoch):
+        self.rng.set_epoch(epoch)
+
+    def do_it_with_flows(self):
+        for dataset in self.datasets:
+            dataset.do_it_with_flows()
+
+    def do_it_without_flows(self):
+        for dataset in self.datasets:
+            dataset.do_it_without_flows()
+
+    def get_whith_flows_bool(self):
+        return self.datasets[0].get_whith_flows_bool()
+
+    def frame_cache_stats(self):
+        # hits and misses of every worker, summed over the sources
+        counts = {}
+        for dataset in self.datasets:
+            for stats in dataset.frame_cache_stats():
+                hits, misses = counts.get(stats['worker'], (0, 0))
+                counts[stats['worker']] = (hits + stats['hits'], misses + stats['misses'])
+
+        return [{'worker' : worker, 'hits' : hits, 'misses' : misses, 'hit_rate' : hits / (hits + misses)} for worker, (hits, misses) in sorted(counts.items())]
+
+    def reset_frame_cache_stats(self):
+        for dataset in self.datasets:
+            dataset.reset_frame_cache_stats()
+
+
+def get_frames_region_name(frame_cache_resize, decode_size):
+    if frame_cache_resize is not None:
+        return 'frames_{}x{}'.format(*frame_cache_resize)
+    if decode_size is not None:
+        return 'frames_draft_{}x{}'.format(*decode_size)
+    return 'frames_full'
 
 
 class CamFlowDataset(data.Dataset):
@@ -77,7 +186,33 @@ class CamFlowDataset(data.Dataset):
                  augment = False,
                  return_path = False, 
                  return_img_path = False, 
-                 with_flow = False):
+                 with_flow = False,
+                 flow_format = 'mmap',
+                 frame_cache_mb = 0,
+                 frame_cache_resize = None,
+                 decode_size = 'auto',
+                 frame_store = None,
+                 shared_cache_mb = 0,
+                 shared_flow_cache_mb = 0,
+                 shared_cache_dir = None,
+                 flow_pyramid = None,
+                 flow_size = None,
+                 seed = 0,
+                 clip_length = None,
+                 fg_boxes = None,
+                 roi_crop = False,
+                 roi_padding = 0.1):
+
+        assert flow_format in ['flo', 'mmap', 'shard']
+
+        if roi_crop and fg_boxes is None:
+            raise ValueError('roi_crop needs the foreground boxes of general_utils/fg_boxes.py (fg_boxes)')
+
+        if roi_crop and flow_pyramid is not None:
+            raise ValueError('roi_crop crops the full-resolution flows, it cannot be used with a flow pyramid (flow_pyramid)')
+
+        if clip_length is not None and (clip_length < 3 or augment):
+            raise ValueError('Clips need at least 3 frames and no per-sample augmentation (use batch_augment), got clip_length={}'.format(clip_length))
 
         self.return_path = return_path
         self.return_img_path = return_img_path
@@ -91,33 +226,162 @@ class CamFlowDataset(data.Dataset):
         self.flow_list = []
         self.label_list = []
         self.with_flows = with_flow
+        self.flow_format = flow_format
+        self.flow_shard_reader = FlowShardReader() if flow_format == 'shard' else None
+
+        # With clip_length, a sample with flows is a clip of clip_length consecutive frames and the
+        # clip_length - 1 forward flows between them (flow i: frame i -> frame i + 1, not negated)
+        self.clip_length = clip_length
+
+        # augmentations draw from per-worker streams derived from (seed, epoch, worker), see set_epoch
+        self.rng = Worker_RNG(seed)
+
+        # Frames of a triplet are shared with the two neighbouring triplets, so decoded frames are
+        # kept in a per-worker LRU cache; frame_cache_resize=(w, h) stores them already resized
+        self.frame_cache = LRU_Frame_Cache(frame_cache_mb * 1024 * 1024) if frame_cache_mb > 0 else None
+        self.frame_cache_resize = None if frame_cache_resize is None else tuple(frame_cache_resize)
+
+        # JPEG frames are decoded at the smallest DCT scale still covering decode_size=(w, h);
+        # 'auto' takes the size of the leading transforms.Resize (or of the cached frames)
+        if decode_size == 'auto':
+            decode_size = self.frame_cache_resize if self.frame_cache_resize is not None else frame_utils.get_decode_size(transform)
+        self.decode_size = decode_size
+
+        # With shared_cache_mb, frames go to a single cache in /dev/shm used by the workers of every
+        # run on the host instead (general_utils/shared_frame_cache.py); its slots have the size of
+        # the first frame stored, hence one region per frame resolution. Flows likewise.
+        if shared_cache_mb > 0:
+            self.frame_cache = Shared_Frame_Cache(get_frames_region_name(self.frame_cache_resize, self.decode_size), shared_cache_mb, shared_cache_dir)
+        self.flow_cache = Shared_Frame_Cache('flows', shared_flow_cache_mb, shared_cache_dir) if shared_flow_cache_mb > 0 else None
+
+        # Frames and flows already resized to the training resolution (general_utils/frame_store.py):
+        # frames are sliced out of a memory-mapped array instead of being decoded
+        self.frame_store = Frame_Store(frame_store) if frame_store is not None else None
+        if self.frame_store is not None and frame_utils.get_decode_size(transform) not in [None, self.frame_store.size]:
+            raise ValueError('Frame store {} holds {}x{} frames, the transform resizes to {}x{}'.format(frame_store, *self.frame_store.size, *frame_utils.get_decode_size(transform)))
+        if self.frame_store is not None and self.frame_store.draft_decode != (self.decode_size is not None):
+            raise ValueError('Frame store {} holds {} decodes, rebuild it with the draft_decode setting of the run'.format(frame_store, 'draft' if self.frame_store.draft_decode else 'full'))
+
+        # Flows already at the CAM resolution flow_size=(w, h) (general_utils/flow_pyramid.py)
+        self.flow_pyramid = Flow_Pyramid(flow_pyramid, flow_size) if flow_pyramid is not None else None
+        self.flow_size = None if flow_size is None else tuple(flow_size)
+
+        # Foreground boxes of the frames (general_utils/fg_boxes.py); with roi_crop, the frames and flows
+        # of a sample are cropped to the padded union box of its frames before the transform
+        self.fg_boxes = Fg_Box_Index(fg_boxes) if fg_boxes is not None else None
+        self.roi_crop = roi_crop
+        self.roi_padding = roi_padding
 
     def get_image(self, image_path):
         image = Image.open(image_path).convert('RGB')
         return image
 
+    def open_frame(self, image_path):
+        if self.frame_store is not None:
+            return Image.fromarray(self.frame_store.frame(image_path))
+        return frame_utils.draft_image(frame_utils.read_gen(image_path), self.decode_size)
+
+    def decode_frame(self, image_path):
+        image = self.open_frame(image_path).convert('RGB')
+        if self.frame_cache_resize is not None and image.size != self.frame_cache_resize:
+            image = image.resize(self.frame_cache_resize, Image.BILINEAR)
+        return image
+
+    def load_frame(self, image_path):
+        if self.frame_cache is None or self.frame_store is not None:
+            return self.open_frame(image_path)
+        return self.frame_cache.get(image_path, self.decode_frame)
+
+    def image_paths(self):
+        # path of the central frame of every sample
+        return [images[1] for images in self.image_list]
+
+    def frame_cache_stats(self):
+        if self.frame_cache is None:
+            return []
+        return self.frame_cache.stats()
+
+    def reset_frame_cache_stats(self):
+        if self.frame_cache is not None:
+            self.frame_cache.reset_stats()
+
+    def read_flow(self, flow_path):
+        # (h, w, 2) flow, possibly a read-only view
+        if self.flow_pyramid is not None:
+            return self.flow_pyramid.flow(flow_path)
+
+        if self.frame_store is not None:
+            return self.frame_store.flow(flow_path)
+
+        if self.flow_format == 'mmap':
+            return frame_utils.read_flow_mmap(flow_path)
+
+        if self.flow_format == 'shard':
+            return self.flow_shard_reader.read(flow_path)
+
+        return np.array(frame_utils.read_gen(flow_path)).astype(np.float32)
+
+    def load_flow(self, flow_path, negate = False):
+        if self.flow_cache is None or self.frame_store is not None or self.flow_pyramid is not None:
+            return flow_to_tensor(self.read_flow(flow_path), negate = negate)
+        return flow_to_tensor(self.flow_cache.get(flow_path, self.read_flow), negate = negate)
+
+    def get_roi_box(self, image_paths):
+        # padded foreground box of a frame, a triplet (stored union) or a clip
+        if len(image_paths) == 1:
+            box = self.fg_boxes.frame_box(image_paths[0])
+        elif len(image_paths) == 3:
+            box = self.fg_boxes.triplet_box(image_paths[1])
+        else:
+            box = self.fg_boxes.union(image_paths)
+        return pad_box(box, self.roi_padding)
+
+    def get_roi(self, image_path, size):
+        """(x0, y0, x1, y1) padded foreground box of a sample in pixels of a size=(w, h) frame, None without fg_boxes."""
+        if self.fg_boxes is None:
+            return None
+        box = self.fg_boxes.triplet_box(image_path) if self.with_flows else self.fg_boxes.frame_box(image_path)
+        return to_pixels(pad_box(box, self.roi_padding), size)
+
+    def crop_frame(self, image, box):
+        return image.crop(to_pixels(box, image.size))
+
+    def crop_flow(self, flow, box):
+        # (2, h, w) flow cropped and resized to flow_size (or back to its size), vectors in the new pixels
+        _, h, w = flow.shape
+        x0, y0, x1, y1 = to_pixels(box, (w, h))
+        out_w, out_h = self.flow_size if self.flow_size is not None else (w, h)
+
+        flow = torch.nn.functional.interpolate(flow[None, :, y0:y1, x0:x1], size = (out_h, out_w), mode = 'bilinear', align_corners = False)[0]
+        flow[0] *= out_w / (x1 - x0)
+        flow[1] *= out_h / (y1 - y0)
+        return flow
+
     def __getitem__(self, index):
 
-        np.random.seed()
+        rng = self.rng.get()
 
         if index!=(index % len(self.image_list)): assert NotImplementedError
         
         index = index % len(self.image_list)
 
+        if self.with_flows and self.clip_length is not None:
+            return self.get_clip(index)
+
         if self.with_flows:
 
-            img1 = frame_utils.read_gen(self.image_list[index][0])
-            img2 = frame_utils.read_gen(self.image_list[index][1])
-            img3 = frame_utils.read_gen(self.image_list[index][2])
+            img1 = self.load_frame(self.image_list[index][0])
+            img2 = self.load_frame(self.image_list[index][1])
+            img3 = self.load_frame(self.image_list[index][2])
 
-            flow1 = frame_utils.read_gen(self.flow_list[index][0])
-            flow2 = frame_utils.read_gen(self.flow_list[index][1])
+            flow1 = self.load_flow(self.flow_list[index][0], negate = True)
+            flow2 = self.load_flow(self.flow_list[index][1])
 
-            flow1 = -np.array(flow1).astype(np.float32)
-            flow2 = np.array(flow2).astype(np.float32)
-            
-            flow1 = torch.from_numpy(flow1).permute(2, 0, 1).float()
-            flow2 = torch.from_numpy(flow2).permute(2, 0, 1).float()
+            if self.roi_crop:
+                # the same box for the three frames and the two flows
+                box = self.get_roi_box(self.image_list[index])
+                img1, img2, img3 = [self.crop_frame(img, box) for img in (img1, img2, img3)]
+                flow1, flow2 = [self.crop_flow(flow, box) for flow in (flow1, flow2)]
 
         
             label = torch_utils.one_hot_embedding(self.class_dic[self.label_list[index]], self.classes)
@@ -131,9 +395,9 @@ class CamFlowDataset(data.Dataset):
 
                 for i in range (3):
 
-                    horizontal_flips.append(random.getrandbits(1))
-                    vertical_flips.append(random.getrandbits(1))
-                    rotation_degrees.append(random.randint(-90,90))
+                    horizontal_flips.append(int(rng.integers(2)))
+                    vertical_flips.append(int(rng.integers(2)))
+                    rotation_degrees.append(int(rng.integers(-90, 91)))
 
                 params = [horizontal_flips, vertical_flips, rotation_degrees]
                 
@@ -165,7 +429,10 @@ class CamFlowDataset(data.Dataset):
         
         else:
 
-            img = frame_utils.read_gen(self.image_list[index][1])
+            img = self.load_frame(self.image_list[index][1])
+
+            if self.roi_crop:
+                img = self.crop_frame(img, self.get_roi_box(self.image_list[index][1:2]))
 
             if self.transform is not None:
                 img = self.transform(img)
@@ -179,12 +446,33 @@ class CamFlowDataset(data.Dataset):
                 return img, label
 
 
+    def get_clip(self, index):
+        images = [self.load_frame(image_path) for image_path in self.image_list[index]]
+        flows = [self.load_flow(flow_path) for flow_path in self.flow_list[index]]
+
+        if self.roi_crop:
+            box = self.get_roi_box(self.image_list[index])
+            images = [self.crop_frame(image, box) for image in images]
+            flows = [self.crop_flow(flow, box) for flow in flows]
+
+        images = [self.transform(image) for image in images]
+
+        if self.return_img_path:
+            return images, flows, self.image_list[index][1]
+
+        label = torch_utils.one_hot_embedding(self.class_dic[self.label_list[index]], self.classes)
+        return images, flows, label
+
     def __len__(self):
         return len(self.image_list)
 
-    def __add(self, other):
+    def __add__(self, other):
         return CombinedDataset([self, other])
 
+    def set_epoch(self, epoch):
+        # called by the main process between epochs (Prefetcher), the workers reseed on their next sample
+        self.rng.set_epoch(epoch)
+
     def do_it_with_flows(self):
         self.with_flows = True
     
@@ -205,9 +493,30 @@ class Seruso_three_classes_flow(CamFlowDataset):
                  augment = False,
                  loader: Callable[[str], Any] = pil_loader,
                  return_img_path = False, 
-                 with_flow = False):
+                 with_flow = False,
+                 flow_format = 'mmap',
+                 frame_cache_mb = 0,
+                 frame_cache_resize = None,
+                 decode_size = 'auto',
+                 frame_store = None,
+                 shared_cache_mb = 0,
+                 shared_flow_cache_mb = 0,
+                 shared_cache_dir = None,
+                 flow_pyramid = None,
+                 flow_size = None,
+                 seed = 0,
+                 clip_length = None,
+                 fg_boxes = None,
+                 roi_crop = False,
+                 roi_padding = 0.1,
+                 manifest_dir = None):
         
-        super(Seruso_three_classes_flow, self).__init__(transform = transform, augment = augment, loader = loader, return_img_path = return_img_path, with_flow = with_flow)
+        super(Seruso_three_classes_flow, self).__init__(transform = transform, augment = augment, loader = loader, return_img_path = return_img_path, with_flow = with_flow, flow_format = flow_format,
+                                                        frame_cache_mb = frame_cache_mb, frame_cache_resize = frame_cache_resize, decode_size = decode_size,
+                                                        frame_store = frame_store, shared_cache_mb = shared_cache_mb, shared_flow_cache_mb = shared_flow_cache_mb,
+                                                        shared_cache_dir = shared_cache_dir, flow_pyramid = flow_pyramid, flow_size = flow_size,
+                                                        seed = seed, clip_length = clip_length, fg_boxes = fg_boxes, roi_crop = roi_crop,
+                                                        roi_padding = roi_padding)
 
         self.img_root = img_root
         self.dstype = dstype
@@ -215,7 +524,6 @@ class Seruso_three_classes_flow(CamFlowDataset):
         img_dir = dstype 
         assert(os.path.isdir(os.path.join(self.img_root,img_dir)))
 
-        images = []
         self.class_names = []
         self.class_dic = {}
 
@@ -226,45 +534,24 @@ class Seruso_three_classes_flow(CamFlowDataset):
             self.class_names.append(class_name)
             self.class_dic[class_name] = len(self.class_dic)
 
-            for rel_frame_dir in sorted(glob(os.path.join(img_root, img_dir, class_name,'*','*.jpg'))):
-                    
-                rel_frame_dir = os.path.relpath(rel_frame_dir,os.path.join(img_root, img_dir, class_name))
-                scene_dir, filename = os.path.split(rel_frame_dir)
-                no_ext_filename = os.path.splitext(filename)[0]
-                prefix, frame_nb = no_ext_filename.split('_')
-                frame_nb = int(frame_nb)
-                img1 = os.path.join(img_dir, class_name, scene_dir, '{}_{:04d}.jpg'.format(prefix, frame_nb))
-                img2 = os.path.join(img_dir, class_name, scene_dir, '{}_{:04d}.jpg'.format(prefix, frame_nb + 1))
-                img3 = os.path.join(img_dir, class_name, scene_dir, '{}_{:04d}.jpg'.format(prefix, frame_nb + 2))
-                flow1 = os.path.join(img_dir, class_name, scene_dir, '{}_{:04d}.flo'.format(prefix, frame_nb))
-                flow2 = os.path.join(img_dir, class_name, scene_dir, '{}_{:04d}.flo'.format(prefix, frame_nb + 1))
-
-                if (os.path.isfile(os.path.join(img_root,img1)) and os.path.isfile(os.path.join(img_root,img2)) and os.path.isfile(os.path.join(img_root,img3))):
-                    images.append([[img1, img2, img3], [flow1, flow2], class_name])
-        
-        self.classes = len(self.class_dic)
-
-        # Use split2list just to ensure the same data structure; actually we do not split here
-        tbd_list, _ = split2list(images, split=1.1, default_split=1.1,order=True)
-
-        self.image_list = []
-        self.flow_list = []
-        self.label_list = []
-
-        for i in range(len(tbd_list)):
+        # Complete triplets of every scene, cached on disk when manifest_dir is given
+        self.manifest = load_triplet_manifest(os.path.join(img_root, img_dir), self.class_names, manifest_dir = manifest_dir)
 
-            im1 = os.path.join(img_root,tbd_list[i][0][0])
-            im2 = os.path.join(img_root,tbd_list[i][0][1])
-            im3 = os.path.join(img_root,tbd_list[i][0][2])
-
-            flo1 = os.path.join(flow_root,tbd_list[i][1][0])
-            flo2 = os.path.join(flow_root,tbd_list[i][1][1])
+        self.classes = len(self.class_dic)
 
-            label_name = tbd_list[i][2]
+        # Paths are rebuilt on demand from NumPy arrays, nothing per sample is a Python object
+        self.sample_table = Sample_Table(self.manifest, {'image' : os.path.join(img_root, img_dir), 'flow' : os.path.join(flow_root, img_dir)})
 
-            self.image_list.append([im1, im2, im3])
-            self.flow_list.append([flo1, flo2])
-            self.label_list.append(label_name)
+        if clip_length is None:
+            self.image_list = self.sample_table.paths('image', 3, '.jpg')
+            self.flow_list = self.sample_table.paths('flow', 2, '.flo')
+            self.label_list = self.sample_table.labels()
+        else:
+            # samples are clips tiling the triplets of every scene
+            clip_starts = self.sample_table.clip_starts(clip_length)
+            self.image_list = self.sample_table.paths('image', clip_length, '.jpg', clip_starts)
+            self.flow_list = self.sample_table.paths('flow', clip_length - 1, '.flo', clip_starts)
+            self.label_list = self.sample_table.labels(clip_starts)
 
 
 class SerusoTestDataset(CamFlowDataset):
@@ -275,9 +562,21 @@ class SerusoTestDataset(CamFlowDataset):
                  loader: Callable[[str], Any] = pil_loader,
                  return_img_path = True, 
                  with_flow = False,
-                 with_mask = False):
+                 with_mask = False,
+                 flow_format = 'mmap',
+                 frame_cache_mb = 0,
+                 frame_cache_resize = None,
+                 decode_size = 'auto',
+                 manifest_dir = None,
+                 pack_masks = False,
+                 mask_cache_dir = None,
+                 seed = 0,
+                 fg_boxes = None,
+                 roi_padding = 0.1):
                
-        super(SerusoTestDataset, self).__init__(transform = transform, loader = loader, with_flow = with_flow)
+        super(SerusoTestDataset, self).__init__(transform = transform, loader = loader, with_flow = with_flow, flow_format = flow_format,
+                                                frame_cache_mb = frame_cache_mb, frame_cache_resize = frame_cache_resize, decode_size = decode_size,
+                                                seed = seed, fg_boxes = fg_boxes, roi_padding = roi_padding)
     
         self.transform = transform
         self.img_root = img_root
@@ -286,7 +585,6 @@ class SerusoTestDataset(CamFlowDataset):
 
         assert(os.path.isdir(os.path.join(self.img_root)))
 
-        images = []
         
         self.class_names = []
         self.class_dic = {}
@@ -296,51 +594,30 @@ class SerusoTestDataset(CamFlowDataset):
             self.class_names.append(class_name)
             self.class_dic[class_name] = len(self.class_dic)
 
-            if class_name in classes_subfolders:
-
-                for rel_frame_dir in sorted(glob(os.path.join(img_root, "images", class_name,'*','*.jpg'))):
-                        
-                    rel_frame_dir = os.path.relpath(rel_frame_dir,os.path.join(img_root, "images", class_name))
-                    scene_dir, filename = os.path.split(rel_frame_dir)
-                    no_ext_filename = os.path.splitext(filename)[0]
-                    prefix, frame_nb = no_ext_filename.split('_')
-                    frame_nb = int(frame_nb)
-                    img1 = os.path.join("images", class_name, scene_dir, '{}_{:04d}.jpg'.format(prefix, frame_nb))
-                    img2 = os.path.join("images", class_name, scene_dir, '{}_{:04d}.jpg'.format(prefix, frame_nb + 1))
-                    img3 = os.path.join("images", class_name, scene_dir, '{}_{:04d}.jpg'.format(prefix, frame_nb + 2))
-                    flow1 = os.path.join("optical_flows", class_name, scene_dir, '{}_{:04d}.flo'.format(prefix, frame_nb))
-                    flow2 = os.path.join("optical_flows", class_name, scene_dir, '{}_{:04d}.flo'.format(prefix, frame_nb + 1))
-                    mask1 = os.path.join("masks", class_name, scene_dir, '{}_{:04d}.jpg'.format(prefix, frame_nb))
-                    mask2 = os.path.join("masks", class_name, scene_dir, '{}_{:04d}.jpg'.format(prefix, frame_nb + 1))
-                    mask3 = os.path.join("masks", class_name, scene_dir, '{}_{:04d}.jpg'.format(prefix, frame_nb + 2))
-
-                    if (os.path.isfile(os.path.join(img_root,img1)) and os.path.isfile(os.path.join(img_root,img2)) and os.path.isfile(os.path.join(img_root,img3))):
-                        images.append([[img1, img2, img3], [flow1, flow2], [mask1, mask2, mask3]])
-
-
-        # Use split2list just to ensure the same data structure; actually we do not split here
-        tbd_list, _ = split2list(images, split=1.1, default_split=1.1,order=True)
-
-        self.image_list = []
-        self.mask_list = []
-        self.flow_list = []
+        scanned_classes = [class_name for class_name in self.class_names if class_name in classes_subfolders]
 
-        for i in range(len(tbd_list)):
+        # Complete triplets of every scene, cached on disk when manifest_dir is given
+        self.manifest = load_triplet_manifest(os.path.join(img_root, "images"), scanned_classes, manifest_dir = manifest_dir)
 
-            im1 = os.path.join(img_root,tbd_list[i][0][0])
-            im2 = os.path.join(img_root,tbd_list[i][0][1])
-            im3 = os.path.join(img_root,tbd_list[i][0][2])
+        # Paths are rebuilt on demand from NumPy arrays, nothing per sample is a Python object
+        self.sample_table = Sample_Table(self.manifest, {'image' : os.path.join(img_root, "images"), 'flow' : os.path.join(img_root, "optical_flows"),
+                                                         'mask' : os.path.join(img_root, "masks")})
 
-            flo1 = os.path.join(img_root,tbd_list[i][1][0])
-            flo2 = os.path.join(img_root,tbd_list[i][1][1])
+        self.image_list = self.sample_table.paths('image', 3, '.jpg')
+        self.flow_list = self.sample_table.paths('flow', 2, '.flo')
+        self.mask_list = self.sample_table.paths('mask', 3, '.jpg')
 
-            msk1 = os.path.join(img_root,tbd_list[i][2][0])
-            msk2 = os.path.join(img_root,tbd_list[i][2][1])
-            msk3 = os.path.join(img_root,tbd_list[i][2][2])
+        # Ground-truth masks decoded once at the evaluation resolution and kept as packed bits
+        # (general_utils/mask_cache.py); with mask_cache_dir, all of them are decoded up front and saved
+        # (the masks whose file changed since are decoded again)
+        self.mask_cache = None
+        if pack_masks or mask_cache_dir is not None:
+            cache_path = None if mask_cache_dir is None else os.path.join(mask_cache_dir, get_cache_name(frame_utils.get_decode_size(transform)))
+            self.mask_cache = GT_Mask_Cache(cache_path)
 
-            self.image_list.append([im1, im2, im3])
-            self.flow_list.append([flo1, flo2])
-            self.mask_list.append([msk1, msk2, msk3])
+            if mask_cache_dir is not None and with_mask:
+                self.mask_cache.build(set(path for paths in self.mask_list for path in paths), self.decode_mask)
+                self.mask_cache.save()
 
 
     def get_mask(self, mask_path):
@@ -349,9 +626,21 @@ class SerusoTestDataset(CamFlowDataset):
 
         return mask
 
+    def decode_mask(self, mask_path):
+        mask = self.get_mask(mask_path)
+        if self.transform is not None:
+            mask = self.transform.transforms[0](mask)
+        return mask
+
+    def load_mask(self, mask_path):
+        # PIL mask, or Packed_Mask with the mask cache
+        if self.mask_cache is None:
+            return self.decode_mask(mask_path)
+        return self.mask_cache.get(mask_path, self.decode_mask)
+
     def __getitem__(self, index):
 
-        np.random.seed()
+        self.rng.get()
 
         if index!=(index % len(self.image_list)): assert NotImplementedError
         
@@ -359,18 +648,12 @@ class SerusoTestDataset(CamFlowDataset):
 
         if self.with_flows:
 
-            img1 = frame_utils.read_gen(self.image_list[index][0])
-            img2 = frame_utils.read_gen(self.image_list[index][1])
-            img3 = frame_utils.read_gen(self.image_list[index][2])
-
-            flow1 = frame_utils.read_gen(self.flow_list[index][0])
-            flow2 = frame_utils.read_gen(self.flow_list[index][1])
+            img1 = self.load_frame(self.image_list[index][0])
+            img2 = self.load_frame(self.image_list[index][1])
+            img3 = self.load_frame(self.image_list[index][2])
 
-            flow1 = np.array(flow1).astype(np.float32)
-            flow2 = np.array(flow2).astype(np.float32)
-            
-            flow1 = torch.from_numpy(flow1).permute(2, 0, 1).float()
-            flow2 = torch.from_numpy(flow2).permute(2, 0, 1).float()
+            flow1 = self.load_flow(self.flow_list[index][0])
+            flow2 = self.load_flow(self.flow_list[index][1])
 
             
             if self.transform is not None:            
@@ -380,15 +663,9 @@ class SerusoTestDataset(CamFlowDataset):
 
             if self.with_mask:
 
-                mask1 = self.get_mask(self.mask_list[index][0]) 
-                mask2 = self.get_mask(self.mask_list[index][1])
-                mask3 = self.get_mask(self.mask_list[index][2])
-
-                if self.transform is not None:
-
-                    mask1 = self.transform.transforms[0](mask1)
-                    mask2 = self.transform.transforms[0](mask2)
-                    mask3 = self.transform.transforms[0](mask3)
+                mask1 = self.load_mask(self.mask_list[index][0]) 
+                mask2 = self.load_mask(self.mask_list[index][1])
+                mask3 = self.load_mask(self.mask_list[index][2])
 
                 if self.return_img_path:
                     return [img1, img2, img3], [flow1, flow2], [mask1, mask2, mask3], self.image_list[index][1]
@@ -404,17 +681,14 @@ class SerusoTestDataset(CamFlowDataset):
         
         else:
             
-            img = frame_utils.read_gen(self.image_list[index][1])
+            img = self.load_frame(self.image_list[index][1])
 
             if self.transform is not None:
                 img = self.transform(img)                
 
             if self.with_mask:
 
-                mask = self.get_mask(self.mask_list[index][1])
-
-                if self.transform is not None:
-                    mask = self.transform.transforms[0](mask)
+                mask = self.load_mask(self.mask_list[index][1])
             
                 if self.return_img_path:
                     return img, mask, self.image_list[index][1]
@@ -431,6 +705,169 @@ class SerusoTestDataset(CamFlowDataset):
         return self.with_mask
 
 
+class TarSampleMixin:
+    """Serves one sample streamed from a tar shard through the regular __getitem__ of a dataset.
+
+    The payloads are keyed by the original paths, so the path lists, the frame cache and the
+    returned image paths are exactly the ones of the exported dataset.
+    """
+    def set_sample(self, meta, payloads):
+        self.payloads = payloads
+        self.image_list = [meta['images']]
+        self.flow_list = [meta['flows']]
+        self.label_list = [meta['label']]
+        self.mask_list = [meta['masks']]
+
+    def open_frame(self, image_path):
+        return frame_utils.draft_image(Image.open(io.BytesIO(self.payloads[image_path])), self.decode_size)
+
+    def read_flow(self, flow_path):
+        return frame_utils.flow_from_bytes(self.payloads[flow_path])
+
+    def get_mask(self, mask_path):
+        return Image.open(io.BytesIO(self.payloads[mask_path])).convert("L")
+
+
+class TarTrainSamples(TarSampleMixin, CamFlowDataset):
+    def __init__(self, class_names, **kwargs):
+        CamFlowDataset.__init__(self, loader = pil_loader, **kwargs)
+
+        self.class_names = list(class_names)
+        self.class_dic = {class_name: i for i, class_name in enumerate(self.class_names)}
+        self.classes = len(self.class_dic)
+
+
+class TarTestSamples(TarSampleMixin, SerusoTestDataset):
+    def __init__(self, class_names, with_mask = False, return_img_path = True, **kwargs):
+        # skips the directory scan of SerusoTestDataset
+        CamFlowDataset.__init__(self, loader = pil_loader, **kwargs)
+
+        self.with_mask = with_mask
+        self.return_img_path = return_img_path
+        self.mask_cache = None
+        self.class_names = list(class_names)
+        self.class_dic = {class_name: i for i, class_name in enumerate(self.class_names)}
+
+
+class TarShardDataset(data.IterableDataset):
+    """Streams the samples exported by general_utils.tar_shards, shard after shard.
+
+    Every sample is built by the __getitem__ of the exported dataset class (CamFlowDataset for
+    the training/validation sets, SerusoTestDataset for the test set), so its content is identical
+    to the one of the directory-based datasets; only the order changes. Shards are shuffled every
+    epoch (same order on every rank), split across the ranks and then across the DataLoader
+    workers, and samples go through a shuffle buffer of shuffle_buffer samples per worker.
+    With shuffle=False and a single worker the samples come in dataset order.
+    """
+    def __init__(self, shard_dir, transform: Optional[Callable] = None, augment = False, return_img_path = None, with_flow = False,
+                 with_mask = False, frame_cache_mb = 0, frame_cache_resize = None, decode_size = 'auto', shuffle = True, shuffle_buffer = 256, seed = 0,
+                 rank = None, world_size = None):
+
+        self.shard_dir = shard_dir
+        self.index = load_shard_index(shard_dir)
+        self.shards = [shard['name'] for shard in self.index['shards']]
+        self.shard_sizes = {shard['name'] : shard['num_samples'] for shard in self.index['shards']}
+
+        if self.index['kind'] == 'test':
+            self.samples = TarTestSamples(self.index['class_names'], with_mask = with_mask, return_img_path = True if return_img_path is None else return_img_path,
+                                          transform = transform, with_flow = with_flow, frame_cache_mb = frame_cache_mb, frame_cache_resize = frame_cache_resize,
+                                          decode_size = decode_size, seed = seed)
+        else:
+            self.samples = TarTrainSamples(self.index['class_names'], transform = transform, augment = augment, return_img_path = bool(return_img_path),
+                                           with_flow = with_flow, frame_cache_mb = frame_cache_mb, frame_cache_resize = frame_cache_resize, decode_size = decode_size,
+                                           seed = seed)
+
+        self.class_names = self.samples.class_names
+        self.rng = self.samples.rng
+        self.transform = transform
+
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer if shuffle else 0
+        self.seed = seed
+        self.epoch = 0
+
+        if rank is None or world_size is None:
+            distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+            rank = torch.distributed.get_rank() if distributed else 0
+            world_size = torch.distributed.get_world_size() if distributed else 1
+
+        self.rank = rank
+        self.world_size = world_size
+
+    def __len__(self):
+        # samples of the shards of this rank in the shard order of the next epoch; with shards of
+        # different sizes, this varies across ranks and epochs
+        return sum(self.shard_sizes[shard] for shard in self.get_rank_shards())
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.samples.set_epoch(epoch)
+
+    def get_rank_shards(self):
+        shards = list(self.shards)
+        if self.shuffle:
+            np.random.default_rng([self.seed, self.epoch]).shuffle(shards)
+
+        return shards[self.rank::self.world_size]
+
+    def get_worker_shards(self):
+        shards = self.get_rank_shards()
+
+        worker_info = data.get_worker_info()
+        if worker_info is not None:
+            shards = shards[worker_info.id::worker_info.num_workers]
+
+        return shards
+
+    def iter_samples(self, shards):
+        for shard in shards:
+            yield from iter_tar_samples(os.path.join(self.shard_dir, shard))
+
+    def __iter__(self):
+        worker_info = data.get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+
+        rng = np.random.default_rng([self.seed, self.epoch, self.rank, worker_id])
+        samples = self.iter_samples(self.get_worker_shards())
+        # with persistent workers the next epoch of this worker gets a new shard order
+        self.epoch += 1
+
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+
+            if self.shuffle_buffer > 0:
+                i = rng.integers(len(buffer))
+                buffer[i], sample = sample, buffer[i]
+
+            yield self.make_item(sample)
+
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield self.make_item(sample)
+
+    def make_item(self, sample):
+        self.samples.set_sample(*sample)
+        return self.samples[0]
+
+    def do_it_with_flows(self):
+        self.samples.do_it_with_flows()
+
+    def do_it_without_flows(self):
+        self.samples.do_it_without_flows()
+
+    def get_whith_flows_bool(self):
+        return self.samples.get_whith_flows_bool()
+
+    def frame_cache_stats(self):
+        return self.samples.frame_cache_stats()
+
+    def reset_frame_cache_stats(self):
+        self.samples.reset_frame_cache_stats()
+
+
 def split2list(images, split, default_split=1.1,order = False):
     if isinstance(split, str):
         with open(split) as f: